@@ -13,11 +13,29 @@ class RoleAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'updated_at')
 
 
+class RoleNameFilter(admin.SimpleListFilter):
+    """
+    Фильтр по роли через денормализованный users.role_name:
+    варианты берутся из кэша ролей, а не из SELECT DISTINCT по users
+    """
+    title = 'Роль'
+    parameter_name = 'role_name'
+    
+    def lookups(self, request, model_admin):
+        return [(name, name) for name in Role.objects.get_names()]
+    
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(role_name=self.value())
+        return queryset
+
+
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     """Админ-панель для пользователей"""
     list_display = ('username', 'email', 'role', 'is_active', 'last_login', 'created_at')
-    list_filter = ('role', 'is_active', 'created_at')
+    list_filter = (RoleNameFilter, 'is_active', 'created_at')
+    list_select_related = ('role',)
     search_fields = ('username', 'email')
     readonly_fields = ('created_at', 'updated_at', 'last_login')
     
@@ -38,6 +56,10 @@ class UserAdmin(admin.ModelAdmin):
     
     ordering = ('-created_at',)
     
+    def get_queryset(self, request):
+        """Роль подтягивается JOIN-ом, чтобы колонка role не давала N+1"""
+        return super().get_queryset(request).select_related('role')
+    
     def save_model(self, request, obj, form, change):
         if not change:
             obj.set_password(obj.password)
@@ -2,59 +2,131 @@
 Отправка email: подтверждение регистрации и сброс пароля (SMTP).
 """
 import logging
-from django.core.mail import send_mail
+from concurrent.futures import ThreadPoolExecutor
+from django.core.mail import send_mail, get_connection, EmailMessage
 from django.conf import settings
+from django.db import close_old_connections, transaction
 
 logger = logging.getLogger(__name__)
 
+REGISTRATION_SUBJECT = 'Подтверждение регистрации — СпортМаг'
+REGISTRATION_TEMPLATE = (
+    'Здравствуйте, {username}!\n\n'
+    'Вы успешно зарегистрированы в интернет-магазине СпортМаг.\n\n'
+    'Теперь вы можете войти в личный кабинет, оформлять заказы и отслеживать их статус.\n\n'
+    'С уважением,\n'
+    'Команда СпортМаг'
+)
 
-def send_registration_confirmation(email, username):
+PASSWORD_RESET_SUBJECT = 'Сброс пароля — СпортМаг'
+PASSWORD_RESET_TEMPLATE = (
+    'Здравствуйте, {username}!\n\n'
+    'Вы запросили сброс пароля для учётной записи в СпортМаг.\n\n'
+    'Перейдите по ссылке для установки нового пароля (действует 24 часа):\n{reset_link}\n\n'
+    'Если вы не запрашивали сброс пароля, проигнорируйте это письмо.\n\n'
+    'С уважением,\n'
+    'Команда СпортМаг'
+)
+
+# Фоновый пул для SMTP: ответ на запрос не ждёт TLS-рукопожатия и отправки.
+# Размер задаётся EMAIL_WORKERS независимо от числа веб-воркеров
+_email_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'EMAIL_WORKERS', 2), thread_name_prefix='email'
+)
+
+
+def send_in_background(func, *args, **kwargs):
+    """
+    Отправить письмо в фоновом потоке после фиксации текущей транзакции.
+
+    Если EMAIL_ASYNC выключен (например, в тестах), письмо отправляется синхронно.
+    """
+    if not getattr(settings, 'EMAIL_ASYNC', True):
+        func(*args, **kwargs)
+        return
+    transaction.on_commit(lambda: _email_executor.submit(_run_in_worker, func, *args, **kwargs))
+
+
+def _run_in_worker(func, *args, **kwargs):
+    """
+    Выполнить задачу в потоке пула. Задача может обращаться к БД
+    (например, поиск пользователя при сбросе пароля), поэтому соединение потока
+    проверяется и закрывается по тем же правилам, что и в обработке запросов.
+    """
+    close_old_connections()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        logger.warning('Ошибка фоновой задачи отправки письма: %s', e)
+    finally:
+        close_old_connections()
+
+
+def send_registration_confirmation(email, username, connection=None):
     """
     Отправить письмо с подтверждением регистрации.
     Не блокирует регистрацию при ошибке отправки (fail_silently=True).
+
+    Args:
+        connection: открытое SMTP-соединение для повторного использования
+            (если не передано, Django откроет новое на одно письмо)
     """
-    subject = 'Подтверждение регистрации — СпортМаг'
-    message = (
-        f'Здравствуйте, {username}!\n\n'
-        'Вы успешно зарегистрированы в интернет-магазине СпортМаг.\n\n'
-        'Теперь вы можете войти в личный кабинет, оформлять заказы и отслеживать их статус.\n\n'
-        'С уважением,\n'
-        'Команда СпортМаг'
-    )
     try:
         send_mail(
-            subject=subject,
-            message=message,
+            subject=REGISTRATION_SUBJECT,
+            message=REGISTRATION_TEMPLATE.format(username=username),
             from_email=settings.DEFAULT_FROM_EMAIL,
             recipient_list=[email],
             fail_silently=True,
+            connection=connection,
         )
     except Exception as e:
         logger.warning('Не удалось отправить письмо подтверждения регистрации: %s', e)
 
 
-def send_password_reset_email(email, username, reset_token):
+def send_password_reset_email(email, username, reset_token, connection=None):
     """
     Отправить письмо со ссылкой для сброса пароля.
     """
     frontend_url = getattr(settings, 'FRONTEND_URL', 'http://127.0.0.1:8001').rstrip('/')
     reset_link = f'{frontend_url}/reset-password/{reset_token}/'
-    subject = 'Сброс пароля — СпортМаг'
-    message = (
-        f'Здравствуйте, {username}!\n\n'
-        'Вы запросили сброс пароля для учётной записи в СпортМаг.\n\n'
-        f'Перейдите по ссылке для установки нового пароля (действует 24 часа):\n{reset_link}\n\n'
-        'Если вы не запрашивали сброс пароля, проигнорируйте это письмо.\n\n'
-        'С уважением,\n'
-        'Команда СпортМаг'
-    )
     try:
         send_mail(
-            subject=subject,
-            message=message,
+            subject=PASSWORD_RESET_SUBJECT,
+            message=PASSWORD_RESET_TEMPLATE.format(username=username, reset_link=reset_link),
             from_email=settings.DEFAULT_FROM_EMAIL,
             recipient_list=[email],
             fail_silently=True,
+            connection=connection,
         )
     except Exception as e:
         logger.warning('Не удалось отправить письмо сброса пароля: %s', e)
+
+
+def send_bulk(emails):
+    """
+    Отправить пачку писем через одно SMTP-соединение
+    (TLS-рукопожатие и AUTH выполняются один раз на всю пачку).
+
+    Args:
+        emails: итерируемое из кортежей (subject, message, recipient)
+
+    Returns:
+        int: количество отправленных писем
+    """
+    try:
+        with get_connection(fail_silently=True) as connection:
+            messages = [
+                EmailMessage(
+                    subject=subject,
+                    body=message,
+                    from_email=settings.DEFAULT_FROM_EMAIL,
+                    to=[recipient],
+                    connection=connection,
+                )
+                for subject, message, recipient in emails
+            ]
+            return connection.send_messages(messages) or 0
+    except Exception as e:
+        logger.warning('Не удалось отправить пачку писем: %s', e)
+        return 0
@@ -1,15 +1,72 @@
 """
 Модели пользователей и ролей (User, Role) и менеджеры.
 """
-from django.db import models
+from django.db import models, connection
+from django.db.models.functions import Lower
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.core.validators import RegexValidator
+from apps.common.fields import FastJSONField
 import json
 
+# Сдвиг updated_at в raw UPDATE shop.users: auto_now срабатывает только в save(),
+# а по updated_at строится ключ кэша /auth/me/. clock_timestamp(), а не NOW():
+# несколько UPDATE в одной транзакции тоже дают разные значения
+USER_TOUCH_SQL = 'updated_at = clock_timestamp()'
+
 
 class RoleManager(models.Manager):
     """Менеджер для модели Role"""
-    pass
+    CACHE_TIMEOUT = 3600
+    CACHE_KEY_PREFIX = 'role_by_name_'
+    CACHE_KEY_BY_ID_PREFIX = 'role_by_id_'
+    CACHE_KEY_NAMES = 'role_names'
+    CACHE_KEY_SERIALIZED = 'role_list_serialized'
+    
+    def get_by_name(self, name):
+        """
+        Получение роли по названию с кэшированием
+        (таблица ролей маленькая и почти не меняется)
+        
+        Raises:
+            Role.DoesNotExist: если роль не найдена
+        """
+        cache_key = f"{self.CACHE_KEY_PREFIX}{name}"
+        role = cache.get(cache_key)
+        if role is None:
+            role = self.get(name=name)
+            cache.set(cache_key, role, self.CACHE_TIMEOUT)
+        return role
+    
+    def get_by_id(self, role_id):
+        """
+        Получение роли по id с кэшированием
+        (смена роли пользователя, сериализация роли без JOIN)
+        
+        Raises:
+            Role.DoesNotExist: если роль не найдена
+        """
+        cache_key = f"{self.CACHE_KEY_BY_ID_PREFIX}{role_id}"
+        role = cache.get(cache_key)
+        if role is None:
+            role = self.get(id=role_id)
+            cache.set(cache_key, role, self.CACHE_TIMEOUT)
+        return role
+    
+    def get_names(self):
+        """Список названий ролей с кэшированием (для фильтров и выпадающих списков)"""
+        names = cache.get(self.CACHE_KEY_NAMES)
+        if names is None:
+            names = list(self.order_by('name').values_list('name', flat=True))
+            cache.set(self.CACHE_KEY_NAMES, names, self.CACHE_TIMEOUT)
+        return names
+    
+    def invalidate_cache(self, *names, role_id=None):
+        """Инвалидация кэша ролей по названиям (и id) и списка названий"""
+        keys = [f"{self.CACHE_KEY_PREFIX}{name}" for name in names if name]
+        if role_id is not None:
+            keys.append(f"{self.CACHE_KEY_BY_ID_PREFIX}{role_id}")
+        cache.delete_many(keys + [self.CACHE_KEY_NAMES, self.CACHE_KEY_SERIALIZED])
 
 
 class Role(models.Model):
@@ -30,6 +87,19 @@ class Role(models.Model):
     
     def __str__(self):
         return self.name
+    
+    def save(self, *args, **kwargs):
+        """Сохранение с инвалидацией кэша (включая старое название при переименовании)"""
+        old_name = None
+        if self.pk and not self._state.adding:
+            old_name = Role.objects.filter(pk=self.pk).values_list('name', flat=True).first()
+        super().save(*args, **kwargs)
+        Role.objects.invalidate_cache(self.name, old_name, role_id=self.pk)
+    
+    def delete(self, *args, **kwargs):
+        """Инвалидация кэша при удалении"""
+        Role.objects.invalidate_cache(self.name, role_id=self.pk)
+        return super().delete(*args, **kwargs)
 
 
 class UserManager(BaseUserManager):
@@ -49,12 +119,14 @@ class UserManager(BaseUserManager):
             raise ValueError('Username обязателен')
         
         email = self.normalize_email(email)
+        role = extra_fields.pop('role', None)
         user = self.model(username=username, email=email, **extra_fields)
         
-        try:
-            role = Role.objects.get(name=role_name)
-        except Role.DoesNotExist:
-            raise ValueError(f'Роль {role_name} не найдена')
+        if role is None:
+            try:
+                role = Role.objects.get_by_name(role_name)
+            except Role.DoesNotExist:
+                raise ValueError(f'Роль {role_name} не найдена')
         
         user.role = role
         
@@ -86,9 +158,17 @@ class User(AbstractBaseUser):
         related_name='users',
         verbose_name='Роль'
     )
+    role_name = models.CharField(
+        max_length=50,
+        blank=True,
+        default='',
+        db_index=True,
+        editable=False,
+        verbose_name='Название роли'
+    )
     is_active = models.BooleanField(default=True, verbose_name='Активен')
     last_login = models.DateTimeField(null=True, blank=True, verbose_name='Последний вход')
-    settings = models.JSONField(default=dict, blank=True, verbose_name='Настройки')
+    settings = FastJSONField(default=dict, blank=True, verbose_name='Настройки')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
     
@@ -102,14 +182,32 @@ class User(AbstractBaseUser):
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at'], name='idx_users_created_at'),
+            models.Index(Lower('email'), name='idx_users_email_lower'),
+        ]
     
     def __str__(self):
         return self.username
     
+    def save(self, *args, **kwargs):
+        """
+        Синхронизация денормализованного role_name при смене роли
+        (в БД то же самое делает триггер trg_users_sync_role_name)
+        """
+        update_fields = kwargs.get('update_fields')
+        role_changed = update_fields is None or bool({'role', 'role_id'} & set(update_fields))
+        if role_changed and self.role_id is not None:
+            self.role_name = self.role.name
+            if update_fields is not None:
+                kwargs['update_fields'] = [*update_fields, 'role_name']
+        super().save(*args, **kwargs)
+    
     @property
     def is_staff(self):
-        """Является ли пользователь администратором"""
-        return self.role.name == 'Admin' if self.role else False
+        """Является ли пользователь администратором (без JOIN с roles)"""
+        role_name = self.role_name or (self.role.name if self.role_id is not None else '')
+        return role_name == 'Admin'
     
     @property
     def is_superuser(self):
@@ -125,17 +223,66 @@ class User(AbstractBaseUser):
         return self.is_staff
     
     def get_settings(self):
-        """Получить настройки пользователя"""
+        """
+        Получить настройки пользователя.
+        Старые строки, где настройки хранятся JSON-строкой, декодируются один раз
+        и сохраняются на экземпляре, повторные вызовы json.loads не выполняют.
+        """
         if isinstance(self.settings, str):
-            return json.loads(self.settings)
+            self.settings = json.loads(self.settings or '{}')
         return self.settings or {}
     
+    def _update_settings(self, sql, params):
+        """
+        Точечное изменение JSONB-настроек на стороне БД (без чтения-изменения-записи).
+        
+        Args:
+            sql: выражение UPDATE shop.users, сдвигающее updated_at (USER_TOUCH_SQL)
+                и заканчивающееся RETURNING settings, updated_at
+            params: параметры запроса
+        
+        Returns:
+            bool: была ли обновлена строка
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        self.settings = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        self.updated_at = row[1]
+        return True
+    
     def set_setting(self, key, value):
         """Установить настройку"""
-        settings = self.get_settings()
-        settings[key] = value
-        self.settings = settings
-        self.save(update_fields=['settings'])
+        self._update_settings(
+            "UPDATE shop.users "
+            "SET settings = jsonb_set(COALESCE(settings, '{}'::jsonb), ARRAY[%s]::text[], %s::jsonb), "
+            f"{USER_TOUCH_SQL} "
+            "WHERE id = %s RETURNING settings, updated_at",
+            [key, json.dumps(value), self.id]
+        )
+    
+    def update_settings(self, values):
+        """
+        Обновить несколько настроек одним UPDATE: переданные ключи сливаются
+        с текущим JSONB оператором || на стороне БД. Параллельные изменения
+        других ключей не теряются. Старые настройки, хранящиеся JSON-строкой,
+        разворачиваются в объект тем же запросом.
+        
+        Args:
+            values: словарь {ключ: значение}
+        """
+        return self._update_settings(
+            "UPDATE shop.users "
+            "SET settings = (CASE jsonb_typeof(settings) "
+            "WHEN 'object' THEN settings "
+            "WHEN 'string' THEN (settings #>> '{}')::jsonb "
+            "ELSE '{}'::jsonb END) || %s::jsonb, "
+            f"{USER_TOUCH_SQL} "
+            "WHERE id = %s RETURNING settings, updated_at",
+            [json.dumps(values), self.id]
+        )
     
     def get_saved_cards(self):
         """Получить сохраненные карты (хешированные)"""
@@ -144,43 +291,40 @@ class User(AbstractBaseUser):
     
     def add_saved_card(self, card_hash, last_four, cardholder_name):
         """
-        Добавить сохраненную карту (только хеш)
+        Добавить сохраненную карту (только хеш).
+        Проверка дубликата по хешу выполняется в БД (оператор @>), без перебора карт в Python.
         
         Args:
             card_hash: хеш данных карты (используя crypt)
             last_four: последние 4 цифры карты
             cardholder_name: имя держателя карты
         """
-        import hashlib
-        settings = self.get_settings()
-        if 'saved_cards' not in settings:
-            settings['saved_cards'] = []
-        
-        for card in settings['saved_cards']:
-            if card.get('hash') == card_hash:
-                return False
-        
-        settings['saved_cards'].append({
+        card = {
             'hash': card_hash,
             'last_four': last_four,
             'cardholder_name': cardholder_name,
             'added_at': str(self.updated_at)
-        })
-        self.settings = settings
-        self.save(update_fields=['settings'])
-        return True
+        }
+        return self._update_settings(
+            "UPDATE shop.users "
+            "SET settings = jsonb_set(COALESCE(settings, '{}'::jsonb), '{saved_cards}', "
+            "COALESCE(settings->'saved_cards', '[]'::jsonb) || %s::jsonb), "
+            f"{USER_TOUCH_SQL} "
+            "WHERE id = %s AND NOT COALESCE(settings->'saved_cards', '[]'::jsonb) "
+            "@> jsonb_build_array(jsonb_build_object('hash', %s::text)) "
+            "RETURNING settings, updated_at",
+            [json.dumps([card]), self.id, card_hash]
+        )
     
     def remove_saved_card(self, card_hash):
         """Удалить сохраненную карту"""
-        settings = self.get_settings()
-        if 'saved_cards' not in settings:
-            return False
-        
-        settings['saved_cards'] = [
-            card for card in settings['saved_cards']
-            if card.get('hash') != card_hash
-        ]
-        self.settings = settings
-        self.save(update_fields=['settings'])
-        return True
-
+        return self._update_settings(
+            "UPDATE shop.users "
+            "SET settings = jsonb_set(settings, '{saved_cards}', COALESCE(("
+            "SELECT jsonb_agg(card) FROM jsonb_array_elements(settings->'saved_cards') AS card "
+            "WHERE card->>'hash' IS DISTINCT FROM %s), '[]'::jsonb)), "
+            f"{USER_TOUCH_SQL} "
+            "WHERE id = %s AND settings ? 'saved_cards' "
+            "RETURNING settings, updated_at",
+            [card_hash, self.id]
+        )
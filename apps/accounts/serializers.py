@@ -3,9 +3,18 @@
 """
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from django.core.cache import cache
+from django.db.models import Q
+from functools import lru_cache
+from apps.common.card_utils import mask_card_number
 from .models import User, Role
 
 
+# Маскирование последних 4 цифр детерминировано (не более 10^4 вариантов),
+# поэтому результат кэшируется; полные номера карт сюда не передаются
+_mask_last_four = lru_cache(maxsize=1024)(mask_card_number)
+
+
 class RoleSerializer(serializers.ModelSerializer):
     """Сериализатор для роли"""
     
@@ -15,6 +24,18 @@ class RoleSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at')
 
 
+def get_cached_roles():
+    """
+    Сериализованный список ролей с кэшированием
+    (инвалидируется в Role.save/delete через RoleManager.invalidate_cache)
+    """
+    data = cache.get(Role.objects.CACHE_KEY_SERIALIZED)
+    if data is None:
+        data = [dict(item) for item in RoleSerializer(Role.objects.all(), many=True).data]
+        cache.set(Role.objects.CACHE_KEY_SERIALIZED, data, Role.objects.CACHE_TIMEOUT)
+    return data
+
+
 class UserRegistrationSerializer(serializers.Serializer):
     """Сериализатор для регистрации пользователя"""
     username = serializers.CharField(max_length=100, min_length=3)
@@ -22,17 +43,21 @@ class UserRegistrationSerializer(serializers.Serializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
     role_name = serializers.CharField(default='Buyer', required=False)
     
-    def validate_username(self, value):
-        """Проверка уникальности username"""
-        if User.objects.filter(username=value).exists():
-            raise serializers.ValidationError("Пользователь с таким именем уже существует")
-        return value
-    
-    def validate_email(self, value):
-        """Проверка уникальности email"""
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("Пользователь с таким email уже существует")
-        return value
+    def validate(self, attrs):
+        """Проверка уникальности username и email одним запросом"""
+        username, email = attrs['username'], attrs['email']
+        taken = User.objects.filter(
+            Q(username=username) | Q(email=email)
+        ).order_by().values_list('username', 'email')[:2]
+        errors = {}
+        for taken_username, taken_email in taken:
+            if taken_username == username:
+                errors['username'] = "Пользователь с таким именем уже существует"
+            if taken_email == email:
+                errors['email'] = "Пользователь с таким email уже существует"
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -53,27 +78,23 @@ class UserSerializer(serializers.ModelSerializer):
     
     def get_saved_cards(self, obj):
         """Получить сохраненные карты (без полных данных, только маскированные)"""
-        from apps.common.card_utils import mask_card_number
-        cards = obj.get_saved_cards()
-        masked_cards = []
-        for card in cards:
-            masked_card = {
-                'last_four': card.get('last_four', '****'),
+        return [
+            {
+                'last_four': last_four,
                 'cardholder_name': card.get('cardholder_name', ''),
                 'added_at': card.get('added_at', ''),
-                'masked_number': mask_card_number(card.get('last_four', '****') if len(card.get('last_four', '')) == 4 else '****')
+                'masked_number': _mask_last_four(last_four if len(last_four) == 4 else '****'),
             }
-            masked_cards.append(masked_card)
-        
-        return masked_cards
+            for card in obj.get_saved_cards()
+            for last_four in (card.get('last_four', '****'),)
+        ]
     
     def update(self, instance, validated_data):
         """Обновление пользователя (включая смену пароля через crypt в БД)."""
         role_id = validated_data.pop('role_id', None)
         if role_id is not None:
             try:
-                role = Role.objects.get(id=role_id)
-                instance.role = role
+                instance.role = Role.objects.get_by_id(role_id)
             except Role.DoesNotExist:
                 raise serializers.ValidationError({'role_id': 'Роль не найдена'})
         
@@ -93,8 +114,11 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class UserListSerializer(serializers.ModelSerializer):
-    """Упрощенный сериализатор для списка пользователей"""
-    role_name = serializers.CharField(source='role.name', read_only=True)
+    """
+    Упрощенный сериализатор для списка пользователей.
+    role_name читается из денормализованной колонки users.role_name — без JOIN с roles
+    (в том числе во вложенных user/created_by журналов и бекапов)
+    """
     
     class Meta:
         model = User
@@ -1,16 +1,39 @@
 """
 Сервис регистрации, аутентификации и смены пароля (интеграция с БД).
 """
-from django.db import connection
+import hashlib
+import hmac
+import logging
+import secrets
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models.functions import Lower
 from django.contrib.auth import get_user_model
-from .models import Role
-from ..common.utils import set_current_user_id
+from .models import Role, USER_TOUCH_SQL
+from .email_service import send_password_reset_email
+from ..common.utils import set_current_user_id, set_current_role
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+PASSWORD_RESET_CACHE_PREFIX = 'pw_reset:'
+PASSWORD_RESET_TIMEOUT = 86400
+
+
+def password_reset_cache_key(token):
+    """
+    Ключ кэша для токена сброса пароля: HMAC-SHA256 от токена на SECRET_KEY.
+    Сам токен в кэше не хранится — дамп кэша не раскрывает действующие ссылки.
+    """
+    digest = hmac.new(settings.SECRET_KEY.encode(), token.encode(), hashlib.sha256).hexdigest()
+    return PASSWORD_RESET_CACHE_PREFIX + digest
 
 
 class UserService:
     """Сервис для работы с пользователями"""
+    # Минимальный интервал (в секундах) между записями last_login при повторных входах
+    LAST_LOGIN_UPDATE_INTERVAL = 60
     
     @staticmethod
     def register_user(username, email, password, role_name='Buyer'):
@@ -24,31 +47,43 @@ class UserService:
             role_name: название роли (по умолчанию 'Buyer')
         
         Returns:
-            user_id: ID созданного пользователя
+            User: созданный пользователь (с подгруженной ролью)
         
         Raises:
             ValueError: если роль не найдена или пользователь уже существует
         """
         try:
-            role = Role.objects.get(name=role_name)
+            Role.objects.get_by_name(role_name)
         except Role.DoesNotExist:
             raise ValueError(f'Роль {role_name} не найдена')
         
-        if User.objects.filter(username=username).exists():
-            raise ValueError('Пользователь с таким именем уже существует')
-        
-        if User.objects.filter(email=email).exists():
-            raise ValueError('Пользователь с таким email уже существует')
-        
-        with connection.cursor() as cursor:
-            cursor.callproc('register_user', [username, email, password, role_name])
-            result = cursor.fetchone()
-            user_id = result[0] if result else None
+        # Уникальность username/email проверяет сама БД (UNIQUE-ограничения),
+        # поэтому отдельные SELECT EXISTS перед вызовом процедуры не нужны
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.callproc('register_user', [username, email, password, role_name])
+                result = cursor.fetchone()
+                user_id = result[0] if result else None
+        except IntegrityError as e:
+            raise ValueError(UserService._unique_violation_message(e))
         
         if not user_id:
             raise ValueError('Ошибка при создании пользователя')
-        user = User.objects.get(id=user_id)
-        return user
+        # Процедура возвращает только id: пользователь читается целиком одним SELECT
+        # вместе с ролью, чтобы даты, настройки и значения, выставленные процедурой,
+        # не догружались отдельными запросами и не затирались при save()
+        return User.objects.select_related('role').get(id=user_id)
+    
+    @staticmethod
+    def _unique_violation_message(error):
+        """Текст ошибки по имени нарушенного UNIQUE-ограничения users"""
+        diag = getattr(error.__cause__, 'diag', None)
+        constraint = (getattr(diag, 'constraint_name', None) or str(error)).lower()
+        if 'email' in constraint:
+            return 'Пользователь с таким email уже существует'
+        if 'username' in constraint:
+            return 'Пользователь с таким именем уже существует'
+        return 'Пользователь уже существует'
     
     @staticmethod
     def authenticate_user(username, password):
@@ -63,55 +98,83 @@ class UserService:
             User: объект пользователя или None
         """
         try:
-            user = User.objects.get(username=username, is_active=True)
-        except User.DoesNotExist:
-            return None
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f'Ошибка при получении пользователя: {e}')
-            return None
-        
-        try:
+            # Проверка пароля через crypt и отметка last_login одним запросом;
+            # строка перезаписывается, только если прошлый вход был давнее интервала
             with connection.cursor() as cursor:
                 cursor.execute(
-                    "SELECT (password_hash = crypt(%s, password_hash)) FROM shop.users WHERE id = %s",
-                    [password, user.id]
+                    "WITH u AS ("
+                    "    SELECT id, last_login FROM shop.users "
+                    "    WHERE username = %s AND is_active "
+                    "    AND password_hash = crypt(%s, password_hash)"
+                    "), touched AS ("
+                    f"    UPDATE shop.users SET last_login = NOW(), {USER_TOUCH_SQL} FROM u "
+                    "    WHERE shop.users.id = u.id AND (u.last_login IS NULL "
+                    "    OR u.last_login < NOW() - make_interval(secs => %s))"
+                    ") "
+                    "SELECT id FROM u",
+                    [username, password, UserService.LAST_LOGIN_UPDATE_INTERVAL]
                 )
                 result = cursor.fetchone()
-                
-                if result and result[0]:
-                    from django.utils import timezone
-                    user.last_login = timezone.now()
-                    user.save(update_fields=['last_login'])
-                    return user
+            
+            if not result:
+                return None
+            return User.objects.select_related('role').get(id=result[0])
         except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
             logger.error(f'Ошибка при проверке пароля: {e}')
             return None
-        
-        return None
     
     @staticmethod
     def set_user_context(user):
         """Установка контекста пользователя для триггеров БД"""
         if user:
             set_current_user_id(user.id)
-            if user.role:
-                from ..common.utils import set_current_role
-                set_current_role(user.role.name)
+            if user.role_name:
+                set_current_role(user.role_name)
 
     @staticmethod
-    def update_password(user_id, new_password):
+    def update_password(user_id, new_password, active_only=False):
         """
         Обновить пароль пользователя (хеш через crypt в БД).
-        Используется при смене пароля админом.
+        Используется при смене пароля админом и при сбросе пароля.
+        
+        Args:
+            active_only: обновлять только активного пользователя
+                (проверка выполняется тем же UPDATE, без отдельного SELECT)
+        
+        Returns:
+            bool: True, если пароль обновлён
         """
+        query = (
+            "UPDATE shop.users SET password_hash = crypt(%s, gen_salt('bf')), "
+            f"{USER_TOUCH_SQL} WHERE id = %s"
+        )
+        if active_only:
+            query += " AND is_active"
         with connection.cursor() as cursor:
-            cursor.execute(
-                "UPDATE shop.users SET password_hash = crypt(%s, gen_salt('bf')) WHERE id = %s",
-                [new_password, user_id]
+            cursor.execute(query, [new_password, user_id])
+            return cursor.rowcount > 0
+    
+    @staticmethod
+    def request_password_reset(email):
+        """
+        Выпустить токен сброса пароля и отправить письмо, если есть активный
+        пользователь с таким email. Вызывается в фоне из password_reset_request.
+        
+        Args:
+            email: email в нижнем регистре
+        
+        Returns:
+            bool: было ли отправлено письмо
+        """
+        try:
+            # LOWER(email) = %s использует индекс idx_users_email_lower
+            user = User.objects.alias(email_lower=Lower('email')).only('id', 'username', 'email').get(
+                email_lower=email, is_active=True
             )
+        except User.DoesNotExist:
+            return False
+        
+        token = secrets.token_urlsafe(32)
+        cache.set(password_reset_cache_key(token), user.id, timeout=PASSWORD_RESET_TIMEOUT)
+        send_password_reset_email(user.email, user.username, token)
         return True
-
@@ -1,7 +1,9 @@
 """
 Тесты аутентификации, управления пользователями и сброса пароля.
 """
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
@@ -15,11 +17,15 @@ User = get_user_model()
 class AuthenticationTestCase(TestCase):
     """Тесты для аутентификации"""
     
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
+        cls.admin_role, _ = Role.objects.get_or_create(name='Admin')
+    
     def setUp(self):
         """Настройка тестового окружения"""
         self.client = APIClient()
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
-        self.admin_role, _ = Role.objects.get_or_create(name='Admin')
     
     def test_register_user(self):
         """Тест регистрации пользователя"""
@@ -101,31 +107,101 @@ class AuthenticationTestCase(TestCase):
         response = self.client.get('/api/v1/auth/me/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['username'], 'testuser')
+    
+    def test_login_and_me_do_not_query_roles_separately(self):
+        """Роль подгружается вместе с пользователем: отдельного SELECT из roles нет"""
+        User.objects.create_user(
+            username='testuser',
+            email='test@test.com',
+            password='testpass123',
+            role=self.buyer_role
+        )
+        
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/v1/auth/login/', {
+                'username': 'testuser',
+                'password': 'testpass123'
+            })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user']['role']['name'], 'Buyer')
+        
+        access = response.data['tokens']['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        with CaptureQueriesContext(connection) as me_ctx:
+            response = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        role_queries = [
+            q['sql'] for q in ctx.captured_queries + me_ctx.captured_queries
+            if q['sql'].lstrip().upper().startswith('SELECT') and 'FROM "roles"' in q['sql']
+        ]
+        self.assertEqual(role_queries, [])
+    
+    def test_get_current_user_served_from_cache(self):
+        """Повторный запрос /me/ без изменений пользователя не сериализует его заново"""
+        from unittest.mock import patch
+        user = User.objects.create_user(
+            username='testuser',
+            email='test@test.com',
+            password='testpass123',
+            role=self.buyer_role
+        )
+        refresh = RefreshToken.for_user(user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(refresh.access_token)}')
+        
+        first = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        with patch('apps.accounts.views.UserSerializer', side_effect=AssertionError):
+            second = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first.data)
+    
+    def test_logout_blacklists_refresh_token(self):
+        """Тест выхода: refresh-токен попадает в чёрный список и больше не обновляется"""
+        user = User.objects.create_user(
+            username='testuser',
+            email='test@test.com',
+            password='testpass123',
+            role=self.buyer_role
+        )
+        
+        refresh = RefreshToken.for_user(user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(refresh.access_token)}')
+        
+        response = self.client.post('/api/v1/auth/logout/', {'refresh': str(refresh)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        self.client.credentials()
+        response = self.client.post('/api/v1/auth/refresh/', {'refresh': str(refresh)})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
 
 class UserManagementTestCase(TestCase):
     """Тесты для управления пользователями"""
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.client = APIClient()
-        
-        self.admin_role, _ = Role.objects.get_or_create(name='Admin')
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.admin_role, _ = Role.objects.get_or_create(name='Admin')
+        cls.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
         
-        self.admin = User.objects.create_user(
+        cls.admin = User.objects.create_user(
             username='admin',
             email='admin@test.com',
             password='testpass123',
-            role=self.admin_role
+            role=cls.admin_role
         )
-        self.buyer = User.objects.create_user(
+        cls.buyer = User.objects.create_user(
             username='buyer',
             email='buyer@test.com',
             password='testpass123',
-            role=self.buyer_role
+            role=cls.buyer_role
         )
     
+    def setUp(self):
+        """Настройка тестового окружения"""
+        self.client = APIClient()
+    
     def get_admin_token(self):
         """Получить токен администратора"""
         refresh = RefreshToken.for_user(self.admin)
@@ -143,6 +219,15 @@ class UserManagementTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('results', response.data)
     
+    def test_list_users_role_name_without_join(self):
+        """Список пользователей отдаёт role_name из users без обращения к roles"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        response = self.client.get('/api/v1/users/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        role_names = {row['username']: row['role_name'] for row in response.data['results']}
+        self.assertEqual(role_names['buyer'], 'Buyer')
+        self.assertEqual(role_names['admin'], 'Admin')
+    
     def test_list_users_buyer_forbidden(self):
         """Тест запрета получения списка пользователей покупателем"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
@@ -167,29 +252,84 @@ class UserManagementTestCase(TestCase):
         response = self.client.put('/api/v1/users/me/settings/', data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['theme'], 'dark')
+    
+    def test_update_user_settings_merges_keys(self):
+        """PUT настроек сливает разрешённые ключи с сохранёнными, остальные не трогает"""
+        self.buyer.set_setting('theme', 'light')
+        self.buyer.set_setting('saved_cards', [])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
+        response = self.client.put(
+            '/api/v1/users/me/settings/', {'page_size': 50, 'is_admin': True}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['page_size'], 50)
+        self.assertEqual(response.data['theme'], 'light')
+        self.assertIn('saved_cards', response.data)
+        self.assertNotIn('is_admin', response.data)
+    
+    def test_me_reflects_settings_updates(self):
+        """Кэш /auth/me/ не отдаёт устаревшие настройки после raw UPDATE users"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
+        response = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(response.data['settings'], {})
+        
+        response = self.client.put('/api/v1/users/me/settings/', {'theme': 'dark'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(response.data['settings'], {'theme': 'dark'})
+        
+        # Повторное изменение в той же транзакции тоже сдвигает updated_at
+        self.buyer.add_saved_card('hash-1', '4242', 'IVAN IVANOV')
+        response = self.client.get('/api/v1/auth/me/')
+        self.assertEqual(response.data['saved_cards'][0]['last_four'], '4242')
 
+    
+    def test_role_list_cache_invalidated_on_role_create(self):
+        """Кэш списка ролей сбрасывается при создании роли"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
+        self.client.get('/api/v1/roles/')
+        Role.objects.create(name='Analyst')
+        response = self.client.get('/api/v1/roles/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = [role['name'] for role in response.data['results']]
+        self.assertIn('Analyst', names)
 
 class UserServiceTestCase(TestCase):
     """Тесты для сервиса пользователей"""
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
-        self.admin_role, _ = Role.objects.get_or_create(name='Admin')
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
+        cls.admin_role, _ = Role.objects.get_or_create(name='Admin')
     
     def test_register_user_service(self):
         """Тест регистрации пользователя через сервис"""
-        user_id = UserService.register_user(
+        user = UserService.register_user(
             username='serviceuser',
             email='service@test.com',
             password='testpass123',
             role_name='Buyer'
         )
         
-        self.assertIsNotNone(user_id)
-        user = User.objects.get(id=user_id)
-        self.assertEqual(user.username, 'serviceuser')
-        self.assertEqual(user.role.name, 'Buyer')
+        # Пользователь загружен полностью: обращение к полям и роли не делает запросов
+        self.assertEqual(user.get_deferred_fields(), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(user.username, 'serviceuser')
+            self.assertIsNotNone(user.created_at)
+            self.assertEqual(user.role.name, 'Buyer')
+    
+    def test_update_password_active_only(self):
+        """Пароль неактивного пользователя не меняется при active_only=True"""
+        user = User.objects.create_user(
+            username='inactive',
+            email='inactive@test.com',
+            password='testpass123',
+            role=self.buyer_role,
+            is_active=False
+        )
+        self.assertFalse(UserService.update_password(user.id, 'newpass123', active_only=True))
+        self.assertTrue(UserService.update_password(user.id, 'newpass123'))
     
     def test_register_user_duplicate(self):
         """Тест регистрации с дублирующимся именем"""
@@ -207,6 +347,23 @@ class UserServiceTestCase(TestCase):
                 password='testpass123',
                 role_name='Buyer'
             )
+    
+    def test_role_by_name_is_cached(self):
+        """Повторное получение роли по названию не обращается к БД"""
+        Role.objects.invalidate_cache('Buyer')
+        self.assertEqual(Role.objects.get_by_name('Buyer').id, self.buyer_role.id)
+        with self.assertNumQueries(0):
+            Role.objects.get_by_name('Buyer')
+    
+    def test_role_by_id_is_cached_and_invalidated(self):
+        """Роль по id берётся из кэша и сбрасывается при переименовании"""
+        role = Role.objects.create(name='Temp')
+        self.assertEqual(Role.objects.get_by_id(role.id).name, 'Temp')
+        with self.assertNumQueries(0):
+            Role.objects.get_by_id(role.id)
+        role.name = 'Renamed'
+        role.save()
+        self.assertEqual(Role.objects.get_by_id(role.id).name, 'Renamed')
 
 
 class FiveUnitTests(TestCase):
@@ -215,9 +372,12 @@ class FiveUnitTests(TestCase):
     Запуск: python manage.py test apps.accounts.tests.FiveUnitTests
     """
 
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
+
     def setUp(self):
         self.client = APIClient()
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
 
     def test_1_password_reset_request_empty_email_returns_400(self):
         """Запрос сброса пароля без email возвращает 400."""
@@ -271,3 +431,59 @@ class FiveUnitTests(TestCase):
             self.assertIn('testuser', call_kw['message'])
             self.assertEqual(call_kw['subject'], 'Подтверждение регистрации — СпортМаг')
 
+
+
+class EmailServiceTestCase(TestCase):
+    """Тесты для сервиса отправки писем"""
+
+    def test_send_bulk_uses_single_connection(self):
+        """Пачка писем отправляется через одно соединение"""
+        from unittest.mock import patch
+        from django.core import mail
+        from .email_service import send_bulk
+        with patch('apps.accounts.email_service.get_connection', wraps=mail.get_connection) as mock_conn:
+            sent = send_bulk([
+                ('Тема 1', 'Текст 1', 'first@test.com'),
+                ('Тема 2', 'Текст 2', 'second@test.com'),
+            ])
+        mock_conn.assert_called_once()
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].to, ['second@test.com'])
+
+    def test_password_reset_request_queued_after_commit(self):
+        """Запрос сброса пароля целиком уходит в фоновый пул после фиксации транзакции"""
+        from unittest.mock import patch
+        from django.test import override_settings
+        from .email_service import _run_in_worker
+        client = APIClient()
+        with override_settings(EMAIL_ASYNC=True), \
+                patch('apps.accounts.email_service._email_executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post('/api/v1/auth/password-reset/', {'email': 'Reset@Test.com'})
+                executor.submit.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        executor.submit.assert_called_once_with(
+            _run_in_worker, UserService.request_password_reset, 'reset@test.com'
+        )
+    
+    def test_request_password_reset_sends_link(self):
+        """Письмо со ссылкой уходит только существующему пользователю, в кэше — HMAC токена"""
+        from django.core import mail
+        from django.core.cache import cache
+        from .services import password_reset_cache_key
+        role, _ = Role.objects.get_or_create(name='Buyer')
+        user = User.objects.create_user(
+            username='resetuser',
+            email='Reset@test.com',
+            password='testpass123',
+            role=role
+        )
+        self.assertFalse(UserService.request_password_reset('missing@test.com'))
+        self.assertEqual(len(mail.outbox), 0)
+        
+        self.assertTrue(UserService.request_password_reset('reset@test.com'))
+        self.assertEqual(mail.outbox[0].to, [user.email])
+        token = mail.outbox[0].body.split('/reset-password/')[1].split('/')[0]
+        self.assertEqual(cache.get(password_reset_cache_key(token)), user.id)
+        self.assertIsNone(cache.get('pw_reset:' + token))
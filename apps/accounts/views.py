@@ -1,23 +1,31 @@
 """
 Эндпоинты аутентификации, пользователей, ролей и сброса пароля.
 """
+import logging
 from rest_framework import status, generics, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from .models import Role
 from .serializers import (
     UserRegistrationSerializer,
     UserSerializer,
     UserListSerializer,
-    RoleSerializer
+    RoleSerializer,
+    get_cached_roles
 )
-from .services import UserService
-from .email_service import send_registration_confirmation
+from .services import UserService, password_reset_cache_key
+from .email_service import send_registration_confirmation, send_in_background
 from ..common.permissions import IsAdmin, IsOwnerOrAdmin
+from ..orders.serializers import OrderListSerializer
+from ..orders.services import OrderService
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+ME_CACHE_TIMEOUT = 300
 
 
 @api_view(['POST'])
@@ -39,14 +47,14 @@ def register_view(request):
                 role_name=serializer.validated_data.get('role_name', 'Buyer')
             )
             
-            send_registration_confirmation(user.email, user.username)
+            send_in_background(send_registration_confirmation, user.email, user.username)
             refresh = RefreshToken.for_user(user)
             
             return Response({
                 'user_id': user.id,
                 'username': user.username,
                 'email': user.email,
-                'role': user.role.name,
+                'role': user.role_name,
                 'tokens': {
                     'refresh': str(refresh),
                     'access': str(refresh.access_token),
@@ -94,8 +102,6 @@ def login_view(request):
                     }
                 }, status=status.HTTP_200_OK)
             except Exception as e:
-                import logging
-                logger = logging.getLogger(__name__)
                 logger.error(f'Ошибка при генерации токенов: {e}')
                 return Response(
                     {'error': 'Ошибка при создании токенов доступа'},
@@ -107,8 +113,6 @@ def login_view(request):
             status=status.HTTP_401_UNAUTHORIZED
         )
     except Exception as e:
-        import logging
-        logger = logging.getLogger(__name__)
         logger.error(f'Ошибка при входе: {e}')
         return Response(
             {'error': 'Внутренняя ошибка сервера'},
@@ -142,16 +146,33 @@ def me_view(request):
     Получение информации о текущем пользователе
     
     GET /api/v1/auth/me/
+    Ответ кэшируется по updated_at пользователя и роли: save() сдвигает updated_at
+    через auto_now, raw UPDATE users (настройки, сохранённые карты, last_login,
+    пароль) — через USER_TOUCH_SQL, поэтому устаревший ключ просто перестаёт
+    запрашиваться.
     """
-    serializer = UserSerializer(request.user)
-    return Response(serializer.data)
+    user = request.user
+    role_updated_at = user.role.updated_at.isoformat() if user.role_id else ''
+    cache_key = f'me:{user.id}:{user.updated_at.isoformat()}:{role_updated_at}'
+    data = cache.get(cache_key)
+    if data is None:
+        data = dict(UserSerializer(user).data)
+        cache.set(cache_key, data, ME_CACHE_TIMEOUT)
+    return Response(data)
 
 
 class RoleListAPIView(generics.ListAPIView):
-    """Список ролей"""
+    """Список ролей (отдаётся из кэша, роли почти не меняются)"""
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
     permission_classes = [permissions.IsAuthenticated]
+    
+    def list(self, request, *args, **kwargs):
+        data = get_cached_roles()
+        page = self.paginate_queryset(data)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(data)
 
 
 class RoleDetailAPIView(generics.RetrieveAPIView):
@@ -163,7 +184,9 @@ class RoleDetailAPIView(generics.RetrieveAPIView):
 
 class UserListAPIView(generics.ListAPIView):
     """Список пользователей (только для администраторов)"""
-    queryset = User.objects.select_related('role').all()
+    queryset = User.objects.only(
+        'id', 'username', 'email', 'role_name', 'is_active', 'created_at'
+    )
     serializer_class = UserListSerializer
     permission_classes = [IsAdmin]
     filterset_fields = ['role', 'is_active']
@@ -185,16 +208,16 @@ class UserDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
 
 
 class UserOrdersAPIView(generics.ListAPIView):
-    """Заказы пользователя"""
+    """Заказы пользователя (позиции и товары подгружаются prefetch-запросами)"""
+    serializer_class = OrderListSerializer
     permission_classes = [IsAdmin | IsOwnerOrAdmin]
     
     def get_queryset(self):
         user_id = self.kwargs['pk']
-        if not self.request.user.role.name == 'Admin' and self.request.user.id != user_id:
+        if not self.request.user.is_staff and self.request.user.id != user_id:
             from rest_framework.exceptions import PermissionDenied
             raise PermissionDenied()
-        from django.db import models
-        return models.QuerySet.none()
+        return OrderService.get_user_orders(user_id)
 
 
 @api_view(['GET', 'PUT'])
@@ -218,22 +241,14 @@ def user_settings_view(request):
             'theme', 'date_format', 'number_format', 'page_size',
             'catalog_filters', 'analytics_filters', 'saved_filters'
         ]
-        current_settings = user.get_settings()
-        for key in allowed_keys:
-            if key in new_settings:
-                current_settings[key] = new_settings[key]
-        user.settings = current_settings
-        user.save(update_fields=['settings'])
+        updates = {key: new_settings[key] for key in allowed_keys if key in new_settings}
+        if updates:
+            user.update_settings(updates)
         
-        return Response(current_settings, status=status.HTTP_200_OK)
-
+        return Response(user.get_settings(), status=status.HTTP_200_OK)
 
-import secrets
-from django.core.cache import cache
-from .email_service import send_password_reset_email
 
-PASSWORD_RESET_CACHE_PREFIX = 'pw_reset:'
-PASSWORD_RESET_TIMEOUT = 86400
+PASSWORD_RESET_MESSAGE = 'Если аккаунт с таким email существует, на него отправлена ссылка для сброса пароля.'
 
 
 @api_view(['POST'])
@@ -244,6 +259,10 @@ def password_reset_request(request):
     
     POST /api/v1/auth/password-reset/
     Body: { "email": "user@example.com" }
+    
+    Поиск аккаунта, выпуск токена и отправка письма выполняются в фоне:
+    время ответа одинаково для существующих и несуществующих email
+    и не позволяет перебором определить зарегистрированные адреса.
     """
     email = (request.data.get('email') or '').strip().lower()
     if not email:
@@ -252,22 +271,9 @@ def password_reset_request(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    try:
-        user = User.objects.get(email__iexact=email, is_active=True)
-    except User.DoesNotExist:
-        return Response(
-            {'message': 'Если аккаунт с таким email существует, на него отправлена ссылка для сброса пароля.'},
-            status=status.HTTP_200_OK
-        )
+    send_in_background(UserService.request_password_reset, email)
     
-    token = secrets.token_urlsafe(32)
-    cache.set(PASSWORD_RESET_CACHE_PREFIX + token, user.id, timeout=PASSWORD_RESET_TIMEOUT)
-    send_password_reset_email(user.email, user.username, token)
-    
-    return Response(
-        {'message': 'Если аккаунт с таким email существует, на него отправлена ссылка для сброса пароля.'},
-        status=status.HTTP_200_OK
-    )
+    return Response({'message': PASSWORD_RESET_MESSAGE}, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
@@ -290,7 +296,7 @@ def password_reset_confirm(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    cache_key = PASSWORD_RESET_CACHE_PREFIX + token
+    cache_key = password_reset_cache_key(token)
     user_id = cache.get(cache_key)
     if not user_id:
         return Response(
@@ -298,16 +304,12 @@ def password_reset_confirm(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    try:
-        user = User.objects.get(id=user_id, is_active=True)
-    except User.DoesNotExist:
-        cache.delete(cache_key)
+    updated = UserService.update_password(user_id, new_password, active_only=True)
+    cache.delete(cache_key)
+    if not updated:
         return Response(
             {'error': 'Пользователь не найден.'},
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    UserService.update_password(user.id, new_password)
-    cache.delete(cache_key)
-    
     return Response({'message': 'Пароль успешно изменён. Теперь вы можете войти с новым паролем.'}, status=status.HTTP_200_OK)
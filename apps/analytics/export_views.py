@@ -1,12 +1,11 @@
 """
 Экспорт отчётов аналитики в CSV.
 """
-import csv
 from django.http import HttpResponse
 from rest_framework.decorators import api_view, permission_classes
-from django.utils.dateparse import parse_date
 from .services import AnalyticsService
 from ..common.permissions import IsAnalyst
+from ..common.utils import cached_csv_response, parse_date_param
 
 
 @api_view(['GET'])
@@ -22,31 +21,27 @@ def export_sales_by_product_csv(request):
     date_to = request.query_params.get('date_to')
     
     if date_from:
-        date_from = parse_date(date_from)
+        date_from = parse_date_param(date_from)
     if date_to:
-        date_to = parse_date(date_to)
+        date_to = parse_date_param(date_to)
     
-    results = AnalyticsService.get_sales_by_product(
+    results = AnalyticsService.iter_sales_by_product(
         category_id=int(category_id) if category_id else None,
         date_from=date_from,
         date_to=date_to
     )
     
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="sales_by_product_export.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['ID товара', 'Название товара', 'Количество продаж', 'Общая сумма'])
-    
-    for item in results:
-        writer.writerow([
-            item.get('product_id', ''),
-            item.get('product_name', ''),
-            item.get('total_quantity_sold', 0),
-            str(item.get('total_revenue', 0)),
-        ])
-    
-    return response
+    rows = (
+        (product_id, product_name, quantity, str(revenue))
+        for product_id, product_name, quantity, revenue in results
+    )
+    return cached_csv_response(
+        request,
+        f'analytics_sales_by_product:{AnalyticsService.cache_version()}',
+        ['ID товара', 'Название товара', 'Количество продаж', 'Общая сумма'],
+        rows,
+        'sales_by_product_export.csv',
+    )
 
 
 @api_view(['GET'])
@@ -59,22 +54,19 @@ def export_monthly_sales_csv(request):
     """
     year = request.query_params.get('year')
     
-    results = AnalyticsService.get_monthly_sales(year=int(year) if year else None)
+    results = AnalyticsService.iter_monthly_sales(year=int(year) if year else None)
     
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="monthly_sales_export.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['Месяц', 'Количество заказов', 'Общая сумма'])
-    
-    for item in results:
-        writer.writerow([
-            item.get('month_start', ''),
-            item.get('orders_count', 0),
-            str(item.get('total_revenue', 0)),
-        ])
-    
-    return response
+    rows = (
+        (month_start, orders_count, str(revenue))
+        for month_start, revenue, orders_count in results
+    )
+    return cached_csv_response(
+        request,
+        f'analytics_monthly_sales:{AnalyticsService.cache_version()}',
+        ['Месяц', 'Количество заказов', 'Общая сумма'],
+        rows,
+        'monthly_sales_export.csv',
+    )
 
 
 @api_view(['GET'])
@@ -91,24 +83,22 @@ def export_revenue_csv(request):
     if not date_from or not date_to:
         return HttpResponse('Необходимо указать date_from и date_to', status=400)
     
-    date_from = parse_date(date_from)
-    date_to = parse_date(date_to)
-    
-    results = AnalyticsService.get_revenue_between(date_from, date_to)
-    
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="revenue_export.csv"'
+    date_from = parse_date_param(date_from)
+    date_to = parse_date_param(date_to)
     
-    writer = csv.writer(response)
-    writer.writerow(['Месяц', 'Выручка'])
+    if not date_from or not date_to:
+        return HttpResponse('Неверный формат даты. Используйте YYYY-MM-DD', status=400)
     
-    for item in results:
-        writer.writerow([
-            item.get('month_date', ''),
-            str(item.get('revenue', 0)),
-        ])
+    results = AnalyticsService.iter_revenue_between(date_from, date_to)
     
-    return response
+    rows = ((month_date, str(revenue)) for month_date, revenue in results)
+    return cached_csv_response(
+        request,
+        f'analytics_revenue:{AnalyticsService.cache_version()}',
+        ['Месяц', 'Выручка'],
+        rows,
+        'revenue_export.csv',
+    )
 
 
 @api_view(['GET'])
@@ -121,19 +111,12 @@ def export_top_products_csv(request):
     """
     limit = request.query_params.get('limit', 10)
     
-    results = AnalyticsService.get_top_products(limit=int(limit) if limit else 10)
+    results = AnalyticsService.iter_top_products(limit=int(limit) if limit else 10)
     
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="top_products_export.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['ID товара', 'Название товара', 'Количество продаж'])
-    
-    for item in results:
-        writer.writerow([
-            item.get('product_id', ''),
-            item.get('product_name', ''),
-            item.get('qty_sold', 0),
-        ])
-    
-    return response
+    return cached_csv_response(
+        request,
+        f'analytics_top_products:{AnalyticsService.cache_version()}',
+        ['ID товара', 'Название товара', 'Количество продаж'],
+        results,
+        'top_products_export.csv',
+    )
@@ -1,8 +1,12 @@
 """
 Сервис аналитики: запросы к БД, представлениям и функциям, кэширование.
 """
+import hashlib
+import weakref
+from collections import namedtuple
 from django.db import connection
 from django.core.cache import cache
+from ..common.utils import bump_cache_version, get_cache_version
 from .serializers import (
     SalesByProductSerializer,
     MonthlySalesSerializer,
@@ -11,9 +15,150 @@ from .serializers import (
 )
 
 
+# Строки отчётов — именованные кортежи: дешевле словарей при создании и в памяти кэша,
+# сериализаторы DRF читают поля как атрибуты
+MonthlySalesRow = namedtuple('MonthlySalesRow', ['month_start', 'total_revenue', 'orders_count'])
+TopProductRow = namedtuple('TopProductRow', ['product_id', 'product_name', 'qty_sold'])
+RevenueRow = namedtuple('RevenueRow', ['month_date', 'revenue'])
+
+# Продажи по продуктам: один текст запроса на оба пути — кэшируемый отчёт
+# (prepared statement) и потоковую выгрузку (серверный курсор, на котором EXECUTE
+# недоступен). Параметр со значением None отключает свой фильтр, любое другое
+# значение, включая category_id = 0, применяется. Имя запроса:
+# (параметры с типами в порядке PREPARE, текст с именованными плейсхолдерами)
+SALES_BY_PRODUCT_QUERIES = {
+    'sbp_dated': (
+        (('category_id', 'integer'), ('date_from', 'date'), ('date_to', 'date')),
+        """
+        SELECT
+            p.id AS product_id,
+            p.name AS product_name,
+            SUM(oi.quantity)::integer AS total_quantity_sold,
+            SUM(oi.quantity * oi.price_at_purchase) AS total_revenue
+        FROM order_items oi
+        JOIN orders o ON o.id = oi.order_id
+        JOIN products p ON p.id = oi.product_id
+        WHERE o.status = 'Completed'
+          AND (%(category_id)s::integer IS NULL OR p.category_id = %(category_id)s::integer)
+          AND (%(date_from)s::date IS NULL OR o.order_date::date >= %(date_from)s::date)
+          AND (%(date_to)s::date IS NULL OR o.order_date::date <= %(date_to)s::date)
+        GROUP BY p.id, p.name
+        ORDER BY total_revenue DESC
+        """,
+    ),
+    'sbp_plain': (
+        (('category_id', 'integer'),),
+        """
+        SELECT
+            product_id,
+            product_name,
+            total_quantity_sold,
+            total_revenue
+        FROM v_sales_by_product
+        WHERE %(category_id)s::integer IS NULL
+           OR product_id IN (SELECT id FROM products WHERE category_id = %(category_id)s::integer)
+        ORDER BY total_revenue DESC
+        """,
+    ),
+}
+
+
+def _as_prepared(params, query):
+    """(типы аргументов для PREPARE, текст с $1..$n вместо именованных плейсхолдеров)"""
+    for position, (name, _) in enumerate(params, start=1):
+        query = query.replace(f'%({name})s', f'${position}')
+    return f"({', '.join(arg_type for _, arg_type in params)})", query
+
+
+# Серверные prepared statements для запросов фиксированной формы
+PREPARED_STATEMENTS = {
+    name: _as_prepared(params, query) for name, (params, query) in SALES_BY_PRODUCT_QUERIES.items()
+}
+
+# Какие statements уже подготовлены на каждом физическом соединении psycopg2
+# (после переподключения соединение новое — statements готовятся заново)
+_prepared_on_connection = weakref.WeakKeyDictionary()
+
+
 class AnalyticsService:
     CACHE_TIMEOUT = 900
+    EXPORT_ITERSIZE = 2000
+    DASHBOARD_TOP_PRODUCTS = 5
+    VERSION_KEY = 'analytics:ver'
     
+    @staticmethod
+    def _cache_key(prefix, *params):
+        """
+        Ключ кэша фиксированной длины: префикс + blake2b (16 байт) от параметров отчёта,
+        чтобы даты и фильтры не раздували ключ (лимит memcached — 250 байт)
+        """
+        digest = hashlib.blake2b(repr(params).encode(), digest_size=16).hexdigest()
+        return f'{prefix}:{digest}'
+
+    @staticmethod
+    def cache_version():
+        """
+        Текущая версия кэша отчётов. Входит во все ключи аналитики:
+        invalidate_cache сбрасывает любые комбинации фильтров одним incr,
+        старые записи становятся недостижимы и истекают по TTL.
+        """
+        return get_cache_version(AnalyticsService.VERSION_KEY)
+
+    @staticmethod
+    def _report_key(prefix, *params):
+        """Ключ кэша отчёта с учётом текущей версии"""
+        return AnalyticsService._cache_key(f'{prefix}:{AnalyticsService.cache_version()}', *params)
+
+    @staticmethod
+    def _execute_prepared(cursor, name, params):
+        """
+        Выполнить prepared statement из PREPARED_STATEMENTS.
+        PREPARE выполняется один раз на соединение при первом обращении,
+        дальше PostgreSQL не разбирает и не планирует текст запроса заново.
+        """
+        prepared = _prepared_on_connection.setdefault(connection.connection, set())
+        if name not in prepared:
+            arg_types, query = PREPARED_STATEMENTS[name]
+            cursor.execute(f'PREPARE {name}{arg_types} AS {query}')
+            prepared.add(name)
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f'EXECUTE {name}({placeholders})', params)
+
+    @staticmethod
+    def _sales_by_product_query(category_id=None, date_from=None, date_to=None):
+        """
+        Выбрать запрос продаж по продуктам из SALES_BY_PRODUCT_QUERIES:
+        при указании дат — агрегат за период из order_items/orders, иначе — v_sales_by_product.
+        Колонки: product_id, product_name, total_quantity_sold, total_revenue.
+        
+        Returns:
+            tuple: (имя запроса, словарь значений его параметров)
+        """
+        if date_from is not None or date_to is not None:
+            return 'sbp_dated', {'category_id': category_id, 'date_from': date_from, 'date_to': date_to}
+        return 'sbp_plain', {'category_id': category_id}
+
+    @staticmethod
+    def _iter_rows(query, params=None):
+        """
+        Построчно читать результат запроса через серверный (именованный) курсор.
+        Строки приходят кортежами пачками по EXPORT_ITERSIZE, весь результат
+        в памяти не собирается. Используется для экспорта, без кэширования.
+        """
+        with connection.chunked_cursor() as cursor:
+            cursor.cursor.itersize = AnalyticsService.EXPORT_ITERSIZE
+            cursor.execute(query, params or [])
+            yield from cursor
+
+    @staticmethod
+    def iter_sales_by_product(category_id=None, date_from=None, date_to=None):
+        """
+        Итератор кортежей (product_id, product_name, total_quantity_sold, total_revenue)
+        для экспорта продаж по продуктам
+        """
+        name, values = AnalyticsService._sales_by_product_query(category_id, date_from, date_to)
+        yield from AnalyticsService._iter_rows(SALES_BY_PRODUCT_QUERIES[name][1], values)
+
     @staticmethod
     def get_sales_by_product(category_id=None, date_from=None, date_to=None):
         """
@@ -21,66 +166,22 @@ class AnalyticsService:
         При указании дат — агрегат за период из order_items/orders; иначе — из представления v_sales_by_product.
         
         Args:
-            category_id: фильтр по категории (опционально)
+            category_id: фильтр по категории (None — без фильтра; 0 — тоже фильтр)
             date_from: начало периода (опционально)
             date_to: конец периода (опционально)
         
         Returns:
             list: список словарей с данными о продажах
         """
-        cache_key = f'sales_by_product_{category_id}_{date_from}_{date_to}'
+        cache_key = AnalyticsService._report_key('sbp', category_id, date_from, date_to)
         cached = cache.get(cache_key)
         if cached is not None:
             return cached
 
-        use_date_filter = date_from or date_to
-
-        if use_date_filter:
-            query = """
-                SELECT
-                    p.id AS product_id,
-                    p.name AS product_name,
-                    SUM(oi.quantity)::integer AS total_quantity_sold,
-                    SUM(oi.quantity * oi.price_at_purchase) AS total_revenue
-                FROM order_items oi
-                JOIN orders o ON o.id = oi.order_id
-                JOIN products p ON p.id = oi.product_id
-                WHERE o.status = 'Completed'
-            """
-            params = []
-            date_conditions = []
-            if date_from:
-                date_conditions.append("o.order_date::date >= %s")
-                params.append(date_from)
-            if date_to:
-                date_conditions.append("o.order_date::date <= %s")
-                params.append(date_to)
-            if date_conditions:
-                query += " AND " + " AND ".join(date_conditions)
-            if category_id:
-                query += " AND p.category_id = %s"
-                params.append(category_id)
-            query += " GROUP BY p.id, p.name ORDER BY total_revenue DESC"
-        else:
-            query = """
-                SELECT
-                    product_id,
-                    product_name,
-                    total_quantity_sold,
-                    total_revenue
-                FROM v_sales_by_product
-            """
-            params = []
-            conditions = []
-            if category_id:
-                conditions.append("product_id IN (SELECT id FROM products WHERE category_id = %s)")
-                params.append(category_id)
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
-            query += " ORDER BY total_revenue DESC"
-
+        name, values = AnalyticsService._sales_by_product_query(category_id, date_from, date_to)
+        params, _ = SALES_BY_PRODUCT_QUERIES[name]
         with connection.cursor() as cursor:
-            cursor.execute(query, params)
+            AnalyticsService._execute_prepared(cursor, name, [values[param] for param, _ in params])
             columns = [col[0] for col in cursor.description]
             results = [dict(zip(columns, row)) for row in cursor.fetchall()]
 
@@ -88,21 +189,11 @@ class AnalyticsService:
         return results
     
     @staticmethod
-    def get_monthly_sales(year=None):
+    def _monthly_sales_query(year=None):
         """
-        Получить ежемесячные продажи из представления v_monthly_sales
-        
-        Args:
-            year: фильтр по году (опционально)
-        
-        Returns:
-            list: список словарей с данными о продажах
+        Построить SQL и параметры для ежемесячных продаж.
+        Колонки: month_start, total_revenue, orders_count.
         """
-        cache_key = f'monthly_sales_{year}'
-        cached = cache.get(cache_key)
-        if cached is not None:
-            return cached
-        
         query = """
             SELECT 
                 month_start,
@@ -111,23 +202,56 @@ class AnalyticsService:
             FROM shop.v_monthly_sales
         """
         params = []
-        
+
         if year:
             query += " WHERE EXTRACT(YEAR FROM month_start) = %s"
             params.append(year)
-        
+
         query += " ORDER BY month_start DESC"
+        return query, params
+
+    @staticmethod
+    def iter_monthly_sales(year=None):
+        """
+        Итератор кортежей (month_start, total_revenue, orders_count)
+        для экспорта ежемесячных продаж
+        """
+        query, params = AnalyticsService._monthly_sales_query(year)
+        yield from AnalyticsService._iter_rows(query, params)
+
+    @staticmethod
+    def get_monthly_sales(year=None):
+        """
+        Получить ежемесячные продажи из представления v_monthly_sales
+        
+        Args:
+            year: фильтр по году (опционально)
+        
+        Returns:
+            list: список MonthlySalesRow
+        """
+        cache_key = AnalyticsService._report_key('monthly_sales', year)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        query, params = AnalyticsService._monthly_sales_query(year)
         
         with connection.cursor() as cursor:
             cursor.execute(query, params)
-            columns = [col[0] for col in cursor.description]
-            results = []
-            for row in cursor.fetchall():
-                results.append(dict(zip(columns, row)))
+            results = [MonthlySalesRow._make(row) for row in cursor.fetchall()]
         
         cache.set(cache_key, results, AnalyticsService.CACHE_TIMEOUT)
         return results
     
+    @staticmethod
+    def iter_top_products(limit=10):
+        """
+        Итератор кортежей (product_id, product_name, qty_sold)
+        из функции fn_top_products для экспорта
+        """
+        yield from AnalyticsService._iter_rows("SELECT * FROM fn_top_products(%s)", [limit])
+
     @staticmethod
     def get_top_products(limit=10):
         """
@@ -137,26 +261,30 @@ class AnalyticsService:
             limit: количество товаров (по умолчанию 10)
         
         Returns:
-            list: список словарей с данными о товарах
+            list: список TopProductRow
         """
-        cache_key = f'top_products_{limit}'
+        cache_key = AnalyticsService._report_key('top_products', limit)
         cached = cache.get(cache_key)
         if cached is not None:
             return cached
         
         with connection.cursor() as cursor:
             cursor.callproc('fn_top_products', [limit])
-            results = []
-            for row in cursor.fetchall():
-                results.append({
-                    'product_id': row[0],
-                    'product_name': row[1],
-                    'qty_sold': row[2]
-                })
+            results = [TopProductRow._make(row) for row in cursor.fetchall()]
         
         cache.set(cache_key, results, AnalyticsService.CACHE_TIMEOUT)
         return results
     
+    @staticmethod
+    def iter_revenue_between(date_from, date_to):
+        """
+        Итератор кортежей (month_date, revenue)
+        из функции fn_revenue_between для экспорта
+        """
+        yield from AnalyticsService._iter_rows(
+            "SELECT * FROM fn_revenue_between(%s, %s)", [date_from, date_to]
+        )
+
     @staticmethod
     def get_revenue_between(date_from, date_to):
         """
@@ -167,17 +295,18 @@ class AnalyticsService:
             date_to: конец периода
         
         Returns:
-            list: список словарей с данными о выручке
+            list: список RevenueRow
         """
+        cache_key = AnalyticsService._report_key('revenue', date_from, date_to)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         with connection.cursor() as cursor:
             cursor.callproc('fn_revenue_between', [date_from, date_to])
-            results = []
-            for row in cursor.fetchall():
-                results.append({
-                    'month_date': row[0],
-                    'revenue': row[1]
-                })
+            results = [RevenueRow._make(row) for row in cursor.fetchall()]
         
+        cache.set(cache_key, results, AnalyticsService.CACHE_TIMEOUT)
         return results
     
     @staticmethod
@@ -186,33 +315,34 @@ class AnalyticsService:
         Получить общую статистику для дашборда.
         Считаем по таблице orders (только статус 'Completed'), как в представлениях аналитики.
         """
-        cache_key = 'dashboard_stats'
+        cache_key = AnalyticsService._report_key('dashboard_stats')
         cached = cache.get(cache_key)
         if cached is not None:
             return cached
 
+        # Выручка, число заказов, пользователей и топ товаров — одним запросом (один round trip):
+        # топ собирается в JSON на стороне БД в порядке, который вернула fn_top_products;
+        # агрегат без GROUP BY возвращает строку и при отсутствии выполненных заказов
         with connection.cursor() as cursor:
             cursor.execute("""
-                SELECT COALESCE(SUM(total_amount), 0)
-                FROM orders
-                WHERE status = 'Completed'
-            """)
-            total_revenue = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT COUNT(*)
+                SELECT
+                    COALESCE(SUM(total_amount), 0),
+                    COUNT(*),
+                    (SELECT COUNT(*) FROM users),
+                    (
+                        SELECT json_agg(json_build_object(
+                            'product_id', t.product_id,
+                            'product_name', t.product_name,
+                            'qty_sold', t.qty_sold
+                        ) ORDER BY t.n)
+                        FROM fn_top_products(%s) WITH ORDINALITY AS t(product_id, product_name, qty_sold, n)
+                    )
                 FROM orders
                 WHERE status = 'Completed'
-            """)
-            total_orders = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT COUNT(*)
-                FROM users
-            """)
-            active_users = cursor.fetchone()[0]
+            """, [AnalyticsService.DASHBOARD_TOP_PRODUCTS])
+            total_revenue, total_orders, active_users, top_products = cursor.fetchone()
 
-        top_products = AnalyticsService.get_top_products(limit=5)
+        top_products = [TopProductRow(**item) for item in top_products or []]
 
         stats = {
             'total_revenue': total_revenue,
@@ -226,15 +356,9 @@ class AnalyticsService:
     
     @staticmethod
     def invalidate_cache():
-        cache_keys = [
-            'dashboard_stats',
-            'sales_by_product_*',
-            'monthly_sales_*',
-            'top_products_*',
-        ]
-        for limit in [5, 10, 20, 50]:
-            cache.delete(f'top_products_{limit}')
-        for year in range(2020, 2030):
-            cache.delete(f'monthly_sales_{year}')
-        cache.delete('dashboard_stats')
-
+        """
+        Сброс кэша аналитики после изменения заказов.
+        Одно обращение к кэшу: увеличение версии делает недостижимыми все отчёты,
+        включая произвольные лимиты, периоды и CSV-выгрузки
+        """
+        bump_cache_version(AnalyticsService.VERSION_KEY)
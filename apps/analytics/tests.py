@@ -1,7 +1,11 @@
 """
 Тесты API аналитики и сервиса отчётов.
 """
+import functools
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
@@ -11,167 +15,207 @@ from datetime import timedelta
 from apps.catalog.models import Category, Product
 from apps.accounts.models import Role
 from apps.orders.models import Order, OrderItem
+from .serializers import TopProductsSerializer
 from .services import AnalyticsService
 
 User = get_user_model()
 
 
+def requires_db_objects(*names):
+    """
+    Пропустить тест, если в БД нет нужных представлений или функций отчётов:
+    они создаются SQL-скриптами базы магазина, а не моделями Django,
+    поэтому в пустой тестовой БД их может не быть
+    """
+    def decorator(test_method):
+        @functools.wraps(test_method)
+        def wrapper(self, *args, **kwargs):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT name FROM unnest(%s::text[]) AS name "
+                    "WHERE to_regclass(name) IS NULL "
+                    "AND NOT EXISTS (SELECT 1 FROM pg_proc WHERE proname = name)",
+                    [list(names)]
+                )
+                missing = [row[0] for row in cursor.fetchall()]
+            if missing:
+                self.skipTest(f'В БД нет объектов отчётов: {", ".join(missing)}')
+            return test_method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class AnalyticsAPITestCase(TestCase):
     """Тесты для API аналитики"""
+    fixtures = ['roles.json']
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.client = APIClient()
-        
-        self.analyst_role, _ = Role.objects.get_or_create(name='Analyst')
-        self.admin_role, _ = Role.objects.get_or_create(name='Admin')
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.analyst_role = Role.objects.get(name='Analyst')
+        cls.admin_role = Role.objects.get(name='Admin')
+        cls.buyer_role = Role.objects.get(name='Buyer')
         
-        self.analyst = User.objects.create_user(
+        cls.analyst = User.objects.create_user(
             username='analyst',
             email='analyst@test.com',
             password='testpass123',
-            role=self.analyst_role
+            role=cls.analyst_role
         )
-        self.buyer = User.objects.create_user(
+        cls.buyer = User.objects.create_user(
             username='buyer',
             email='buyer@test.com',
             password='testpass123',
-            role=self.buyer_role
+            role=cls.buyer_role
         )
         
-        self.category = Category.objects.create(
+        cls.category = Category.objects.create(
             name='Категория',
             slug='category'
         )
-        self.product = Product.objects.create(
+        cls.product = Product.objects.create(
             name='Товар',
             sku='PROD-001',
             price=1000.00,
             stock_quantity=10,
-            category=self.category,
+            category=cls.category,
             is_available=True
         )
-        self.order = Order.objects.create(
-            user=self.buyer,
+        cls.order = Order.objects.create(
+            user=cls.buyer,
             total_amount=1000.00,
             status='Completed',
             order_date=timezone.now()
         )
         OrderItem.objects.create(
-            order=self.order,
-            product=self.product,
+            order=cls.order,
+            product=cls.product,
             quantity=1,
-            price=1000.00
+            price_at_purchase=1000.00
         )
+        # Подпись JWT — один раз на класс, а не в каждом тесте
+        cls.analyst_token = str(RefreshToken.for_user(cls.analyst).access_token)
+        cls.buyer_token = str(RefreshToken.for_user(cls.buyer).access_token)
+        # Клиенты с готовыми заголовками; каждый тест получает свою копию
+        # (атрибуты из setUpTestData копируются для теста через deepcopy)
+        cls.analyst_client = APIClient()
+        cls.analyst_client.credentials(HTTP_AUTHORIZATION=f'Bearer {cls.analyst_token}')
+        cls.buyer_client = APIClient()
+        cls.buyer_client.credentials(HTTP_AUTHORIZATION=f'Bearer {cls.buyer_token}')
     
-    def get_analyst_token(self):
-        """Получить токен аналитика"""
-        refresh = RefreshToken.for_user(self.analyst)
-        return str(refresh.access_token)
-    
-    def get_buyer_token(self):
-        """Получить токен покупателя"""
-        refresh = RefreshToken.for_user(self.buyer)
-        return str(refresh.access_token)
-    
+    @requires_db_objects('fn_top_products')
     def test_dashboard_stats_analyst(self):
         """Тест получения статистики дашборда аналитиком"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/dashboard/')
+        response = self.analyst_client.get('/api/v1/analytics/dashboard/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('total_revenue', response.data)
         self.assertIn('total_orders', response.data)
     
     def test_dashboard_stats_buyer_forbidden(self):
         """Тест запрета доступа к аналитике покупателем"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
-        response = self.client.get('/api/v1/analytics/dashboard/')
+        response = self.buyer_client.get('/api/v1/analytics/dashboard/')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
     
+    @requires_db_objects('v_sales_by_product')
     def test_sales_by_product(self):
         """Тест получения продаж по продуктам"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/sales-by-product/')
+        response = self.analyst_client.get('/api/v1/analytics/sales-by-product/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.data, list)
     
+    def test_sales_by_product_invalid_params(self):
+        """Некорректные даты и категория отклоняются с 400, а не игнорируются"""
+        for query in ('date_from=2024-13-01', 'date_to=2024-02-30', 'category=abc'):
+            response = self.analyst_client.get(f'/api/v1/analytics/sales-by-product/?{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+    
+    @requires_db_objects('v_monthly_sales')
     def test_monthly_sales(self):
         """Тест получения ежемесячных продаж"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/monthly-sales/')
+        response = self.analyst_client.get('/api/v1/analytics/monthly-sales/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.data, list)
     
+    @requires_db_objects('fn_top_products')
     def test_top_products(self):
         """Тест получения топ товаров"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/top-products/?limit=10')
+        response = self.analyst_client.get('/api/v1/analytics/top-products/?limit=10')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.data, list)
     
+    def test_top_products_invalid_limit(self):
+        """Нечисловой и выходящий за диапазон limit отклоняются"""
+        for limit in ('abc', '-5', '0', '101', '１０'):
+            response = self.analyst_client.get(f'/api/v1/analytics/top-products/?limit={limit}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, limit)
+    
+    @requires_db_objects('fn_revenue_between')
     def test_revenue(self):
         """Тест получения выручки"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
         date_from = (timezone.now() - timedelta(days=30)).date().isoformat()
         date_to = timezone.now().date().isoformat()
-        response = self.client.get(f'/api/v1/analytics/revenue/?date_from={date_from}&date_to={date_to}')
+        response = self.analyst_client.get(f'/api/v1/analytics/revenue/?date_from={date_from}&date_to={date_to}')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIsInstance(response.data, list)
     
     def test_export_sales_by_product_csv(self):
         """Тест экспорта продаж по продуктам в CSV"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/sales-by-product/export/csv/')
+        response = self.analyst_client.get('/api/v1/analytics/sales-by-product/export/csv/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
     
     def test_export_top_products_csv(self):
         """Тест экспорта топ товаров в CSV"""
-        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_analyst_token()}')
-        response = self.client.get('/api/v1/analytics/top-products/export/csv/')
+        response = self.analyst_client.get('/api/v1/analytics/top-products/export/csv/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
 
 
 class AnalyticsServiceTestCase(TestCase):
     """Тесты для сервиса аналитики"""
+    fixtures = ['roles.json']
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.category = Category.objects.create(
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.category = Category.objects.create(
             name='Категория',
             slug='category'
         )
-        self.product = Product.objects.create(
+        cls.product = Product.objects.create(
             name='Товар',
             sku='PROD-001',
             price=1000.00,
             stock_quantity=10,
-            category=self.category,
+            category=cls.category,
             is_available=True
         )
         
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
-        self.buyer = User.objects.create_user(
+        cls.buyer_role = Role.objects.get(name='Buyer')
+        cls.buyer = User.objects.create_user(
             username='buyer',
             email='buyer@test.com',
             password='testpass123',
-            role=self.buyer_role
+            role=cls.buyer_role
         )
         order = Order.objects.create(
-            user=self.buyer,
+            user=cls.buyer,
             total_amount=1000.00,
-            status='Completed',
+            status='Pending',
             order_date=timezone.now()
         )
         OrderItem.objects.create(
             order=order,
-            product=self.product,
+            product=cls.product,
             quantity=1,
-            price=1000.00
+            price_at_purchase=1000.00
         )
+        # Итоговый статус — через update(): Order.save поставил бы сброс кэша в очередь
+        # транзакции класса, которая не фиксируется, и on_commit_once в тестах
+        # считал бы его уже запланированным
+        Order.objects.filter(pk=order.pk).update(status='Completed')
     
+    @requires_db_objects('v_sales_by_product')
     def test_get_sales_by_product(self):
         """Тест получения продаж по продуктам"""
         results = AnalyticsService.get_sales_by_product()
@@ -180,13 +224,120 @@ class AnalyticsServiceTestCase(TestCase):
             self.assertIn('product_id', results[0])
             self.assertIn('total_revenue', results[0])
     
+    @requires_db_objects('v_sales_by_product')
+    def test_iter_sales_by_product_matches_cached_list(self):
+        """Итератор для экспорта отдаёт те же строки, что и кэшируемый список"""
+        rows = list(AnalyticsService.iter_sales_by_product())
+        results = AnalyticsService.get_sales_by_product()
+        self.assertEqual(
+            rows,
+            [
+                (r['product_id'], r['product_name'], r['total_quantity_sold'], r['total_revenue'])
+                for r in results
+            ]
+        )
+    
+    @requires_db_objects('fn_top_products')
     def test_get_top_products(self):
         """Тест получения топ товаров"""
         results = AnalyticsService.get_top_products(limit=10)
         self.assertIsInstance(results, list)
     
+    @requires_db_objects('v_monthly_sales')
     def test_get_monthly_sales(self):
         """Тест получения ежемесячных продаж"""
         results = AnalyticsService.get_monthly_sales()
         self.assertIsInstance(results, list)
-
+    
+    @requires_db_objects('v_monthly_sales', 'fn_top_products')
+    def test_invalidate_cache_drops_cached_reports(self):
+        """Сброс кэша делает недостижимыми дашборд, ежемесячные продажи и топ с любым лимитом"""
+        AnalyticsService.get_monthly_sales()
+        AnalyticsService.get_dashboard_stats()
+        AnalyticsService.get_top_products(limit=7)
+        with self.assertNumQueries(0):
+            AnalyticsService.get_top_products(limit=7)
+        AnalyticsService.invalidate_cache()
+        self.assertIsNone(cache.get(AnalyticsService._report_key('monthly_sales', None)))
+        self.assertIsNone(cache.get(AnalyticsService._report_key('dashboard_stats')))
+        self.assertIsNone(cache.get(AnalyticsService._report_key('top_products', 7)))
+    
+    def test_completed_order_invalidates_reports(self):
+        """Отчёт за период кэшируется и пересчитывается после фиксации завершения заказа"""
+        date_from = (timezone.now() - timedelta(days=30)).date()
+        results = AnalyticsService.get_sales_by_product(date_from=date_from)
+        self.assertEqual([row['total_quantity_sold'] for row in results], [1])
+        with self.assertNumQueries(0):
+            AnalyticsService.get_sales_by_product(date_from=date_from)
+        
+        order = Order.objects.create(user=self.buyer, total_amount=2000.00, status='Pending')
+        OrderItem.objects.create(order=order, product=self.product, quantity=2, price_at_purchase=1000.00)
+        with self.assertNumQueries(0):
+            AnalyticsService.get_sales_by_product(date_from=date_from)
+        order.status = 'Completed'
+        # Версия кэша меняется после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            order.save(update_fields=['status'])
+        self.assertEqual(len(callbacks), 1)
+        with self.assertNumQueries(1):
+            results = AnalyticsService.get_sales_by_product(date_from=date_from)
+        self.assertEqual([row['total_quantity_sold'] for row in results], [3])
+    
+    def test_invalidate_cache_bumps_sales_by_product_version(self):
+        """После сброса кэша продажи по продуктам читаются из БД, а не из старой записи"""
+        date_from = (timezone.now() - timedelta(days=30)).date()
+        AnalyticsService.get_sales_by_product(date_from=date_from)
+        with self.assertNumQueries(0):
+            AnalyticsService.get_sales_by_product(date_from=date_from)
+        AnalyticsService.invalidate_cache()
+        with self.assertNumQueries(1):
+            AnalyticsService.get_sales_by_product(date_from=date_from)
+    
+    def test_sales_by_product_prepared_once_per_connection(self):
+        """Запрос за период готовится один раз на соединение и совпадает с выгрузкой"""
+        date_from = (timezone.now() - timedelta(days=30)).date()
+        with CaptureQueriesContext(connection) as ctx:
+            results = AnalyticsService.get_sales_by_product(date_from=date_from)
+            AnalyticsService.invalidate_cache()
+            AnalyticsService.get_sales_by_product(date_from=date_from)
+        prepares = [q for q in ctx.captured_queries if q['sql'].startswith('PREPARE sbp_dated')]
+        self.assertLessEqual(len(prepares), 1)
+        self.assertEqual(
+            [tuple(row.values()) for row in results],
+            list(AnalyticsService.iter_sales_by_product(date_from=date_from))
+        )
+    
+    def test_sales_by_product_filters_match_export(self):
+        """Отчёт и выгрузка строятся из одного запроса: category_id = 0 — фильтр, None — нет"""
+        date_from = (timezone.now() - timedelta(days=30)).date()
+        for category_id, expected_count in ((None, 1), (self.category.id, 1), (0, 0)):
+            with self.subTest(category_id=category_id):
+                results = AnalyticsService.get_sales_by_product(
+                    category_id=category_id, date_from=date_from
+                )
+                self.assertEqual(len(results), expected_count)
+                self.assertEqual(
+                    [tuple(row.values()) for row in results],
+                    list(AnalyticsService.iter_sales_by_product(
+                        category_id=category_id, date_from=date_from
+                    ))
+                )
+    
+    @requires_db_objects('fn_top_products')
+    def test_top_products_rows_serialize(self):
+        """Строки топа товаров — именованные кортежи, сериализатор читает их по атрибутам"""
+        results = AnalyticsService.get_top_products(limit=5)
+        data = TopProductsSerializer(results, many=True).data
+        self.assertEqual(
+            [(row['product_id'], row['qty_sold']) for row in data],
+            [(row.product_id, row.qty_sold) for row in results]
+        )
+    
+    @requires_db_objects('fn_top_products')
+    def test_dashboard_stats_single_query(self):
+        """Дашборд вместе с топом товаров собирается одним запросом"""
+        AnalyticsService.invalidate_cache()
+        with self.assertNumQueries(1):
+            stats = AnalyticsService.get_dashboard_stats()
+        self.assertEqual(stats['total_orders'], 1)
+        self.assertEqual(stats['top_products'], AnalyticsService.get_top_products(limit=5))
@@ -4,7 +4,6 @@
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from django.utils.dateparse import parse_date
 from .services import AnalyticsService
 from .serializers import (
     SalesByProductSerializer,
@@ -14,6 +13,9 @@ from .serializers import (
     DashboardStatsSerializer
 )
 from ..common.permissions import IsAnalyst
+from ..common.utils import parse_date_param
+
+INVALID_DATE_MESSAGE = 'Неверный формат даты. Используйте YYYY-MM-DD'
 
 
 @api_view(['GET'])
@@ -29,13 +31,19 @@ def sales_by_product_view(request):
         - date_to: конец периода (YYYY-MM-DD, опционально)
     """
     category_id = request.query_params.get('category')
-    date_from = request.query_params.get('date_from')
-    date_to = request.query_params.get('date_to')
+    date_from_param = request.query_params.get('date_from')
+    date_to_param = request.query_params.get('date_to')
     
-    if date_from:
-        date_from = parse_date(date_from)
-    if date_to:
-        date_to = parse_date(date_to)
+    # Некорректные параметры отклоняются до обращения к кэшу и БД
+    if category_id and not (category_id.isascii() and category_id.isdigit()):
+        return Response(
+            {'error': 'category должен быть числом'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    date_from = parse_date_param(date_from_param) if date_from_param else None
+    date_to = parse_date_param(date_to_param) if date_to_param else None
+    if (date_from_param and not date_from) or (date_to_param and not date_to):
+        return Response({'error': INVALID_DATE_MESSAGE}, status=status.HTTP_400_BAD_REQUEST)
     
     results = AnalyticsService.get_sales_by_product(
         category_id=int(category_id) if category_id else None,
@@ -77,20 +85,20 @@ def top_products_view(request):
     Query params:
         - limit: количество товаров (по умолчанию 10)
     """
-    limit = request.query_params.get('limit', 10)
-    
-    try:
-        limit = int(limit)
-        if limit < 1 or limit > 100:
-            return Response(
-                {'error': 'Limit должен быть от 1 до 100'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-    except ValueError:
+    limit = request.query_params.get('limit', '10')
+    
+    # Только ASCII-цифры: мусорные значения отсекаются без исключения из int()
+    if not (limit.isascii() and limit.isdigit()):
         return Response(
             {'error': 'Limit должен быть числом'},
             status=status.HTTP_400_BAD_REQUEST
         )
+    limit = int(limit)
+    if limit < 1 or limit > 100:
+        return Response(
+            {'error': 'Limit должен быть от 1 до 100'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     
     results = AnalyticsService.get_top_products(limit=limit)
     
@@ -118,12 +126,12 @@ def revenue_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    date_from = parse_date(date_from)
-    date_to = parse_date(date_to)
+    date_from = parse_date_param(date_from)
+    date_to = parse_date_param(date_to)
     
     if not date_from or not date_to:
         return Response(
-            {'error': 'Неверный формат даты. Используйте YYYY-MM-DD'},
+            {'error': INVALID_DATE_MESSAGE},
             status=status.HTTP_400_BAD_REQUEST
         )
     
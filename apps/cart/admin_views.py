@@ -6,7 +6,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
 from .models import CartItem
-from .serializers import CartItemSerializer
+from .serializers import CartItemSerializer, cart_rows_to_representation
 from .services import CartService
 from ..common.permissions import IsAdmin
 
@@ -21,23 +21,21 @@ def admin_user_cart_view(request, user_id):
     
     GET /api/v1/admin/cart/users/{user_id}/
     """
+    # Нужны только id и username — пароль, настройки и прочие колонки не читаются
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.only('id', 'username').get(id=user_id)
     except User.DoesNotExist:
         return Response(
             {'error': 'Пользователь не найден'},
             status=status.HTTP_404_NOT_FOUND
         )
     
-    cart_items = CartService.get_cart(user)
-    cart_total = CartService.get_cart_total(user)
-    
-    serializer = CartItemSerializer(cart_items, many=True)
+    rows, cart_total = CartService.get_cart_rows_with_totals(user)
     
     return Response({
         'user_id': user.id,
         'user_username': user.username,
-        'items': serializer.data,
+        'items': cart_rows_to_representation(rows),
         'total_items': cart_total['total_items'],
         'total_price': float(cart_total['total_price'])
     })
@@ -52,7 +50,7 @@ def admin_add_to_user_cart_view(request, user_id):
     POST /api/v1/admin/cart/users/{user_id}/items/
     """
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.only('id').get(id=user_id)
     except User.DoesNotExist:
         return Response(
             {'error': 'Пользователь не найден'},
@@ -95,15 +93,19 @@ def admin_update_user_cart_item_view(request, user_id, item_id):
     PUT/PATCH /api/v1/admin/cart/users/{user_id}/items/{item_id}/
     """
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.only('id').get(id=user_id)
     except User.DoesNotExist:
         return Response(
             {'error': 'Пользователь не найден'},
             status=status.HTTP_404_NOT_FOUND
         )
     
+    # Позиция с товаром и категорией читается один раз: сервис её не перечитывает,
+    # а ответ сериализуется без доп. запросов
     try:
-        cart_item = CartItem.objects.get(id=item_id, user=user)
+        cart_item = CartItem.objects.select_related('product', 'product__category').get(
+            id=item_id, user=user
+        )
     except CartItem.DoesNotExist:
         return Response(
             {'error': 'Элемент корзины не найден'},
@@ -118,11 +120,7 @@ def admin_update_user_cart_item_view(request, user_id, item_id):
         )
     
     try:
-        updated_item = CartService.update_cart_item(
-            user=user,
-            item_id=item_id,
-            quantity=int(quantity)
-        )
+        updated_item = CartService.update_cart_item_instance(cart_item, int(quantity))
         serializer = CartItemSerializer(updated_item)
         return Response(serializer.data)
     except ValueError as e:
@@ -132,6 +130,43 @@ def admin_update_user_cart_item_view(request, user_id, item_id):
         )
 
 
+@api_view(['PATCH'])
+@permission_classes([IsAdmin])
+def admin_bulk_update_user_cart_items_view(request, user_id):
+    """
+    Изменить количество у нескольких позиций корзины пользователя (для администраторов)
+    
+    PATCH /api/v1/admin/cart/users/{user_id}/items/bulk/
+    Body: {"items": [{"id": 1, "quantity": 3}, ...]}
+    """
+    try:
+        user = User.objects.only('id').get(id=user_id)
+    except User.DoesNotExist:
+        return Response(
+            {'error': 'Пользователь не найден'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    items = request.data.get('items')
+    try:
+        updates = [(int(item['id']), int(item['quantity'])) for item in items]
+    except (TypeError, KeyError, ValueError):
+        return Response(
+            {'error': 'items должен быть списком объектов с полями id и quantity'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        updated_items = CartService.bulk_update_items(user, updates)
+    except ValueError as e:
+        return Response(
+            {'error': str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    serializer = CartItemSerializer(updated_items, many=True)
+    return Response(serializer.data)
+
+
 @api_view(['DELETE'])
 @permission_classes([IsAdmin])
 def admin_delete_user_cart_item_view(request, user_id, item_id):
@@ -141,7 +176,7 @@ def admin_delete_user_cart_item_view(request, user_id, item_id):
     DELETE /api/v1/admin/cart/users/{user_id}/items/{item_id}/
     """
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.only('id').get(id=user_id)
     except User.DoesNotExist:
         return Response(
             {'error': 'Пользователь не найден'},
@@ -167,7 +202,7 @@ def admin_clear_user_cart_view(request, user_id):
     DELETE /api/v1/admin/cart/users/{user_id}/clear/
     """
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.only('id').get(id=user_id)
     except User.DoesNotExist:
         return Response(
             {'error': 'Пользователь не найден'},
@@ -179,3 +214,27 @@ def admin_clear_user_cart_view(request, user_id):
         'message': f'Корзина пользователя очищена. Удалено элементов: {count}'
     }, status=status.HTTP_200_OK)
 
+
+@api_view(['POST'])
+@permission_classes([IsAdmin])
+def admin_bulk_clear_carts_view(request):
+    """
+    Очистить корзины нескольких пользователей одним запросом (для администраторов)
+    
+    POST /api/v1/admin/cart/clear/
+    Body: {"user_ids": [1, 2, 3]}
+    """
+    user_ids = request.data.get('user_ids')
+    if not isinstance(user_ids, list) or not all(
+        isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids
+    ):
+        return Response(
+            {'error': 'user_ids должен быть списком целых чисел'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    count = CartService.bulk_clear(user_ids)
+    return Response({
+        'message': f'Корзины пользователей очищены. Удалено элементов: {count}'
+    }, status=status.HTTP_200_OK)
+
@@ -4,11 +4,37 @@
 from django.db import models
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from apps.catalog.models import Product
 
 User = get_user_model()
 
 
+class CartItemQuerySet(models.QuerySet):
+    """QuerySet элементов корзины"""
+    
+    def with_line_total(self):
+        """Стоимость позиции (total_price = quantity * price), посчитанная в БД"""
+        return self.annotate(
+            total_price=models.ExpressionWrapper(
+                models.F('quantity') * models.F('product__price'),
+                output_field=models.DecimalField(max_digits=14, decimal_places=2)
+            )
+        )
+    
+    def with_totals(self):
+        """
+        Товар через JOIN, стоимость позиции (total_price) и признак возможности
+        увеличить количество на единицу (_can_increase), посчитанные в БД
+        """
+        return self.with_line_total().select_related('product').annotate(
+            _can_increase=models.ExpressionWrapper(
+                models.Q(product__stock_quantity__gte=models.F('quantity') + 1),
+                output_field=models.BooleanField()
+            ),
+        )
+
+
 class CartItem(models.Model):
     """Элемент корзины"""
     id = models.AutoField(primary_key=True)
@@ -33,14 +59,17 @@ class CartItem(models.Model):
     added_at = models.DateTimeField(auto_now_add=True, verbose_name='Добавлено')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
     
+    objects = CartItemQuerySet.as_manager()
+    
     class Meta:
         db_table = 'cart_items'
         verbose_name = 'Элемент корзины'
         verbose_name_plural = 'Элементы корзины'
+        # Индекс UNIQUE (user, product) обслуживает и фильтр по user (ведущая колонка):
+        # поиск позиции, условный UPDATE в add_to_cart и агрегаты ETag/итогов читают
+        # только строки пользователя. Индекс по (user, updated_at) не заводится —
+        # агрегат ETag всё равно соединяет товары, а каждая запись в корзину стала бы дороже
         unique_together = [['user', 'product']]
-        indexes = [
-            models.Index(fields=['user']),
-        ]
         ordering = ['-added_at']
     
     def __str__(self):
@@ -54,14 +83,33 @@ class CartItem(models.Model):
         """Проверка возможности увеличения количества"""
         return self.product.stock_quantity >= (self.quantity + amount)
     
+    def set_totals(self):
+        """
+        Заполнить total_price и _can_increase, как их аннотирует with_totals(),
+        для позиции, загруженной или созданной без аннотаций
+        """
+        self.total_price = self.get_total_price()
+        self._can_increase = self.can_increase()
+        return self
+    
     def increase_quantity(self, amount=1):
-        """Увеличить количество товара"""
-        new_quantity = self.quantity + amount
-        if not self.can_increase(amount):
+        """
+        Увеличить количество товара.
+        Проверка остатка и увеличение — один условный UPDATE: без отдельного чтения
+        товара и без гонки между проверкой и записью при параллельных запросах
+        """
+        updated = CartItem.objects.filter(
+            pk=self.pk,
+            product__stock_quantity__gte=models.F('quantity') + amount
+        ).update(quantity=models.F('quantity') + amount, updated_at=timezone.now())
+        if not updated:
+            # Остаток читается только для текста ошибки
+            stock_quantity = Product.objects.filter(pk=self.product_id).values_list(
+                'stock_quantity', flat=True
+            ).first()
             raise ValueError(
-                f'Недостаточно товара на складе. Доступно: {self.product.stock_quantity}, '
-                f'запрошено: {new_quantity}'
+                f'Недостаточно товара на складе. Доступно: {stock_quantity}, '
+                f'запрошено: {self.quantity + amount}'
             )
-        self.quantity = new_quantity
-        self.save(update_fields=['quantity', 'updated_at'])
+        self.quantity += amount
 
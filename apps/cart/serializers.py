@@ -10,6 +10,8 @@ class CartItemSerializer(serializers.ModelSerializer):
     """Сериализатор для элемента корзины"""
     product = ProductListSerializer(read_only=True)
     product_id = serializers.IntegerField(write_only=True)
+    # Значения из аннотаций CartItemQuerySet.with_totals() (или CartItem.set_totals());
+    # для позиции, загруженной без них, считаются методами модели
     total_price = serializers.SerializerMethodField()
     can_increase = serializers.SerializerMethodField()
     
@@ -22,22 +24,34 @@ class CartItemSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'added_at', 'updated_at')
     
     def get_total_price(self, obj):
-        """Общая стоимость позиции"""
-        return float(obj.get_total_price())
+        """Стоимость позиции: аннотация total_price или расчёт по цене товара"""
+        total_price = getattr(obj, 'total_price', None)
+        if total_price is None:
+            total_price = obj.get_total_price()
+        return float(total_price)
     
     def get_can_increase(self, obj):
-        """Можно ли увеличить количество"""
-        return obj.can_increase()
+        """Можно ли увеличить количество: аннотация _can_increase или проверка остатка"""
+        can_increase = getattr(obj, '_can_increase', None)
+        if can_increase is None:
+            can_increase = obj.can_increase()
+        return can_increase
     
     def validate_product_id(self, value):
         """Проверка существования товара и его доступности"""
         from apps.catalog.models import Product
-        try:
-            product = Product.objects.get(id=value, is_available=True)
-            if product.stock_quantity == 0:
-                raise serializers.ValidationError('Товар отсутствует на складе')
-        except Product.DoesNotExist:
+        # Нужен только остаток: одна колонка вместо всей строки товара
+        stock_quantity = (
+            Product.objects.filter(id=value, is_available=True)
+            .values_list('stock_quantity', flat=True)
+            .first()
+        )
+        if stock_quantity is None:
             raise serializers.ValidationError('Товар не найден или недоступен')
+        if stock_quantity == 0:
+            raise serializers.ValidationError('Товар отсутствует на складе')
+        # Остаток переиспользуется в validate() без повторного запроса
+        self._stock_quantity = stock_quantity
         return value
     
     def validate_quantity(self, value):
@@ -48,22 +62,62 @@ class CartItemSerializer(serializers.ModelSerializer):
     
     def validate(self, attrs):
         """Проверка наличия товара на складе"""
-        product_id = attrs.get('product_id')
+        stock_quantity = getattr(self, '_stock_quantity', None)
         quantity = attrs.get('quantity', 1)
         
-        if product_id:
-            from apps.catalog.models import Product
-            try:
-                product = Product.objects.get(id=product_id)
-                if product.stock_quantity < quantity:
-                    raise serializers.ValidationError(
-                        f'Недостаточно товара на складе. Доступно: {product.stock_quantity}'
-                    )
-            except Product.DoesNotExist:
-                pass
+        if stock_quantity is not None and stock_quantity < quantity:
+            raise serializers.ValidationError(
+                f'Недостаточно товара на складе. Доступно: {stock_quantity}'
+            )
         return attrs
 
 
+_price_field = serializers.DecimalField(max_digits=12, decimal_places=2)
+_datetime_field = serializers.DateTimeField()
+
+
+def cart_rows_to_representation(rows):
+    """
+    Представление позиций корзины из словарей CartService.get_cart_rows_with_totals —
+    тот же вывод, что у CartItemSerializer(many=True), без создания моделей
+    и привязки полей сериализатора на каждую строку. Соответствие сериализаторам
+    поле за полем проверяет test_cart_rows_match_serializer_output: при добавлении
+    поля в CartItemSerializer или ProductListSerializer его нужно добавить и сюда
+    (и в CART_ROW_FIELDS)
+    """
+    items = []
+    for row in rows:
+        product = {
+            'id': row['product_id'],
+            'sku': row['product__sku'],
+            'name': row['product__name'],
+            'description': row['product__description'],
+            'price': _price_field.to_representation(row['product__price']),
+            'stock_quantity': row['product__stock_quantity'],
+            'category': row['product__category_id'],
+        }
+        # Как и ProductListSerializer, поля категории опускаются, если её нет
+        if row['product__category_id'] is not None:
+            product['category_name'] = row['product__category__name']
+            product['category_slug'] = row['product__category__slug']
+        product.update({
+            'image_url': row['product__image_url'],
+            'is_available': row['product__is_available'],
+            'is_in_stock': row['product__stock_quantity'] > 0 and row['product__is_available'],
+            'created_at': _datetime_field.to_representation(row['product__created_at']),
+        })
+        items.append({
+            'id': row['id'],
+            'product': product,
+            'quantity': row['quantity'],
+            'total_price': float(row['total_price']),
+            'can_increase': row['_can_increase'],
+            'added_at': _datetime_field.to_representation(row['added_at']),
+            'updated_at': _datetime_field.to_representation(row['updated_at']),
+        })
+    return items
+
+
 class CartItemAddSerializer(serializers.Serializer):
     """Сериализатор для добавления товара в корзину"""
     product_id = serializers.IntegerField()
@@ -72,25 +126,27 @@ class CartItemAddSerializer(serializers.Serializer):
     def validate_product_id(self, value):
         """Проверка существования товара"""
         from apps.catalog.models import Product
-        try:
-            product = Product.objects.get(id=value, is_available=True)
-            if product.stock_quantity == 0:
-                raise serializers.ValidationError('Товар отсутствует на складе')
-        except Product.DoesNotExist:
+        # Нужен только остаток: одна колонка вместо всей строки товара
+        stock_quantity = (
+            Product.objects.filter(id=value, is_available=True)
+            .values_list('stock_quantity', flat=True)
+            .first()
+        )
+        if stock_quantity is None:
             raise serializers.ValidationError('Товар не найден или недоступен')
+        if stock_quantity == 0:
+            raise serializers.ValidationError('Товар отсутствует на складе')
+        # Остаток переиспользуется в validate() без повторного запроса
+        self._stock_quantity = stock_quantity
         return value
     
     def validate(self, attrs):
         """Проверка наличия товара на складе"""
-        product_id = attrs.get('product_id')
         quantity = attrs.get('quantity', 1)
         
-        from apps.catalog.models import Product
-        product = Product.objects.get(id=product_id)
-        
-        if product.stock_quantity < quantity:
+        if self._stock_quantity < quantity:
             raise serializers.ValidationError(
-                f'Недостаточно товара на складе. Доступно: {product.stock_quantity}'
+                f'Недостаточно товара на складе. Доступно: {self._stock_quantity}'
             )
         
         return attrs
@@ -1,14 +1,44 @@
 """
 Сервис корзины: получение, добавление, обновление, удаление, валидация.
 """
+from decimal import Decimal
 from django.db import transaction
+from django.utils import timezone
+from django.db.models import Case, CharField, Count, DecimalField, F, Max, Sum, Value, When
+from django.db.models.functions import Coalesce, Now
 from django.contrib.auth import get_user_model
 from .models import CartItem
 from apps.catalog.models import Product
-from apps.catalog.services import ProductService
+from apps.common.utils import make_etag
 
 User = get_user_model()
 
+CART_TOTAL_FIELD = DecimalField(max_digits=14, decimal_places=2)
+
+# Колонки позиции и товара, которых достаточно для оформления заказа и проверок;
+# description и image_url товара из БД не читаются
+CART_MINIMAL_FIELDS = (
+    'id', 'user_id', 'quantity', 'added_at', 'updated_at',
+    'product__id', 'product__name', 'product__sku', 'product__price',
+    'product__stock_quantity', 'product__is_available',
+)
+
+# Колонки позиции корзины для ответов только на чтение (get_cart_rows_with_totals)
+CART_ROW_FIELDS = (
+    'id', 'quantity', 'total_price', '_can_increase', 'added_at', 'updated_at',
+    'product_id', 'product__sku', 'product__name', 'product__description',
+    'product__price', 'product__stock_quantity', 'product__category_id',
+    'product__category__name', 'product__category__slug', 'product__image_url',
+    'product__is_available', 'product__created_at',
+)
+
+# Размер пачки для bulk_update позиций корзины
+BULK_UPDATE_BATCH_SIZE = 500
+
+# Причины, по которым позиция корзины не проходит валидацию
+SHORTAGE_UNAVAILABLE = 'unavailable'
+SHORTAGE_STOCK = 'short'
+
 
 class CartService:
     """Сервис для работы с корзиной"""
@@ -16,7 +46,21 @@ class CartService:
     @staticmethod
     def get_cart(user):
         """
-        Получить корзину пользователя
+        Получить корзину пользователя для сериализации (товар вместе с категорией)
+        
+        Args:
+            user: объект пользователя
+        
+        Returns:
+            QuerySet элементов корзины
+        """
+        return CartItem.objects.filter(user=user).with_totals().select_related('product__category')
+    
+    @staticmethod
+    def get_cart_minimal(user):
+        """
+        Получить корзину пользователя без JOIN категорий — для путей,
+        которые не читают product.category (оформление заказа)
         
         Args:
             user: объект пользователя
@@ -24,12 +68,13 @@ class CartService:
         Returns:
             QuerySet элементов корзины
         """
-        return CartItem.objects.filter(user=user).select_related('product', 'product__category')
+        return CartItem.objects.filter(user=user).with_totals().only(*CART_MINIMAL_FIELDS)
     
     @staticmethod
     def get_cart_total(user):
         """
-        Получить общую стоимость корзины
+        Получить общую стоимость корзины (только итоги, без позиций).
+        Если нужны и позиции, и итоги — get_cart_with_totals: один запрос вместо двух
         
         Args:
             user: объект пользователя
@@ -37,13 +82,106 @@ class CartService:
         Returns:
             dict: {'total_items': int, 'total_price': Decimal}
         """
-        cart_items = CartService.get_cart(user)
-        total_items = sum(item.quantity for item in cart_items)
-        total_price = sum(item.get_total_price() for item in cart_items)
+        # Пустая корзина даёт нули прямо из БД (COALESCE), без постобработки в Python
+        # Сумма по тому же выражению quantity * price, что и аннотация with_line_total();
+        # саму аннотацию агрегировать нельзя: алиас агрегата total_price совпал бы с ней
+        return CartItem.objects.filter(user=user).aggregate(
+            total_items=Coalesce(Sum('quantity'), 0),
+            total_price=Coalesce(
+                Sum(F('quantity') * F('product__price'), output_field=CART_TOTAL_FIELD),
+                Value(Decimal('0')),
+                output_field=CART_TOTAL_FIELD
+            ),
+        )
+    
+    @staticmethod
+    def get_cart_count(user):
+        """
+        Количество товаров в корзине (для бейджа в шапке): один SUM
+        по индексу cart_items(user_id), без загрузки позиций и товаров
+        
+        Args:
+            user: объект пользователя
+        
+        Returns:
+            int: суммарное количество товаров
+        """
+        return CartItem.objects.filter(user=user).aggregate(
+            total_items=Coalesce(Sum('quantity'), 0)
+        )['total_items']
+    
+    @staticmethod
+    def get_cart_etag(user):
+        """
+        ETag содержимого корзины по одному агрегату, без выборки позиций:
+        меняется при добавлении, изменении и удалении позиций, а также
+        при изменении товаров в корзине (цена, остаток)
         
+        Args:
+            user: объект пользователя
+        
+        Returns:
+            str: слабый ETag
+        """
+        meta = CartItem.objects.filter(user=user).aggregate(
+            count=Count('id'),
+            updated_at=Max('updated_at'),
+            product_updated_at=Max('product__updated_at'),
+            stock=Sum('product__stock_quantity'),
+        )
+        return make_etag(
+            meta['count'], meta['updated_at'], meta['product_updated_at'], meta['stock']
+        )
+    
+    @staticmethod
+    def summarize_cart(cart_items):
+        """
+        Посчитать итоги по уже загруженным элементам корзины
+        (без повторного запроса, когда позиции всё равно выводятся в ответе)
+        
+        Args:
+            cart_items: список элементов корзины из get_cart (с аннотацией total_price)
+        
+        Returns:
+            dict: {'total_items': int, 'total_price': Decimal}
+        """
         return {
-            'total_items': total_items,
-            'total_price': total_price
+            'total_items': sum(item.quantity for item in cart_items),
+            'total_price': sum((item.total_price for item in cart_items), Decimal('0'))
+        }
+    
+    @staticmethod
+    def get_cart_with_totals(user):
+        """
+        Получить позиции корзины и итоги за один запрос
+        
+        Args:
+            user: объект пользователя
+        
+        Returns:
+            tuple: (список CartItem, {'total_items': int, 'total_price': Decimal})
+        """
+        cart_items = list(CartService.get_cart(user))
+        return cart_items, CartService.summarize_cart(cart_items)
+    
+    @staticmethod
+    def get_cart_rows_with_totals(user):
+        """
+        Позиции корзины словарями (values) и итоги за один запрос — для ответов
+        только на чтение: модели и поля сериализатора на каждую строку не создаются
+        (представление строк — serializers.cart_rows_to_representation)
+        
+        Args:
+            user: объект пользователя
+        
+        Returns:
+            tuple: (список словарей с колонками CART_ROW_FIELDS,
+                    {'total_items': int, 'total_price': Decimal})
+        """
+        rows = list(CartItem.objects.filter(user=user).with_totals().values(*CART_ROW_FIELDS))
+        return rows, {
+            'total_items': sum(row['quantity'] for row in rows),
+            'total_price': sum((row['total_price'] for row in rows), Decimal('0'))
         }
     
     @staticmethod
@@ -63,31 +201,60 @@ class CartService:
         Raises:
             ValueError: если товар недоступен или недостаточно на складе
         """
-        is_available, product = ProductService.check_availability(product_id, quantity)
-        if not is_available:
-            if product:
+        # Частый случай — товар уже в корзине и остатка хватает: проверка и увеличение
+        # одним условным UPDATE, без отдельного чтения товара и без гонки между ними
+        updated = CartItem.objects.filter(
+            user=user,
+            product_id=product_id,
+            product__is_available=True,
+            product__stock_quantity__gte=F('quantity') + quantity
+        ).update(quantity=F('quantity') + quantity, updated_at=Now())
+        if updated:
+            cart_item = CartItem.objects.select_related('product', 'product__category').get(
+                user=user, product_id=product_id
+            )
+            return cart_item.set_totals()
+        
+        # Позиции нет или остатка не хватает: блокируем строку товара, чтобы параллельное
+        # добавление того же товара дождалось нас и увидело созданную позицию
+        product = (
+            Product.objects.select_related('category')
+            .select_for_update(of=('self',))
+            .filter(id=product_id, is_available=True)
+            .first()
+        )
+        if product is None:
+            raise ValueError('Товар не найден или недоступен')
+        
+        # Строку позиции тоже блокируем: условный UPDATE из быстрого пути
+        # не сможет изменить количество между нашей проверкой и записью
+        cart_item = CartItem.objects.select_for_update().filter(user=user, product_id=product_id).first()
+        if cart_item is None:
+            if product.stock_quantity < quantity:
                 raise ValueError(
                     f'Недостаточно товара на складе. Доступно: {product.stock_quantity}, '
                     f'запрошено: {quantity}'
                 )
-            else:
-                raise ValueError('Товар не найден или недоступен')
-        cart_item, created = CartItem.objects.get_or_create(
-            user=user,
-            product_id=product_id,
-            defaults={'quantity': quantity}
-        )
-        if not created:
+            cart_item = CartItem.objects.create(user=user, product=product, quantity=quantity)
+        else:
             new_quantity = cart_item.quantity + quantity
             if product.stock_quantity < new_quantity:
                 raise ValueError(
                     f'Недостаточно товара на складе. В корзине: {cart_item.quantity}, '
                     f'добавляется: {quantity}, доступно: {product.stock_quantity}'
                 )
+            # Позицию создал параллельный запрос, пока мы ждали блокировку товара.
+            # Увеличение — атомарным F-выражением, а не записью посчитанного в Python значения
+            updated_at = timezone.now()
+            CartItem.objects.filter(pk=cart_item.pk).update(
+                quantity=F('quantity') + quantity, updated_at=updated_at
+            )
             cart_item.quantity = new_quantity
-            cart_item.save(update_fields=['quantity', 'updated_at'])
+            cart_item.updated_at = updated_at
         
-        return cart_item
+        # Товар с категорией уже загружен — ответ сериализуется без доп. запросов
+        cart_item.product = product
+        return cart_item.set_totals()
     
     @staticmethod
     @transaction.atomic
@@ -107,13 +274,30 @@ class CartService:
             ValueError: если товар недоступен или недостаточно на складе
         """
         try:
-            cart_item = CartItem.objects.select_related('product').get(
+            cart_item = CartItem.objects.select_related('product', 'product__category').get(
                 id=item_id,
                 user=user
             )
         except CartItem.DoesNotExist:
             raise ValueError('Элемент корзины не найден')
         
+        return CartService.update_cart_item_instance(cart_item, quantity)
+    
+    @staticmethod
+    def update_cart_item_instance(cart_item, quantity):
+        """
+        Обновить количество у уже загруженного элемента корзины (без повторного чтения)
+        
+        Args:
+            cart_item: элемент корзины с загруженным товаром
+            quantity: новое количество
+        
+        Returns:
+            CartItem: обновленный элемент корзины
+        
+        Raises:
+            ValueError: если недостаточно товара на складе
+        """
         if quantity < 1:
             raise ValueError('Количество должно быть больше 0')
         if cart_item.product.stock_quantity < quantity:
@@ -125,7 +309,51 @@ class CartService:
         cart_item.quantity = quantity
         cart_item.save(update_fields=['quantity', 'updated_at'])
         
-        return cart_item
+        return cart_item.set_totals()
+    
+    @staticmethod
+    @transaction.atomic
+    def bulk_update_items(user, updates):
+        """
+        Изменить количество у нескольких позиций корзины: одно чтение позиций
+        и один UPDATE ... CASE WHEN на пачку вместо запросов на каждую позицию.
+        Изменения применяются целиком или не применяются вовсе
+        
+        Args:
+            user: объект пользователя
+            updates: список пар (item_id, quantity)
+        
+        Returns:
+            list: обновленные элементы корзины
+        
+        Raises:
+            ValueError: если позиция не найдена, количество меньше 1
+                или недостаточно товара на складе
+        """
+        quantities = dict(updates)
+        cart_items = list(
+            CartItem.objects.filter(user=user, id__in=quantities)
+            .select_related('product', 'product__category')
+        )
+        missing = quantities.keys() - {item.id for item in cart_items}
+        if missing:
+            raise ValueError(f'Элементы корзины не найдены: {", ".join(map(str, sorted(missing)))}')
+        
+        updated_at = timezone.now()
+        for item in cart_items:
+            quantity = quantities[item.id]
+            if quantity < 1:
+                raise ValueError('Количество должно быть больше 0')
+            if item.product.stock_quantity < quantity:
+                raise ValueError(
+                    f'Недостаточно товара "{item.product.name}" на складе. '
+                    f'Доступно: {item.product.stock_quantity}, запрошено: {quantity}'
+                )
+            item.quantity = quantity
+            item.updated_at = updated_at
+        
+        CartItem.objects.bulk_update(cart_items, ['quantity', 'updated_at'], batch_size=BULK_UPDATE_BATCH_SIZE)
+        return [item.set_totals() for item in cart_items]
     
     @staticmethod
     def remove_from_cart(user, item_id):
@@ -142,12 +370,11 @@ class CartService:
         Raises:
             ValueError: если элемент не найден
         """
-        try:
-            cart_item = CartItem.objects.get(id=item_id, user=user)
-            cart_item.delete()
-            return True
-        except CartItem.DoesNotExist:
+        # Один DELETE вместо SELECT + DELETE; отсутствие строки видно по счётчику
+        deleted, _ = CartItem.objects.filter(id=item_id, user=user).delete()
+        if not deleted:
             raise ValueError('Элемент корзины не найден')
+        return True
     
     @staticmethod
     def clear_cart(user):
@@ -160,8 +387,28 @@ class CartService:
         Returns:
             int: количество удаленных элементов
         """
-        count, _ = CartItem.objects.filter(user=user).delete()
-        return count
+        # Один DELETE по user_id; считаем только позиции корзины
+        _, details = CartItem.objects.filter(user=user).delete()
+        return details.get(CartItem._meta.label, 0)
+    
+    @staticmethod
+    def bulk_clear(user_ids):
+        """
+        Очистить корзины нескольких пользователей одним DELETE ... WHERE user_id IN (...).
+        На позиции корзины никто не ссылается и обработчиков удаления у них нет,
+        поэтому QuerySet.delete() удаляет их одним запросом, без выборки строк
+        
+        Args:
+            user_ids: итерируемое из ID пользователей
+        
+        Returns:
+            int: количество удаленных элементов
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+        deleted, _ = CartItem.objects.filter(user_id__in=user_ids).delete()
+        return deleted
     
     @staticmethod
     def validate_cart(user):
@@ -179,21 +426,32 @@ class CartService:
         Returns:
             tuple: (is_valid, errors_list)
         """
-        cart_items = CartService.get_cart(user)
+        # Проверка остатков в БД: возвращаются только проблемные позиции
+        issues = CartItem.objects.filter(user=user).annotate(
+            shortage=Case(
+                When(product__is_available=False, then=Value(SHORTAGE_UNAVAILABLE)),
+                When(product__stock_quantity__lt=F('quantity'), then=Value(SHORTAGE_STOCK)),
+                default=Value(''),
+                output_field=CharField()
+            )
+        ).exclude(shortage='').values(
+            'product__name', 'quantity', 'product__stock_quantity', 'shortage'
+        )
         errors = []
         
-        if not cart_items.exists():
-            errors.append('Корзина пуста')
-            return False, errors
-        
-        for item in cart_items:
-            if not item.product.is_available:
-                errors.append(f'Товар "{item.product.name}" недоступен')
-            elif item.product.stock_quantity < item.quantity:
+        for issue in issues:
+            name = issue['product__name']
+            if issue['shortage'] == SHORTAGE_UNAVAILABLE:
+                errors.append(f'Товар "{name}" недоступен')
+            else:
                 errors.append(
-                    f'Недостаточно товара "{item.product.name}" на складе. '
-                    f'В корзине: {item.quantity}, доступно: {item.product.stock_quantity}'
+                    f'Недостаточно товара "{name}" на складе. '
+                    f'В корзине: {issue["quantity"]}, доступно: {issue["product__stock_quantity"]}'
                 )
         
+        # Пустоту корзины проверяем, только если проблемных позиций нет
+        if not errors and not CartItem.objects.filter(user=user).exists():
+            errors.append('Корзина пуста')
+        
         return len(errors) == 0, errors
 
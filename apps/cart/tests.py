@@ -1,14 +1,18 @@
 """
 Тесты API корзины и сервиса CartService.
 """
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from apps.catalog.models import Category, Product
+from apps.catalog.serializers import ProductListSerializer
 from apps.accounts.models import Role
 from .models import CartItem
+from .serializers import CartItemAddSerializer, CartItemSerializer, cart_rows_to_representation
 from .services import CartService
 
 User = get_user_model()
@@ -16,32 +20,36 @@ User = get_user_model()
 
 class CartAPITestCase(TestCase):
     """Тесты для API корзины"""
+    fixtures = ['roles.json']
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.client = APIClient()
-        
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
-        self.buyer = User.objects.create_user(
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.buyer_role = Role.objects.get(name='Buyer')
+        cls.buyer = User.objects.create_user(
             username='buyer',
             email='buyer@test.com',
             password='testpass123',
-            role=self.buyer_role
+            role=cls.buyer_role
         )
         
-        self.category = Category.objects.create(
+        cls.category = Category.objects.create(
             name='Категория',
             slug='category'
         )
-        self.product = Product.objects.create(
+        cls.product = Product.objects.create(
             name='Товар',
             sku='PROD-001',
             price=1000.00,
             stock_quantity=10,
-            category=self.category,
+            category=cls.category,
             is_available=True
         )
     
+    def setUp(self):
+        """Клиент хранит состояние (credentials) — новый на каждый тест"""
+        self.client = APIClient()
+    
     def get_buyer_token(self):
         """Получить токен покупателя"""
         refresh = RefreshToken.for_user(self.buyer)
@@ -69,6 +77,22 @@ class CartAPITestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(CartItem.objects.filter(user=self.buyer, product=self.product).exists())
     
+    def test_cart_conditional_get(self):
+        """Повторный запрос корзины с If-None-Match получает 304, пока корзина не изменилась"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        for url in ('/api/v1/cart/', '/api/v1/cart/total/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        
+        CartItem.objects.filter(user=self.buyer).update(quantity=2)
+        response = self.client.get('/api/v1/cart/total/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_items'], 2)
+    
     def test_update_cart_item(self):
         """Тест обновления количества товара в корзине"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
@@ -94,31 +118,36 @@ class CartAPITestCase(TestCase):
         response = self.client.delete(f'/api/v1/cart/items/{cart_item.id}/')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertFalse(CartItem.objects.filter(id=cart_item.id).exists())
+        
+        response = self.client.delete(f'/api/v1/cart/items/{cart_item.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
 class CartServiceTestCase(TestCase):
     """Тесты для сервиса корзины"""
+    fixtures = ['roles.json']
     
-    def setUp(self):
-        """Настройка тестового окружения"""
-        self.buyer_role, _ = Role.objects.get_or_create(name='Buyer')
-        self.buyer = User.objects.create_user(
+    @classmethod
+    def setUpTestData(cls):
+        """Общие данные создаются один раз на класс"""
+        cls.buyer_role = Role.objects.get(name='Buyer')
+        cls.buyer = User.objects.create_user(
             username='buyer',
             email='buyer@test.com',
             password='testpass123',
-            role=self.buyer_role
+            role=cls.buyer_role
         )
         
-        self.category = Category.objects.create(
+        cls.category = Category.objects.create(
             name='Категория',
             slug='category'
         )
-        self.product = Product.objects.create(
+        cls.product = Product.objects.create(
             name='Товар',
             sku='PROD-001',
             price=1000.00,
             stock_quantity=10,
-            category=self.category,
+            category=cls.category,
             is_available=True
         )
     
@@ -151,4 +180,224 @@ class CartServiceTestCase(TestCase):
         is_valid, errors = CartService.validate_cart(self.buyer)
         self.assertFalse(is_valid)
         self.assertGreater(len(errors), 0)
-
+    
+    def test_get_cart_minimal_skips_category_join(self):
+        """Минимальная корзина не присоединяет категории, полная — присоединяет"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        minimal_sql = str(CartService.get_cart_minimal(self.buyer).query)
+        self.assertNotIn('categories', minimal_sql)
+        self.assertIn('categories', str(CartService.get_cart(self.buyer).query))
+        self.assertEqual(CartService.get_cart_minimal(self.buyer).get().product_id, self.product.id)
+    
+    def test_get_cart_minimal_defers_wide_product_columns(self):
+        """Минимальная корзина не читает описание и изображение товара"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        item = CartService.get_cart_minimal(self.buyer).get()
+        self.assertEqual(item.product.get_deferred_fields() & {'description', 'image_url'},
+                         {'description', 'image_url'})
+        with self.assertNumQueries(0):
+            self.assertEqual(item.product.stock_quantity, self.product.stock_quantity)
+            self.assertEqual(item.total_price, item.quantity * self.product.price)
+    
+    def test_update_loaded_item_without_refetch(self):
+        """Обновление загруженной позиции — только UPDATE, без повторного чтения"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        item = CartService.get_cart(self.buyer).get()
+        with self.assertNumQueries(1):
+            item = CartService.update_cart_item_instance(item, 4)
+        self.assertEqual(item.total_price, 4 * self.product.price)
+        with self.assertRaises(ValueError):
+            CartService.update_cart_item_instance(item, self.product.stock_quantity + 1)
+    
+    def test_bulk_update_items(self):
+        """Количество нескольких позиций меняется одним UPDATE, ошибка откатывает всё"""
+        other_product = Product.objects.create(
+            name='Другой товар', sku='TEST-002', price=500, stock_quantity=3, category=self.category
+        )
+        first = CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        second = CartItem.objects.create(user=self.buyer, product=other_product, quantity=1)
+        with CaptureQueriesContext(connection) as ctx:
+            items = CartService.bulk_update_items(self.buyer, [(first.id, 5), (second.id, 2)])
+        queries = [q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(queries), 2)
+        self.assertEqual({item.id: item.quantity for item in items}, {first.id: 5, second.id: 2})
+        
+        with self.assertRaises(ValueError):
+            CartService.bulk_update_items(self.buyer, [(first.id, 7), (second.id, 4)])
+        first.refresh_from_db()
+        self.assertEqual(first.quantity, 5)
+        with self.assertRaises(ValueError):
+            CartService.bulk_update_items(self.buyer, [(first.id + second.id + 100, 1)])
+    
+    def test_cart_count(self):
+        """Количество товаров корзины — один запрос суммы по позициям пользователя"""
+        other_product = Product.objects.create(
+            name='Другой товар', sku='TEST-002', price=500, stock_quantity=3, category=self.category
+        )
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=2)
+        CartItem.objects.create(user=self.buyer, product=other_product, quantity=3)
+        with self.assertNumQueries(1):
+            self.assertEqual(CartService.get_cart_count(self.buyer), 5)
+    
+    def test_cart_rows_match_serializer_output(self):
+        """
+        Позиции из values() представляются так же, как через CartItemSerializer:
+        поле за полем, включая вложенный товар, по списку полей самих сериализаторов
+        """
+        no_category = Product.objects.create(
+            name='Без категории', sku='TEST-003', price=250.50, stock_quantity=0, is_available=False
+        )
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=2)
+        CartItem.objects.create(user=self.buyer, product=no_category, quantity=1)
+        with self.assertNumQueries(1):
+            rows, totals = CartService.get_cart_rows_with_totals(self.buyer)
+        actual = cart_rows_to_representation(rows)
+        expected = CartItemSerializer(CartService.get_cart(self.buyer), many=True).data
+        self.assertEqual(len(actual), len(expected))
+        
+        item_fields = [
+            name for name, field in CartItemSerializer().fields.items() if not field.write_only
+        ]
+        product_fields = list(ProductListSerializer().fields)
+        for actual_item, expected_item in zip(actual, expected):
+            # Порядок и состав ключей совпадают: новое поле сериализатора без пары
+            # в cart_rows_to_representation сразу роняет тест
+            self.assertEqual(list(actual_item), list(expected_item))
+            self.assertEqual(list(actual_item), item_fields)
+            for name in item_fields:
+                if name == 'product':
+                    continue
+                with self.subTest(item=expected_item['id'], field=name):
+                    self.assertEqual(actual_item[name], expected_item[name])
+            
+            actual_product, expected_product = actual_item['product'], expected_item['product']
+            self.assertEqual(list(actual_product), list(expected_product))
+            for name in product_fields:
+                with self.subTest(item=expected_item['id'], field=f'product.{name}'):
+                    self.assertEqual(actual_product.get(name), expected_product.get(name))
+                    self.assertEqual(name in actual_product, name in expected_product)
+        self.assertEqual(totals, CartService.get_cart_total(self.buyer))
+    
+    def test_bulk_clear_single_delete(self):
+        """Корзины нескольких пользователей очищаются одним DELETE"""
+        other = User.objects.create_user(
+            username='buyer2', email='buyer2@test.com', password='testpass123', role=self.buyer_role
+        )
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        CartItem.objects.create(user=other, product=self.product, quantity=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(CartService.bulk_clear([self.buyer.id, other.id]), 2)
+        self.assertFalse(CartItem.objects.exists())
+        with self.assertNumQueries(0):
+            self.assertEqual(CartService.bulk_clear([]), 0)
+    
+    def test_validate_cart_single_query(self):
+        """Проблемные позиции отбираются одним запросом, пустая корзина — отдельная ошибка"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=15)
+        with self.assertNumQueries(1):
+            is_valid, errors = CartService.validate_cart(self.buyer)
+        self.assertFalse(is_valid)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('Недостаточно товара', errors[0])
+        
+        CartItem.objects.filter(user=self.buyer).delete()
+        self.assertEqual(CartService.validate_cart(self.buyer), (False, ['Корзина пуста']))
+    
+    def test_add_serializer_fetches_product_once(self):
+        """Товар загружается один раз на валидацию product_id и остатка"""
+        serializer = CartItemAddSerializer(data={'product_id': self.product.id, 'quantity': 20})
+        with self.assertNumQueries(1):
+            self.assertFalse(serializer.is_valid())
+        self.assertIn('non_field_errors', serializer.errors)
+    
+    def test_cart_total_aggregated_in_db(self):
+        """Итоги корзины считаются одним агрегирующим запросом"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=3)
+        
+        with self.assertNumQueries(1):
+            totals = CartService.get_cart_total(self.buyer)
+        self.assertEqual(totals['total_items'], 3)
+        self.assertEqual(totals['total_price'], self.product.price * 3)
+        with self.assertNumQueries(1):
+            _, fused_totals = CartService.get_cart_with_totals(self.buyer)
+        self.assertEqual(fused_totals, totals)
+    
+    def test_get_cart_annotates_line_total(self):
+        """Стоимость позиции считается в БД и совпадает с расчётом модели"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=2)
+        
+        item = CartService.get_cart(self.buyer).get()
+        self.assertEqual(item.total_price, item.get_total_price())
+        self.assertEqual(item._can_increase, item.can_increase())
+    
+    def test_serialized_cart_query_count_independent_of_size(self):
+        """Категории товаров приходят JOIN'ом: число запросов не растёт с размером корзины"""
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                CartItemSerializer(CartService.get_cart(self.buyer), many=True).data
+            return len(ctx.captured_queries)
+        
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        single = count_queries()
+        for i in range(3):
+            category = Category.objects.create(name=f'Категория {i}', slug=f'category-{i}')
+            product = Product.objects.create(
+                name=f'Товар {i}', sku=f'PROD-1{i}', price=10, stock_quantity=5, category=category
+            )
+            CartItem.objects.create(user=self.buyer, product=product, quantity=1)
+        self.assertEqual(count_queries(), single)
+    
+    def test_clear_cart_single_delete(self):
+        """Очистка корзины — один DELETE, возвращается число удалённых позиций"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=1)
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(CartService.clear_cart(self.buyer), 1)
+        with self.assertRaises(ValueError):
+            CartService.remove_from_cart(self.buyer, 0)
+    
+    def test_added_item_serializes_without_annotations(self):
+        """Позиция из add_to_cart сериализуется с теми же полями, что и позиции get_cart"""
+        cart_item = CartService.add_to_cart(self.buyer, self.product.id, 2)
+        data = CartItemSerializer(cart_item).data
+        self.assertEqual(data['total_price'], 2000.0)
+        self.assertTrue(data['can_increase'])
+    
+    def test_plain_item_serializes_computed_totals(self):
+        """Позиция, загруженная без with_totals()/set_totals(), не теряет total_price и can_increase"""
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=10)
+        cart_item = CartItem.objects.select_related('product').get(user=self.buyer)
+        self.assertFalse(hasattr(cart_item, '_can_increase'))
+        data = CartItemSerializer(cart_item).data
+        self.assertEqual(data['total_price'], 10000.0)
+        self.assertFalse(data['can_increase'])
+    
+    def test_increase_quantity_conditional_update(self):
+        """Увеличение количества — один UPDATE; при нехватке остатка строка не меняется"""
+        cart_item = CartItem.objects.create(user=self.buyer, product=self.product, quantity=9)
+        
+        with self.assertNumQueries(1):
+            cart_item.increase_quantity()
+        self.assertEqual(cart_item.quantity, 10)
+        with self.assertRaises(ValueError):
+            cart_item.increase_quantity()
+        cart_item.refresh_from_db()
+        self.assertEqual(cart_item.quantity, 10)
+    
+    def test_empty_cart_total_is_zero(self):
+        """Для пустой корзины агрегат возвращает нули"""
+        totals = CartService.get_cart_total(self.buyer)
+        self.assertEqual(totals, {'total_items': 0, 'total_price': 0})
+    
+    def test_add_existing_item_increments_in_place(self):
+        """Повторное добавление — условный UPDATE и чтение позиции; сверх остатка — ошибка"""
+        CartService.add_to_cart(self.buyer, self.product.id, 2)
+        
+        with CaptureQueriesContext(connection) as ctx:
+            cart_item = CartService.add_to_cart(self.buyer, self.product.id, 3)
+        statements = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(cart_item.quantity, 5)
+        with self.assertRaises(ValueError):
+            CartService.add_to_cart(self.buyer, self.product.id, 6)
+        self.assertEqual(CartItem.objects.get(id=cart_item.id).quantity, 5)
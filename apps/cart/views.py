@@ -8,11 +8,13 @@ from .models import CartItem
 from .serializers import (
     CartItemSerializer,
     CartItemAddSerializer,
-    CartSerializer
+    CartSerializer,
+    cart_rows_to_representation
 )
 from .services import CartService
 from ..common.permissions import IsBuyer
 from ..common.exceptions import InsufficientStockError, EmptyCartError
+from ..common.utils import make_etag, not_modified_response
 
 
 class CartItemListAPIView(generics.ListCreateAPIView):
@@ -60,7 +62,10 @@ class CartItemDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsBuyer]
     
     def get_queryset(self):
-        """Получить корзину текущего пользователя"""
+        """
+        Получить корзину текущего пользователя
+        (товар с категорией: позиция сериализуется и при чтении, и после изменения)
+        """
         return CartService.get_cart(self.request.user)
     
     def update(self, request, *args, **kwargs):
@@ -76,11 +81,8 @@ class CartItemDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
             )
         
         try:
-            cart_item = CartService.update_cart_item(
-                user=request.user,
-                item_id=instance.id,
-                quantity=int(quantity)
-            )
+            # Позиция уже загружена get_object — сервис не читает её повторно
+            cart_item = CartService.update_cart_item_instance(instance, int(quantity))
             serializer = self.get_serializer(cart_item)
             return Response(serializer.data)
         except ValueError as e:
@@ -91,14 +93,15 @@ class CartItemDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     
     def destroy(self, request, *args, **kwargs):
         """Удаление товара из корзины"""
-        instance = self.get_object()
+        # Без предварительного get_object: DELETE с фильтром по пользователю
+        # сам проверяет владельца, отсутствие позиции — 404
         try:
-            CartService.remove_from_cart(request.user, instance.id)
+            CartService.remove_from_cart(request.user, kwargs['pk'])
             return Response(status=status.HTTP_204_NO_CONTENT)
         except ValueError as e:
             return Response(
                 {'error': str(e)},
-                status=status.HTTP_400_BAD_REQUEST
+                status=status.HTTP_404_NOT_FOUND
             )
 
 
@@ -109,17 +112,24 @@ def cart_view(request):
     Получить полную корзину с общей стоимостью
     
     GET /api/v1/cart/
+    
+    Поддерживает условный запрос: при совпадении If-None-Match
+    возвращается 304 без выборки и сериализации позиций
     """
-    cart_items = CartService.get_cart(request.user)
-    cart_total = CartService.get_cart_total(request.user)
+    etag = CartService.get_cart_etag(request.user)
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
     
-    serializer = CartItemSerializer(cart_items, many=True)
+    rows, cart_total = CartService.get_cart_rows_with_totals(request.user)
     
-    return Response({
-        'items': serializer.data,
+    response = Response({
+        'items': cart_rows_to_representation(rows),
         'total_items': cart_total['total_items'],
         'total_price': float(cart_total['total_price'])
     })
+    response['ETag'] = etag
+    return response
 
 
 @api_view(['GET'])
@@ -131,11 +141,29 @@ def cart_total_view(request):
     GET /api/v1/cart/total/
     """
     cart_total = CartService.get_cart_total(request.user)
+    # Итоги и есть содержимое ответа: ETag строится из них без отдельного запроса
+    etag = make_etag(cart_total['total_items'], cart_total['total_price'])
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
     
-    return Response({
+    response = Response({
         'total_items': cart_total['total_items'],
         'total_price': float(cart_total['total_price'])
     })
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsBuyer])
+def cart_count_view(request):
+    """
+    Получить количество товаров в корзине (для бейджа в шапке)
+    
+    GET /api/v1/cart/count/
+    """
+    return Response({'total_items': CartService.get_cart_count(request.user)})
 
 
 @api_view(['DELETE'])
@@ -1,14 +1,63 @@
 """
 Экспорт категорий и товаров в CSV.
 """
-import csv
-from django.http import HttpResponse
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.response import Response
-from rest_framework import status
-from .models import Product, Category
+from .models import Category
 from .services import ProductService
 from ..common.permissions import IsAdmin, IsAnalyst
+from ..common.utils import csv_streaming_response
+
+EXPORT_CHUNK_SIZE = 2000
+
+PRODUCT_EXPORT_FIELDS = (
+    'id', 'sku', 'name', 'description', 'category__name', 'price',
+    'stock_quantity', 'is_available', 'created_at', 'updated_at',
+)
+
+CATEGORY_EXPORT_FIELDS = (
+    'id', 'name', 'description', 'parent__name', 'created_at', 'updated_at',
+)
+
+
+def _format_dt(value):
+    # isoformat заметно быстрее strftime; срез отбрасывает смещение часового пояса
+    return value.isoformat(sep=' ', timespec='seconds')[:19]
+
+
+def _product_rows(queryset):
+    """
+    Строки экспорта товаров: кортежи значений читаются пачками,
+    модели Product на каждую строку не создаются
+    """
+    rows = queryset.values_list(*PRODUCT_EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for (product_id, sku, name, description, category_name, price,
+         stock_quantity, is_available, created_at, updated_at) in rows:
+        yield (
+            product_id,
+            sku,
+            name,
+            description or '',
+            category_name or '',
+            str(price),
+            stock_quantity,
+            'Да' if is_available else 'Нет',
+            _format_dt(created_at),
+            _format_dt(updated_at),
+        )
+
+
+def _category_rows(queryset):
+    """Строки экспорта категорий"""
+    rows = queryset.values_list(*CATEGORY_EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for category_id, name, description, parent_name, created_at, updated_at in rows:
+        yield (
+            category_id,
+            name,
+            description or '',
+            parent_name or '',
+            _format_dt(created_at),
+            _format_dt(updated_at),
+        )
 
 
 @api_view(['GET'])
@@ -21,33 +70,17 @@ def export_products_csv(request):
     """
     category_id = request.query_params.get('category')
     search = request.query_params.get('search')
+    # Атрибуты товаров в выгрузку не попадают — их предзагрузка не нужна
     queryset = ProductService.get_products_with_filters(
         category_id=int(category_id) if category_id else None,
         search=search,
         available_only=False
-    )
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="products_export.csv"'
-    writer = csv.writer(response)
-    writer.writerow([
+    ).prefetch_related(None)
+    header = [
         'ID', 'SKU', 'Название', 'Описание', 'Категория', 
         'Цена', 'Количество на складе', 'Доступен', 'Создан', 'Обновлен'
-    ])
-    for product in queryset:
-        writer.writerow([
-            product.id,
-            product.sku,
-            product.name,
-            product.description or '',
-            product.category.name if product.category else '',
-            str(product.price),
-            product.stock_quantity,
-            'Да' if product.is_available else 'Нет',
-            product.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            product.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-        ])
-    
-    return response
+    ]
+    return csv_streaming_response(header, _product_rows(queryset), 'products_export.csv')
 
 
 @api_view(['GET'])
@@ -58,23 +91,6 @@ def export_categories_csv(request):
     
     GET /api/v1/categories/export/csv/
     """
-    queryset = Category.objects.select_related('parent').all()
-    
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = 'attachment; filename="categories_export.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['ID', 'Название', 'Описание', 'Родительская категория', 'Создан', 'Обновлен'])
-    
-    for category in queryset:
-        writer.writerow([
-            category.id,
-            category.name,
-            category.description or '',
-            category.parent.name if category.parent else '',
-            category.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            category.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-        ])
-    
-    return response
-
+    queryset = Category.objects.all()
+    header = ['ID', 'Название', 'Описание', 'Родительская категория', 'Создан', 'Обновлен']
+    return csv_streaming_response(header, _category_rows(queryset), 'categories_export.csv')
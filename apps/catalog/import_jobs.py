@@ -0,0 +1,104 @@
+"""
+Фоновый импорт товаров из CSV.
+
+Загруженный файл сохраняется в хранилище (default_storage), разбор и запись
+в БД выполняются в отдельном пуле потоков: HTTP-воркер не занят на всё время
+импорта. Число одновременных импортов ограничено размером пула (IMPORT_WORKERS),
+остальные ждут в очереди. Состояние задачи хранится в кэше.
+"""
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+IMPORT_STATE_PENDING = 'PENDING'
+IMPORT_STATE_PROGRESS = 'PROGRESS'
+IMPORT_STATE_SUCCESS = 'SUCCESS'
+IMPORT_STATE_FAILURE = 'FAILURE'
+
+IMPORT_JOB_KEY_PREFIX = 'import:products:'
+# Сколько хранится состояние задачи после последнего обновления
+IMPORT_JOB_TIMEOUT = 24 * 3600
+IMPORT_UPLOAD_DIR = 'imports'
+
+_import_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'IMPORT_WORKERS', 1), thread_name_prefix='import'
+)
+
+
+def _set_state(job_id, state, **data):
+    cache.set(f'{IMPORT_JOB_KEY_PREFIX}{job_id}', {'state': state, **data}, IMPORT_JOB_TIMEOUT)
+
+
+def get_import_status(job_id):
+    """
+    Состояние задачи импорта
+
+    Returns:
+        dict: {'state': ..., 'processed'/'total' | 'result' | 'error'} или None, если задача не найдена
+    """
+    return cache.get(f'{IMPORT_JOB_KEY_PREFIX}{job_id}')
+
+
+def start_products_import(file):
+    """
+    Сохранить загруженный CSV и поставить импорт в очередь после фиксации
+    текущей транзакции. Если IMPORT_ASYNC выключен (например, в тестах),
+    импорт выполняется синхронно.
+
+    Returns:
+        str: id задачи для get_import_status
+    """
+    job_id = uuid.uuid4().hex
+    path = default_storage.save(f'{IMPORT_UPLOAD_DIR}/{job_id}.csv', file)
+    _set_state(job_id, IMPORT_STATE_PENDING)
+    if not getattr(settings, 'IMPORT_ASYNC', True):
+        _run_products_import(job_id, path)
+    else:
+        transaction.on_commit(lambda: _import_executor.submit(_run_in_worker, job_id, path))
+    return job_id
+
+
+def _run_in_worker(job_id, path):
+    """
+    Выполнить импорт в потоке пула. Соединение с БД потока проверяется
+    и закрывается по тем же правилам, что и в обработке запросов.
+    Только для пула: при синхронном импорте соединение принадлежит запросу
+    и может быть внутри его транзакции.
+    """
+    close_old_connections()
+    try:
+        _run_products_import(job_id, path)
+    finally:
+        close_old_connections()
+
+
+def _run_products_import(job_id, path):
+    """
+    Разобрать сохранённый CSV и записать товары, обновляя состояние задачи;
+    сохранённый файл удаляется в любом случае
+    """
+    from .import_views import CsvImportError, import_product_rows, parse_products_csv
+
+    try:
+        with default_storage.open(path, 'rb') as file:
+            parsed = parse_products_csv(file)
+        result = import_product_rows(
+            *parsed,
+            progress=lambda processed, total: _set_state(
+                job_id, IMPORT_STATE_PROGRESS, processed=processed, total=total
+            ),
+        )
+        _set_state(job_id, IMPORT_STATE_SUCCESS, result=result)
+    except CsvImportError as e:
+        _set_state(job_id, IMPORT_STATE_FAILURE, error=str(e))
+    except Exception as e:
+        logger.exception('Ошибка фонового импорта товаров %s', job_id)
+        _set_state(job_id, IMPORT_STATE_FAILURE, error=f'Ошибка импорта: {str(e)}')
+    finally:
+        default_storage.delete(path)
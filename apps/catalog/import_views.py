@@ -1,17 +1,281 @@
 """
 Импорт категорий и товаров из CSV с rate limiting.
 """
+import codecs
 import csv
-import io
+from decimal import Decimal, InvalidOperation
+from operator import itemgetter
+from django.conf import settings
 from django.http import JsonResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
-from django.db import transaction
+from django.db import DatabaseError, transaction
+from .import_jobs import IMPORT_STATE_PENDING, get_import_status, start_products_import
 from .models import Product, Category
 from ..common.permissions import IsAdmin
 from ..common.throttles import ImportRateThrottle
 
+# utf-8-sig читает UTF-8 и с BOM, и без него; всё, что не UTF-8, считается cp1251
+IMPORT_ENCODINGS = ('utf-8-sig', 'cp1251')
+# Сколько байт начала файла читается для определения кодировки
+ENCODING_SNIFF_SIZE = 64 * 1024
+MAX_IMPORT_ROWS = 10000
+
+# Колонки CSV товаров в порядке распаковки строки
+PRODUCT_IMPORT_COLUMNS = (
+    'SKU', 'Название', 'Описание', 'Категория', 'Цена', 'Количество на складе', 'Доступен',
+)
+_get_product_fields = itemgetter(*PRODUCT_IMPORT_COLUMNS)
+AVAILABLE_TRUE = frozenset({'да', 'yes', 'true', '1'})
+# Как часто (в строках) фоновый импорт обновляет прогресс
+IMPORT_PROGRESS_STEP = 1000
+
+
+def open_csv_reader(file):
+    """
+    Потоковое чтение загруженного CSV: кодировка определяется по началу файла,
+    дальше строки декодируются и разбираются по мере чтения file, без копии
+    всего файла в памяти
+
+    Returns:
+        csv.DictReader или None, если кодировку определить не удалось.
+        Ошибка декодирования дальше по файлу — UnicodeDecodeError при итерации
+    """
+    head = file.read(ENCODING_SNIFF_SIZE)
+    file.seek(0)
+    for encoding in IMPORT_ENCODINGS:
+        try:
+            # final=False: многобайтовый символ на границе прочитанного куска — не ошибка
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+        except UnicodeDecodeError:
+            continue
+        return csv.DictReader(codecs.getreader(encoding)(file))
+    return None
+
+
+def unique_category_slug(name, taken_slugs):
+    """
+    Slug новой категории, не совпадающий с taken_slugs (занятые в БД и уже
+    выданные в этом импорте): bulk_create не вызывает Category.save, поэтому
+    slug задаётся до вставки. При совпадении добавляется суффикс -2, -3, ...
+    Выданный slug добавляется в taken_slugs
+    """
+    max_length = Category._meta.get_field('slug').max_length
+    base = Category.slug_from_name(name)[:max_length - 6] or 'category'
+    slug = base
+    suffix = 2
+    while slug in taken_slugs:
+        slug = f'{base}-{suffix}'
+        suffix += 1
+    taken_slugs.add(slug)
+    return slug
+
+
+class CsvImportError(Exception):
+    """Ошибка содержимого файла импорта (кодировка, формат, лимит строк) — ответ 400"""
+
+
+def parse_products_csv(file):
+    """
+    Первый проход по CSV товаров: строки файла читаются один раз; лимит строк
+    проверяется по ходу чтения, попутно собираются SKU и категории, которые нужно
+    найти в БД. Строка сразу сводится к кортежу очищенных значений PRODUCT_IMPORT_COLUMNS
+
+    Returns:
+        tuple: (rows, csv_skus, csv_category_names, available_default)
+
+    Raises:
+        CsvImportError: кодировка не определена, ошибка чтения, слишком много строк или нет данных
+    """
+    csv_reader = open_csv_reader(file)
+    if csv_reader is None:
+        raise CsvImportError('Не удалось определить кодировку файла. Используйте UTF-8')
+
+    rows = []
+    csv_skus = set()
+    csv_category_names = set()
+    try:
+        # Отсутствующие в заголовке колонки добавляются, чтобы itemgetter
+        # не падал с KeyError: их значения в строках будут None
+        fieldnames = csv_reader.fieldnames or []
+        missing_columns = [c for c in PRODUCT_IMPORT_COLUMNS if c not in fieldnames]
+        if missing_columns:
+            csv_reader.fieldnames = list(fieldnames) + missing_columns
+        available_default = 'Доступен' in missing_columns
+        for row in csv_reader:
+            if len(rows) == MAX_IMPORT_ROWS:
+                raise CsvImportError(
+                    f'Файл содержит слишком много строк (более {MAX_IMPORT_ROWS}). '
+                    f'Максимум: {MAX_IMPORT_ROWS}'
+                )
+            values = tuple(v.strip() if v else '' for v in _get_product_fields(row))
+            rows.append(values)
+            if values[0]:
+                csv_skus.add(values[0])
+            if values[3]:
+                csv_category_names.add(values[3])
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise CsvImportError(f'Ошибка чтения файла: {str(e)}')
+
+    if not rows:
+        raise CsvImportError('Файл не содержит данных (только заголовки)')
+    return rows, csv_skus, csv_category_names, available_default
+
+
+def import_product_rows(rows, csv_skus, csv_category_names, available_default, progress=None):
+    """
+    Запись разобранных строк (см. parse_products_csv) в БД: новые товары —
+    bulk_create, существующие по SKU — bulk_update.
+
+    Каждая пачка (BULK_CREATE_BATCH_SIZE / BULK_UPDATE_BATCH_SIZE) пишется в своей
+    транзакции, чтобы не держать блокировки строк товаров всё время импорта.
+    Обновляемые товары перечитываются под select_for_update(skip_locked=True):
+    строки, занятые другой операцией (например, списанием остатков по заказу),
+    пропускаются и попадают в errors. Ошибка записи пачки откатывает только её
+
+    Args:
+        progress: необязательный callback(processed, total), вызывается
+            каждые IMPORT_PROGRESS_STEP строк и по завершении разбора
+
+    Returns:
+        dict: итог импорта (тело ответа API)
+    """
+    errors = []
+    success_count = 0
+    updated_count = 0
+    products_to_create = []
+    products_to_update = []
+    total = len(rows)
+    # Из БД читаются только товары и категории, упомянутые в файле, а не вся таблица.
+    # Здесь нужен лишь id по SKU: сами строки перечитываются под блокировкой при записи
+    existing_products = Product.objects.filter(sku__in=csv_skus).only('id', 'sku').in_bulk(field_name='sku')
+    # Для категорий нужен только id по названию — без объектов модели и лишних колонок
+    category_map = dict(Category.objects.filter(name__in=csv_category_names).values_list('name', 'id'))
+    
+    for row_num, (sku, name, description, category_name, price_s, qty_s, avail) in enumerate(rows, start=2):
+        if progress is not None and row_num % IMPORT_PROGRESS_STEP == 0:
+            progress(row_num - 2, total)
+        try:
+            if not sku or not name:
+                errors.append(f'Строка {row_num}: Отсутствуют обязательные поля (SKU, Название)')
+                continue
+            
+            category_id = None
+            if category_name:
+                category_id = category_map.get(category_name)
+                if not category_id:
+                    errors.append(f'Строка {row_num}: Категория "{category_name}" не найдена')
+                    continue
+            try:
+                # Decimal сразу: без округления через float перед DecimalField
+                price = Decimal(price_s.replace(',', '.')) if price_s else Decimal('0')
+                if not price.is_finite():
+                    raise InvalidOperation
+            except InvalidOperation:
+                errors.append(f'Строка {row_num}: Неверный формат цены')
+                continue
+            try:
+                stock_quantity = int(qty_s) if qty_s else 0
+            except ValueError:
+                errors.append(f'Строка {row_num}: Неверный формат количества')
+                continue
+            is_available = available_default or avail.lower() in AVAILABLE_TRUE
+            if sku in existing_products:
+                products_to_update.append({
+                    'sku': sku,
+                    'name': name,
+                    'description': description,
+                    'category_id': category_id,
+                    'price': price,
+                    'stock_quantity': stock_quantity,
+                    'is_available': is_available,
+                    'row_num': row_num
+                })
+            else:
+                product = Product(
+                    sku=sku,
+                    name=name,
+                    description=description,
+                    category_id=category_id,
+                    price=price,
+                    stock_quantity=stock_quantity,
+                    is_available=is_available
+                )
+                products_to_create.append((row_num, product))
+                # Повтор SKU ниже по файлу обновит этот же товар после bulk_create
+                existing_products[sku] = product
+        except Exception as e:
+            errors.append(f'Строка {row_num}: {str(e)}')
+            continue
+    if progress is not None:
+        progress(total, total)
+    
+    create_batch_size = settings.BULK_CREATE_BATCH_SIZE
+    for i in range(0, len(products_to_create), create_batch_size):
+        batch = products_to_create[i:i + create_batch_size]
+        try:
+            with transaction.atomic():
+                Product.objects.bulk_create([product for _, product in batch])
+        except DatabaseError as e:
+            errors.append(f'Строки {batch[0][0]}-{batch[-1][0]}: Ошибка записи: {str(e)}')
+            continue
+        success_count += len(batch)
+    
+    update_batch_size = settings.BULK_UPDATE_BATCH_SIZE
+    for i in range(0, len(products_to_update), update_batch_size):
+        batch = products_to_update[i:i + update_batch_size]
+        # Товар, созданный в неудавшейся пачке выше, остался без id
+        pk_by_sku = {
+            data['sku']: existing_products[data['sku']].pk
+            for data in batch if existing_products[data['sku']].pk is not None
+        }
+        try:
+            with transaction.atomic():
+                locked = Product.objects.select_for_update(skip_locked=True).in_bulk(set(pk_by_sku.values()))
+                products_bulk_update = {}
+                applied = 0
+                for update_data in batch:
+                    product = locked.get(pk_by_sku.get(update_data['sku']))
+                    if product is None:
+                        errors.append(
+                            f'Строка {update_data["row_num"]}: Товар {update_data["sku"]} '
+                            f'занят другой операцией или не создан, строка пропущена'
+                        )
+                        continue
+                    product.name = update_data['name']
+                    if update_data['description']:
+                        product.description = update_data['description']
+                    if update_data['category_id']:
+                        product.category_id = update_data['category_id']
+                    product.price = update_data['price']
+                    product.stock_quantity = update_data['stock_quantity']
+                    product.is_available = update_data['is_available']
+                    products_bulk_update[product.pk] = product
+                    applied += 1
+                if products_bulk_update:
+                    Product.objects.bulk_update(
+                        products_bulk_update.values(),
+                        ['name', 'description', 'category', 'price', 'stock_quantity', 'is_available']
+                    )
+        except DatabaseError as e:
+            errors.append(f'Строки {batch[0]["row_num"]}-{batch[-1]["row_num"]}: Ошибка записи: {str(e)}')
+            continue
+        updated_count += applied
+    
+    from .services import ProductService, CategoryService
+    ProductService.invalidate_cache()
+    CategoryService.invalidate_cache()
+    
+    return {
+        'message': 'Импорт завершен',
+        'created': success_count,
+        'updated': updated_count,
+        'errors': errors,
+        'total_processed': success_count + updated_count,
+        'has_errors': len(errors) > 0
+    }
+
 
 @api_view(['POST'])
 @permission_classes([IsAdmin])
@@ -46,155 +310,38 @@ def import_products_csv(request):
             {'error': 'Файл слишком маленький или пустой'},
             status=status.HTTP_400_BAD_REQUEST
         )
-    try:
-        file_content = file.read()
-        decoded_file = None
-        
-        for encoding in ['utf-8-sig', 'utf-8', 'cp1251', 'windows-1251']:
-            try:
-                decoded_file = file_content.decode(encoding)
-                break
-            except UnicodeDecodeError:
-                continue
-        
-        if decoded_file is None:
-            return Response(
-                {'error': 'Не удалось определить кодировку файла. Используйте UTF-8'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        MAX_ROWS = 10000
-        lines = decoded_file.splitlines()
-        row_count = len(lines) - 1
-        
-        if row_count > MAX_ROWS:
-            return Response(
-                {'error': f'Файл содержит слишком много строк ({row_count}). Максимум: {MAX_ROWS}'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        if row_count < 1:
-            return Response(
-                {'error': 'Файл не содержит данных (только заголовки)'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        csv_reader = csv.DictReader(io.StringIO(decoded_file))
-        
-    except Exception as e:
+    if request.query_params.get('background'):
+        # Разбор и запись выполняются в фоновом пуле, ответ — сразу с id задачи
+        job_id = start_products_import(file)
         return Response(
-            {'error': f'Ошибка чтения файла: {str(e)}'},
-            status=status.HTTP_400_BAD_REQUEST
+            {'task_id': job_id, 'status': IMPORT_STATE_PENDING},
+            status=status.HTTP_202_ACCEPTED
         )
     
-    errors = []
-    success_count = 0
-    updated_count = 0
-    products_to_create = []
-    products_to_update = []
-    existing_skus = set(Product.objects.values_list('sku', flat=True))
-    category_map = {cat.name: cat for cat in Category.objects.all()}
-    
     try:
-        with transaction.atomic():
-            for row_num, row in enumerate(csv_reader, start=2):
-                try:
-                    if not row.get('SKU') or not row.get('Название'):
-                        errors.append(f'Строка {row_num}: Отсутствуют обязательные поля (SKU, Название)')
-                        continue
-                    
-                    sku = row['SKU'].strip()
-                    name = row['Название'].strip()
-                    description = row.get('Описание', '').strip()
-                    category = None
-                    if row.get('Категория'):
-                        category_name = row['Категория'].strip()
-                        category = category_map.get(category_name)
-                        if not category:
-                            errors.append(f'Строка {row_num}: Категория "{category_name}" не найдена')
-                            continue
-                    try:
-                        price = float(row['Цена'].replace(',', '.')) if row.get('Цена') else 0.0
-                    except (ValueError, AttributeError):
-                        errors.append(f'Строка {row_num}: Неверный формат цены')
-                        continue
-                    try:
-                        stock_quantity = int(row['Количество на складе']) if row.get('Количество на складе') else 0
-                    except (ValueError, AttributeError):
-                        errors.append(f'Строка {row_num}: Неверный формат количества')
-                        continue
-                    is_available = row.get('Доступен', 'да').lower() in ('да', 'yes', 'true', '1')
-                    if sku in existing_skus:
-                        products_to_update.append({
-                            'sku': sku,
-                            'name': name,
-                            'description': description,
-                            'category': category,
-                            'price': price,
-                            'stock_quantity': stock_quantity,
-                            'is_available': is_available,
-                            'row_num': row_num
-                        })
-                    else:
-                        products_to_create.append(Product(
-                            sku=sku,
-                            name=name,
-                            description=description,
-                            category=category,
-                            price=price,
-                            stock_quantity=stock_quantity,
-                            is_available=is_available
-                        ))
-                        existing_skus.add(sku)
-                except Exception as e:
-                    errors.append(f'Строка {row_num}: {str(e)}')
-                    continue
-            if products_to_create:
-                Product.objects.bulk_create(products_to_create, batch_size=100)
-                success_count = len(products_to_create)
-            if products_to_update:
-                update_skus = [p['sku'] for p in products_to_update]
-                existing_products = {p.sku: p for p in Product.objects.filter(sku__in=update_skus)}
-                
-                products_bulk_update = []
-                for update_data in products_to_update:
-                    sku = update_data['sku']
-                    if sku in existing_products:
-                        product = existing_products[sku]
-                        product.name = update_data['name']
-                        if update_data['description']:
-                            product.description = update_data['description']
-                        if update_data['category']:
-                            product.category = update_data['category']
-                        product.price = update_data['price']
-                        product.stock_quantity = update_data['stock_quantity']
-                        product.is_available = update_data['is_available']
-                        products_bulk_update.append(product)
-                
-                if products_bulk_update:
-                    Product.objects.bulk_update(
-                        products_bulk_update,
-                        ['name', 'description', 'category', 'price', 'stock_quantity', 'is_available'],
-                        batch_size=100
-                    )
-                    updated_count = len(products_bulk_update)
-            from .services import ProductService, CategoryService
-            ProductService.invalidate_cache()
-            CategoryService.invalidate_cache()
+        parsed = parse_products_csv(file)
+    except CsvImportError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
+    try:
+        result = import_product_rows(*parsed)
     except Exception as e:
         return Response(
             {'error': f'Ошибка импорта: {str(e)}'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
     
-    return Response({
-        'message': 'Импорт завершен',
-        'created': success_count,
-        'updated': updated_count,
-        'errors': errors,
-        'total_processed': success_count + updated_count,
-        'has_errors': len(errors) > 0
-    }, status=status.HTTP_200_OK)
+    return Response(result, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdmin])
+def import_products_status(request, task_id):
+    """Состояние фонового импорта товаров (см. ?background=1)"""
+    job = get_import_status(task_id)
+    if job is None:
+        return Response({'error': 'Задача импорта не найдена'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(job)
 
 
 @api_view(['POST'])
@@ -227,10 +374,15 @@ def import_categories_csv(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    csv_reader = open_csv_reader(file)
+    if csv_reader is None:
+        return Response(
+            {'error': 'Не удалось определить кодировку файла. Используйте UTF-8'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
     try:
-        decoded_file = file.read().decode('utf-8-sig')
-        csv_reader = csv.DictReader(io.StringIO(decoded_file))
-    except Exception as e:
+        rows = list(csv_reader)
+    except (UnicodeDecodeError, csv.Error) as e:
         return Response(
             {'error': f'Ошибка чтения файла: {str(e)}'},
             status=status.HTTP_400_BAD_REQUEST
@@ -241,10 +393,16 @@ def import_categories_csv(request):
     updated_count = 0
     categories_to_create = []
     categories_to_update = []
-    existing_names = {cat.name: cat for cat in Category.objects.all()}
+    # id по названию (для родителей и проверки существования) и занятые slug —
+    # без объектов модели: обновляемые категории перечитываются ниже по названиям
+    existing_names = {}
+    taken_slugs = set()
+    for category_name, category_id, slug in Category.objects.values_list('name', 'id', 'slug'):
+        existing_names[category_name] = category_id
+        taken_slugs.add(slug)
     try:
         with transaction.atomic():
-            for row_num, row in enumerate(csv_reader, start=2):
+            for row_num, row in enumerate(rows, start=2):
                 try:
                     if not row.get('Название'):
                         errors.append(f'Строка {row_num}: Отсутствует обязательное поле "Название"')
@@ -252,32 +410,33 @@ def import_categories_csv(request):
                     
                     name = row['Название'].strip()
                     description = row.get('Описание', '').strip()
-                    parent = None
+                    parent_id = None
                     if row.get('Родительская категория'):
                         parent_name = row['Родительская категория'].strip()
-                        parent = existing_names.get(parent_name)
-                        if not parent:
+                        parent_id = existing_names.get(parent_name)
+                        if not parent_id:
                             errors.append(f'Строка {row_num}: Родительская категория "{parent_name}" не найдена')
                             continue
                     if name in existing_names:
                         categories_to_update.append({
                             'name': name,
                             'description': description,
-                            'parent': parent,
+                            'parent_id': parent_id,
                             'row_num': row_num
                         })
                     else:
                         categories_to_create.append(Category(
                             name=name,
+                            slug=unique_category_slug(name, taken_slugs),
                             description=description,
-                            parent=parent
+                            parent_id=parent_id
                         ))
                         existing_names[name] = None
                 except Exception as e:
                     errors.append(f'Строка {row_num}: {str(e)}')
                     continue
             if categories_to_create:
-                Category.objects.bulk_create(categories_to_create, batch_size=100)
+                Category.objects.bulk_create(categories_to_create, batch_size=settings.BULK_CREATE_BATCH_SIZE)
                 success_count = len(categories_to_create)
             if categories_to_update:
                 update_names = [c['name'] for c in categories_to_update]
@@ -290,15 +449,15 @@ def import_categories_csv(request):
                         category = existing_categories[name]
                         if update_data['description']:
                             category.description = update_data['description']
-                        if update_data['parent']:
-                            category.parent = update_data['parent']
+                        if update_data['parent_id']:
+                            category.parent_id = update_data['parent_id']
                         categories_bulk_update.append(category)
                 
                 if categories_bulk_update:
                     Category.objects.bulk_update(
                         categories_bulk_update,
                         ['description', 'parent'],
-                        batch_size=100
+                        batch_size=settings.BULK_UPDATE_BATCH_SIZE
                     )
                     updated_count = len(categories_bulk_update)
             from .services import CategoryService
@@ -4,13 +4,15 @@
 from django.db import models
 from django.core.validators import MinValueValidator
 from django.utils.text import slugify
+from apps.common.utils import on_commit_once
 
 
 class Category(models.Model):
     """Категория товаров (с поддержкой иерархии)"""
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=150, verbose_name='Название')
-    slug = models.SlugField(max_length=150, unique=True, verbose_name='URL-адрес')
+    # allow_unicode: slug строится из русских названий (см. slug_from_name)
+    slug = models.SlugField(max_length=150, unique=True, allow_unicode=True, verbose_name='URL-адрес')
     description = models.TextField(blank=True, null=True, verbose_name='Описание')
     parent = models.ForeignKey(
         'self',
@@ -34,18 +36,29 @@ class Category(models.Model):
         return self.name
     
     def save(self, *args, **kwargs):
-        """Автоматическое создание slug из названия и инвалидация кэша"""
+        """
+        Автоматическое создание slug из названия и инвалидация кэша
+        (один раз на транзакцию, после фиксации)
+        """
         if not self.slug:
-            self.slug = slugify(self.name)
+            self.slug = self.slug_from_name(self.name)
         super().save(*args, **kwargs)
         from .services import CategoryService
-        CategoryService.invalidate_cache()
+        on_commit_once(CategoryService.invalidate_cache)
     
     def delete(self, *args, **kwargs):
         """Инвалидация кэша при удалении"""
         from .services import CategoryService
-        CategoryService.invalidate_cache()
-        super().delete(*args, **kwargs)
+        on_commit_once(CategoryService.invalidate_cache)
+        return super().delete(*args, **kwargs)
+    
+    @staticmethod
+    def slug_from_name(name):
+        """
+        Slug из названия. allow_unicode: названия категорий на русском,
+        ASCII-slugify превратил бы их в пустую строку
+        """
+        return slugify(name, allow_unicode=True)
     
     def get_full_path(self):
         """Получить полный путь категории (с родителями)"""
@@ -147,16 +160,20 @@ class Product(models.Model):
         self.save(update_fields=['stock_quantity', 'is_available'])
     
     def save(self, *args, **kwargs):
-        """Сохранение товара с инвалидацией кэша"""
+        """
+        Сохранение товара с инвалидацией кэша. Сброс откладывается до фиксации
+        транзакции и выполняется один раз, сколько бы товаров в ней ни сохранили
+        (списание остатков по позициям заказа и т.п.)
+        """
         super().save(*args, **kwargs)
         from .services import ProductService
-        ProductService.invalidate_cache()
+        on_commit_once(ProductService.invalidate_cache)
     
     def delete(self, *args, **kwargs):
         """Удаление товара с инвалидацией кэша"""
         from .services import ProductService
-        ProductService.invalidate_cache()
-        super().delete(*args, **kwargs)
+        on_commit_once(ProductService.invalidate_cache)
+        return super().delete(*args, **kwargs)
 
 
 class ProductAttributeValue(models.Model):
@@ -20,14 +20,23 @@ class CategorySerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at')
     
     def get_children_count(self, obj):
-        if hasattr(obj, '_prefetched_objects_cache') and 'children' in obj._prefetched_objects_cache:
-            return len(obj.children.all())
-        return obj.children.count()
+        return self._related_count(obj, 'children')
     
     def get_products_count(self, obj):
-        if hasattr(obj, '_prefetched_objects_cache') and 'products' in obj._prefetched_objects_cache:
-            return len(obj.products.all())
-        return obj.products.count()
+        return self._related_count(obj, 'products')
+    
+    @staticmethod
+    def _related_count(obj, relation):
+        """
+        Количество связанных объектов: из аннотации _<relation>_count
+        (см. CategoryService.with_counts), из prefetch или отдельным COUNT
+        """
+        annotated = getattr(obj, f'_{relation}_count', None)
+        if annotated is not None:
+            return annotated
+        if hasattr(obj, '_prefetched_objects_cache') and relation in obj._prefetched_objects_cache:
+            return len(getattr(obj, relation).all())
+        return getattr(obj, relation).count()
 
 
 class CategoryTreeSerializer(serializers.ModelSerializer):
@@ -42,6 +51,35 @@ class CategoryTreeSerializer(serializers.ModelSerializer):
         """Рекурсивное получение дочерних категорий"""
         children = obj.children.all()
         return CategoryTreeSerializer(children, many=True).data
+    
+    @staticmethod
+    def build_tree(categories):
+        """
+        Дерево категорий из плоского списка за один проход: вместо запроса
+        children на каждый узел — словарь id -> узел и привязка к родителю в памяти.
+        Формат узлов тот же, что у сериализатора; порядок — порядок categories
+        
+        Args:
+            categories: список категорий (id, name, slug, description, parent_id)
+        
+        Returns:
+            list: корневые узлы с вложенными children
+        """
+        nodes = {
+            category.id: {
+                'id': category.id,
+                'name': category.name,
+                'slug': category.slug,
+                'description': category.description,
+                'children': [],
+            }
+            for category in categories
+        }
+        roots = []
+        for category in categories:
+            parent = nodes.get(category.parent_id)
+            (parent['children'] if parent else roots).append(nodes[category.id])
+        return roots
 
 
 class AttributeSerializer(serializers.ModelSerializer):
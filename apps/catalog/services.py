@@ -1,14 +1,16 @@
 """
 Сервисы каталога: товары и категории с фильтрами и кэшированием.
 """
-from django.db.models import Q, Prefetch, Count
+from django.db.models import Q, Prefetch, Count, F, Func, IntegerField, OuterRef, Subquery
 from django.core.cache import cache
 from .models import Product, Category, Attribute, ProductAttributeValue
+from ..common.utils import bump_cache_version, get_cache_version
 
 
 class ProductService:
     CACHE_TIMEOUT_POPULAR = 1800
     CACHE_KEY_POPULAR = 'popular_products'
+    VERSION_KEY = 'catalog:products:ver'
     
     @staticmethod
     def get_popular_products(limit=12):
@@ -21,7 +23,7 @@ class ProductService:
         Returns:
             QuerySet товаров
         """
-        cache_key = f"{ProductService.CACHE_KEY_POPULAR}_{limit}"
+        cache_key = f"{ProductService.CACHE_KEY_POPULAR}:{get_cache_version(ProductService.VERSION_KEY)}_{limit}"
         cached = cache.get(cache_key)
         if cached is not None:
             return cached
@@ -42,8 +44,8 @@ class ProductService:
     
     @staticmethod
     def invalidate_cache():
-        for limit in [6, 12, 24, 48]:
-            cache.delete(f"{ProductService.CACHE_KEY_POPULAR}_{limit}")
+        """Сброс кэша популярных товаров при любом limit — одним incr версии"""
+        bump_cache_version(ProductService.VERSION_KEY)
     
     @staticmethod
     def get_products_with_filters(
@@ -128,7 +130,9 @@ class ProductService:
             tuple: (is_available, product) или (False, None)
         """
         try:
-            product = Product.objects.get(id=product_id, is_available=True)
+            product = Product.objects.only(
+                'id', 'name', 'price', 'stock_quantity', 'is_available'
+            ).get(id=product_id, is_available=True)
             if product.stock_quantity >= quantity:
                 return True, product
             return False, product
@@ -140,34 +144,82 @@ class CategoryService:
     CACHE_TIMEOUT = 3600
     CACHE_KEY_TREE = 'category_tree'
     CACHE_KEY_LIST = 'category_list'
+    VERSION_KEY = 'catalog:categories:ver'
+    
+    @staticmethod
+    def _cache_key(name):
+        """Ключ записи с текущей версией кэша категорий"""
+        return f'{name}:{get_cache_version(CategoryService.VERSION_KEY)}'
     
     @staticmethod
     def get_category_tree():
-        """Получение дерева категорий с кэшированием"""
-        cached = cache.get(CategoryService.CACHE_KEY_TREE)
+        """
+        Получение дерева категорий с кэшированием.
+        Все категории читаются одним запросом, вложенность собирается в памяти
+        
+        Returns:
+            list: корневые узлы дерева (словари с вложенными children)
+        """
+        cache_key = CategoryService._cache_key(CategoryService.CACHE_KEY_TREE)
+        cached = cache.get(cache_key)
         if cached is not None:
             return cached
         
-        root_categories = Category.objects.filter(parent=None).prefetch_related('children').all()
-        cache.set(CategoryService.CACHE_KEY_TREE, root_categories, CategoryService.CACHE_TIMEOUT)
-        return root_categories
+        from .serializers import CategoryTreeSerializer
+        categories = list(Category.objects.only('id', 'name', 'slug', 'description', 'parent_id'))
+        tree = CategoryTreeSerializer.build_tree(categories)
+        cache.set(cache_key, tree, CategoryService.CACHE_TIMEOUT)
+        return tree
+    
+    @staticmethod
+    def _count_subquery(queryset):
+        """
+        Коррелированный подзапрос SELECT COUNT(id) по queryset (0, если строк нет).
+        COUNT как Func, а не Count: без GROUP BY подзапрос всегда возвращает одну строку
+        """
+        return Subquery(
+            queryset.order_by().annotate(
+                _count=Func(F('pk'), function='COUNT', output_field=IntegerField())
+            ).values('_count')
+        )
+    
+    @staticmethod
+    def with_counts(queryset=None):
+        """
+        Категории с количеством дочерних категорий и товаров (_children_count,
+        _products_count), посчитанным в том же запросе отдельными подзапросами
+        по индексам parent_id и category_id. JOIN обеих связей с COUNT DISTINCT
+        перемножал бы строки: дочерние × товары на каждую категорию
+        """
+        if queryset is None:
+            queryset = Category.objects.all()
+        return queryset.annotate(
+            _children_count=CategoryService._count_subquery(
+                Category.objects.filter(parent=OuterRef('pk'))
+            ),
+            _products_count=CategoryService._count_subquery(
+                Product.objects.filter(category=OuterRef('pk'))
+            ),
+        )
     
     @staticmethod
     def get_all_categories():
         """Получение всех категорий с кэшированием"""
-        cached = cache.get(CategoryService.CACHE_KEY_LIST)
+        cache_key = CategoryService._cache_key(CategoryService.CACHE_KEY_LIST)
+        cached = cache.get(cache_key)
         if cached is not None:
             return cached
         
         categories = Category.objects.all().order_by('name')
-        cache.set(CategoryService.CACHE_KEY_LIST, categories, CategoryService.CACHE_TIMEOUT)
+        cache.set(cache_key, categories, CategoryService.CACHE_TIMEOUT)
         return categories
     
     @staticmethod
     def invalidate_cache():
         """Инвалидация кэша категорий"""
-        cache.delete(CategoryService.CACHE_KEY_TREE)
-        cache.delete(CategoryService.CACHE_KEY_LIST)
+        bump_cache_version(CategoryService.VERSION_KEY)
+        # Популярные товары отдаются вместе с данными категории
+        bump_cache_version(ProductService.VERSION_KEY)
     
     @staticmethod
     def get_category_with_products(category_id):
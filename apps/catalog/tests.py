@@ -1,12 +1,16 @@
 """
 Тесты API каталога, сервисов и импорта/экспорта.
 """
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
+from .import_views import open_csv_reader, unique_category_slug
 from .models import Category, Product
+from .services import CategoryService, ProductService
 from apps.accounts.models import Role
 
 User = get_user_model()
@@ -88,12 +92,54 @@ class CategoryAPITestCase(TestCase):
         self.category.refresh_from_db()
         self.assertEqual(self.category.name, 'Обновленная категория')
     
+    def test_cyrillic_slug_round_trip(self):
+        """Slug из русского названия принимается сериализатором при обратной отправке"""
+        category = Category.objects.create(name='Мячи футбольные')
+        self.assertEqual(category.slug, 'мячи-футбольные')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        data = self.client.get(f'/api/v1/categories/{category.id}/').data
+        response = self.client.put(
+            f'/api/v1/categories/{category.id}/',
+            {'name': data['name'], 'slug': data['slug'], 'description': 'Описание'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
     def test_delete_category_admin(self):
         """Тест удаления категории администратором"""
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
         response = self.client.delete(f'/api/v1/categories/{self.category.id}/')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertFalse(Category.objects.filter(id=self.category.id).exists())
+    
+    def test_list_categories_counts_annotated(self):
+        """Счётчики считаются в запросе списка, без COUNT на каждую категорию"""
+        for i in range(2):
+            Category.objects.create(name=f'Дочерняя {i}', slug=f'child-{i}', parent=self.category)
+            Product.objects.create(
+                name=f'Товар {i}', sku=f'CNT-{i}', price=100, stock_quantity=1, category=self.category
+            )
+        # COUNT для пагинации и сама выборка
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/categories/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        root = next(c for c in response.data['results'] if c['id'] == self.category.id)
+        self.assertEqual(root['children_count'], 2)
+        self.assertEqual(root['products_count'], 2)
+    
+    def test_category_tree_single_query(self):
+        """Дерево любой глубины строится одним запросом, повторно — из кэша"""
+        # Кэш дерева сбрасывается после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            child = Category.objects.create(name='Дочерняя', slug='child', parent=self.category)
+            Category.objects.create(name='Внучатая', slug='grandchild', parent=child)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/categories/tree/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        root = response.data['results'][0]
+        self.assertEqual(root['id'], self.category.id)
+        self.assertEqual(root['children'][0]['children'][0]['slug'], 'grandchild')
+        with self.assertNumQueries(0):
+            self.client.get('/api/v1/categories/tree/')
 
 
 class ProductAPITestCase(TestCase):
@@ -283,4 +329,164 @@ class ProductImportExportTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
         self.assertIn('attachment', response['Content-Disposition'])
+    
+    def test_export_products_csv_streams_rows(self):
+        """Экспорт товаров отдаётся потоком, строки содержат категорию"""
+        Product.objects.create(
+            name='Мяч', sku='EXP-1', price=100, stock_quantity=3, category=self.category
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        response = self.client.get('/api/v1/products/export/csv/')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('EXP-1', lines[1])
+        self.assertIn('Категория', lines[1])
+
+
+    
+    def test_import_products_csv(self):
+        """Импорт создаёт новые товары, обновляет существующие по SKU и сообщает об ошибках строк"""
+        Product.objects.create(name='Старое', sku='IMP-1', price=1, stock_quantity=1, category=self.category)
+        content = (
+            'SKU,Название,Категория,Цена,Количество на складе\n'
+            'IMP-1,Обновлённый,Категория,150,5\n'
+            'IMP-2,Новый,,99.90,2\n'
+            'IMP-3,С чужой категорией,Нет такой,10,1\n'
+        ).encode('utf-8')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        response = self.client.post(
+            '/api/v1/products/import/csv/',
+            {'file': SimpleUploadedFile('products.csv', content)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        self.assertEqual(response.data['errors'], ['Строка 4: Категория "Нет такой" не найдена'])
+        self.assertEqual(Product.objects.get(sku='IMP-1').name, 'Обновлённый')
+        self.assertTrue(Product.objects.filter(sku='IMP-2').exists())
+    
+    def test_import_products_csv_normalizes_values(self):
+        """Значения очищаются от пробелов, цена с запятой читается без потери точности"""
+        content = (
+            'SKU,Название,Цена,Доступен\n'
+            ' NRM-1 , Мяч ,"1234,56", YES \n'
+            'NRM-2,Сетка,abc,да\n'
+        ).encode('utf-8')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        response = self.client.post(
+            '/api/v1/products/import/csv/',
+            {'file': SimpleUploadedFile('products.csv', content)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['errors'], ['Строка 3: Неверный формат цены'])
+        product = Product.objects.get(sku='NRM-1')
+        self.assertEqual(product.name, 'Мяч')
+        self.assertEqual(str(product.price), '1234.56')
+        self.assertTrue(product.is_available)
+    
+    def test_import_products_csv_batches(self):
+        """Запись по пачкам: повтор SKU из файла обновляет товар, созданный в предыдущей пачке"""
+        content = (
+            'SKU,Название,Цена\n'
+            'BAT-1,Первый,10\n'
+            'BAT-2,Второй,20\n'
+            'BAT-1,Первый обновлённый,15\n'
+        ).encode('utf-8')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        with override_settings(BULK_CREATE_BATCH_SIZE=1, BULK_UPDATE_BATCH_SIZE=1):
+            response = self.client.post(
+                '/api/v1/products/import/csv/',
+                {'file': SimpleUploadedFile('products.csv', content)},
+                format='multipart'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated']), (2, 1))
+        self.assertEqual(response.data['errors'], [])
+        product = Product.objects.get(sku='BAT-1')
+        self.assertEqual((product.name, str(product.price)), ('Первый обновлённый', '15.00'))
+    
+    def test_import_categories_csv_sets_slugs(self):
+        """bulk_create при импорте категорий получает заполненные уникальные slug"""
+        content = 'Название,Описание\nЛыжи,\nКоньки,Фигурные\n'.encode('utf-8')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        response = self.client.post(
+            '/api/v1/categories/import/csv/',
+            {'file': SimpleUploadedFile('categories.csv', content)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(
+            set(Category.objects.filter(name__in=['Лыжи', 'Коньки']).values_list('slug', flat=True)),
+            {'лыжи', 'коньки'}
+        )
+    
+    def test_import_products_csv_background(self):
+        """?background=1: ответ 202 с id задачи, итог импорта — по адресу состояния"""
+        content = 'SKU,Название,Цена\nBG-1,Фоновый,10\n'.encode('utf-8')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        with override_settings(IMPORT_ASYNC=False):
+            response = self.client.post(
+                '/api/v1/products/import/csv/?background=1',
+                {'file': SimpleUploadedFile('products.csv', content)},
+                format='multipart'
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        task_id = response.data['task_id']
+        response = self.client.get(f'/api/v1/products/import/csv/{task_id}/')
+        self.assertEqual(response.data['state'], 'SUCCESS')
+        self.assertEqual(response.data['result']['created'], 1)
+        self.assertTrue(Product.objects.filter(sku='BG-1').exists())
+        response = self.client.get('/api/v1/products/import/csv/unknown/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+
+class OpenCsvReaderTestCase(SimpleTestCase):
+    """Тесты потокового чтения загруженного CSV"""
+    
+    def test_utf8_with_bom(self):
+        """BOM отбрасывается, многострочное поле в кавычках читается целиком"""
+        content = '\ufeffSKU,Название\nA-1,"Мяч\nфутбольный"\nA-2,Сетка\n'.encode('utf-8')
+        reader = open_csv_reader(SimpleUploadedFile('p.csv', content))
+        rows = list(reader)
+        self.assertEqual(reader.fieldnames, ['SKU', 'Название'])
+        self.assertEqual([row['Название'] for row in rows], ['Мяч\nфутбольный', 'Сетка'])
+    
+    def test_cp1251(self):
+        """Файл не в UTF-8 читается как cp1251"""
+        content = 'SKU,Название\nA-1,Кроссовки\n'.encode('cp1251')
+        rows = list(open_csv_reader(SimpleUploadedFile('p.csv', content)))
+        self.assertEqual(rows[0]['Название'], 'Кроссовки')
+    
+    def test_undecodable(self):
+        """Начало файла не декодируется ни в одной кодировке — None"""
+        content = b'SKU,\x98\xff\n'
+        self.assertIsNone(open_csv_reader(SimpleUploadedFile('p.csv', content)))
+
+
+class UniqueCategorySlugTestCase(SimpleTestCase):
+    """Тесты slug категорий при импорте"""
+    
+    def test_cyrillic_and_duplicates(self):
+        """Русское название даёт непустой slug, совпадения получают суффикс"""
+        taken = {'мячи'}
+        self.assertEqual(unique_category_slug('Мячи', taken), 'мячи-2')
+        self.assertEqual(unique_category_slug('Мячи', taken), 'мячи-3')
+        self.assertEqual(unique_category_slug('Beach Volley', taken), 'beach-volley')
+        self.assertEqual(unique_category_slug('!!!', taken), 'category')
+
+
+class CatalogCacheVersionTestCase(SimpleTestCase):
+    """Тесты версионирования кэша каталога"""
+    
+    def test_invalidate_bumps_version(self):
+        """Инвалидация делает недостижимыми записи под старой версией"""
+        tree_key = CategoryService._cache_key(CategoryService.CACHE_KEY_TREE)
+        cache.set(tree_key, ['stale'])
+        cache.set(ProductService.VERSION_KEY, 1, None)
+        CategoryService.invalidate_cache()
+        self.assertNotEqual(CategoryService._cache_key(CategoryService.CACHE_KEY_TREE), tree_key)
+        # Категории входят в ответ популярных товаров — их версия тоже меняется
+        self.assertEqual(cache.get(ProductService.VERSION_KEY), 2)
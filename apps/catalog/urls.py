@@ -21,6 +21,7 @@ urlpatterns = [
     path('products/<int:product_id>/attributes/<int:pk>/', views.ProductAttributeDetailAPIView.as_view(), name='product-attribute-detail'),
     path('products/export/csv/', export_views.export_products_csv, name='product-export-csv'),
     path('products/import/csv/', import_views.import_products_csv, name='product-import-csv'),
+    path('products/import/csv/<str:task_id>/', import_views.import_products_status, name='product-import-status'),
     path('attributes/', views.AttributeListAPIView.as_view(), name='attribute-list'),
     path('attributes/<int:pk>/', views.AttributeDetailAPIView.as_view(), name='attribute-detail'),
 ]
@@ -31,11 +31,8 @@ class CategoryListAPIView(generics.ListCreateAPIView):
     ordering = ['name']
     
     def get_queryset(self):
-        """Оптимизированный queryset с prefetch для счетчиков"""
-        return Category.objects.select_related('parent').prefetch_related(
-            'children',
-            'products'
-        ).all()
+        """Счётчики дочерних категорий и товаров считаются в том же запросе"""
+        return CategoryService.with_counts(Category.objects.select_related('parent'))
     
     def get_permissions(self):
         """Разные права для GET и POST"""
@@ -50,11 +47,8 @@ class CategoryDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdmin]
     
     def get_queryset(self):
-        """Оптимизированный queryset с prefetch"""
-        return Category.objects.select_related('parent').prefetch_related(
-            'children',
-            'products'
-        ).all()
+        """Счётчики дочерних категорий и товаров считаются в том же запросе"""
+        return CategoryService.with_counts(Category.objects.select_related('parent'))
     
     def get_permissions(self):
         """Разные права для GET и остальных методов"""
@@ -65,9 +59,16 @@ class CategoryDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
 
 class CategoryTreeAPIView(generics.ListAPIView):
     """Дерево категорий"""
-    queryset = CategoryService.get_category_tree()
     serializer_class = CategoryTreeSerializer
     permission_classes = [permissions.AllowAny]
+    
+    def list(self, request, *args, **kwargs):
+        """Готовое (закэшированное) дерево отдаётся без сериализации по узлам"""
+        tree = CategoryService.get_category_tree()
+        page = self.paginate_queryset(tree)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(tree)
 
 
 @api_view(['GET'])
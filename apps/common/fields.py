@@ -0,0 +1,24 @@
+"""
+Кастомные поля моделей
+"""
+from django.db import models
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONField(models.JSONField):
+    """
+    JSONField, декодирующий значения из БД через orjson (в 3-5 раз быстрее json).
+    Без установленного orjson или с кастомным decoder работает как обычный JSONField.
+    """
+    
+    def from_db_value(self, value, expression, connection):
+        if orjson is None or self.decoder is not None or not isinstance(value, (str, bytes)):
+            return super().from_db_value(value, expression, connection)
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            return value
@@ -1,5 +1,8 @@
 """
-Кастомные permissions для управления доступом
+Кастомные permissions для управления доступом.
+
+Роль читается из денормализованного users.role_name — проверка прав
+не обращается к таблице roles.
 """
 from rest_framework import permissions
 
@@ -11,8 +14,7 @@ class IsAdmin(permissions.BasePermission):
         return (
             request.user and
             request.user.is_authenticated and
-            hasattr(request.user, 'role') and
-            request.user.role.name == 'Admin'
+            request.user.role_name == 'Admin'
         )
 
 
@@ -23,8 +25,7 @@ class IsAnalyst(permissions.BasePermission):
         return (
             request.user and
             request.user.is_authenticated and
-            hasattr(request.user, 'role') and
-            request.user.role.name in ('Analyst', 'Admin')
+            request.user.role_name in ('Analyst', 'Admin')
         )
 
 
@@ -43,7 +44,7 @@ class IsOwnerOrAdmin(permissions.BasePermission):
     
     def has_object_permission(self, request, view, obj):
         # Администратор имеет доступ ко всему
-        if hasattr(request.user, 'role') and request.user.role.name == 'Admin':
+        if getattr(request.user, 'role_name', None) == 'Admin':
             return True
         
         # Проверяем, является ли пользователь владельцем
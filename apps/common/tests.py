@@ -1,14 +1,17 @@
 """
 Тесты для общих функций (безопасность, права доступа, SQL-инъекции)
 """
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, SimpleTestCase, RequestFactory
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from apps.accounts.models import Role
 from apps.catalog.models import Category, Product
+from apps.catalog.services import ProductService
 from .permissions import IsAdmin, IsBuyer, IsAnalyst
+from .utils import cached_csv_response, on_commit_once, parse_date_param
 
 User = get_user_model()
 
@@ -193,6 +196,15 @@ class PermissionsTestCase(TestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_buyer_token()}')
         response = self.client.get('/api/v1/admin/backups/')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+    
+    def test_role_permissions_do_not_load_role(self):
+        """IsAdmin/IsAnalyst читают users.role_name — роль из таблицы roles не загружается"""
+        analyst = User.objects.get(id=self.analyst.id)
+        request = RequestFactory().get('/')
+        request.user = analyst
+        with self.assertNumQueries(0):
+            self.assertTrue(IsAnalyst().has_permission(request, None))
+            self.assertFalse(IsAdmin().has_permission(request, None))
 
 
 class PasswordHashingTestCase(TestCase):
@@ -277,3 +289,71 @@ class CardDataSecurityTestCase(TestCase):
         for card in cards:
             self.assertNotIn('hash', card)  # Хеш не должен быть в ответе
             self.assertIn('last_four', card)  # Только последние 4 цифры
+
+
+class CachedCSVResponseTestCase(SimpleTestCase):
+    """Тесты кэширования CSV-выгрузок"""
+    
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+    
+    def test_repeat_export_served_from_cache(self):
+        """Повторная выгрузка с теми же параметрами не читает строки и отдаёт gzip"""
+        first = cached_csv_response(
+            self.factory.get('/export/', {'year': '2024'}), 'test_export', ['a'], iter([[1], [2]]), 'test.csv'
+        )
+        self.assertEqual(b''.join(first.streaming_content), b'a\r\n1\r\n2\r\n')
+        
+        def fail_rows():
+            raise AssertionError('строки не должны читаться при попадании в кэш')
+            yield
+        
+        gzipped = cached_csv_response(
+            self.factory.get('/export/', {'year': '2024'}, HTTP_ACCEPT_ENCODING='gzip, deflate'),
+            'test_export', ['a'], fail_rows(), 'test.csv'
+        )
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        
+        plain = cached_csv_response(
+            self.factory.get('/export/', {'year': '2024'}), 'test_export', ['a'], fail_rows(), 'test.csv'
+        )
+        self.assertEqual(plain.content, b'a\r\n1\r\n2\r\n')
+
+
+class ParseDateParamTestCase(SimpleTestCase):
+    """Тесты разбора дат из query-параметров"""
+    
+    def test_valid_and_invalid_dates(self):
+        """Корректная дата разбирается, неверный формат и несуществующая дата дают None"""
+        self.assertEqual(parse_date_param('2024-02-29').isoformat(), '2024-02-29')
+        self.assertIsNone(parse_date_param('2024-02-30'))
+        self.assertIsNone(parse_date_param('29.02.2024'))
+
+
+class OnCommitOnceTestCase(TestCase):
+    """Тесты отложенного однократного вызова после фиксации транзакции"""
+    
+    def test_queued_once_per_transaction(self):
+        """Повторная постановка той же функции в одной транзакции не дублирует вызов"""
+        calls = []
+        
+        def callback():
+            calls.append(1)
+        
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for _ in range(3):
+                on_commit_once(callback)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(calls, [1])
+    
+    def test_product_saves_invalidate_cache_once(self):
+        """Сохранение нескольких товаров в транзакции сбрасывает кэш популярных один раз"""
+        category = Category.objects.create(name='Кэш', slug='cache')
+        with self.captureOnCommitCallbacks() as callbacks:
+            for i in range(3):
+                Product.objects.create(
+                    name=f'Товар {i}', sku=f'OC-{i}', price=1, stock_quantity=5, category=category
+                )
+        self.assertEqual(len(callbacks), 1)
+        self.assertIs(callbacks[0], ProductService.invalidate_cache)
@@ -1,7 +1,20 @@
 """
 Общие утилиты
 """
-from django.db import connection
+import csv
+import gzip
+import hashlib
+import io
+import json
+import time
+from functools import lru_cache
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_date
+
+CSV_CACHE_TIMEOUT = 900
 
 
 def execute_db_function(function_name, *args):
@@ -20,6 +33,54 @@ def execute_db_function(function_name, *args):
         return cursor.fetchall()
 
 
+@lru_cache(maxsize=1024)
+def parse_date_param(value):
+    """
+    Разбор даты из query-параметра (YYYY-MM-DD) с мемоизацией:
+    отчёты запрашиваются с одними и теми же периодами.
+
+    Returns:
+        date или None, если строка не является корректной датой
+    """
+    try:
+        return parse_date(value)
+    except ValueError:
+        # Формат верный, но даты не существует (например, 2024-02-30)
+        return None
+
+
+def get_cache_version(version_key):
+    """
+    Текущая версия группы ключей кэша. Версия входит в ключи записей:
+    инвалидация — один incr (bump_cache_version), старые записи становятся
+    недостижимы и истекают по TTL.
+    Начальная версия — текущее время, чтобы после вытеснения ключа версии из кэша
+    не вернуться к номеру, под которым ещё лежат старые данные
+    """
+    return cache.get_or_set(version_key, lambda: int(time.time()), None)
+
+
+def bump_cache_version(version_key):
+    """Сделать недостижимыми все записи группы ключей version_key (см. get_cache_version)"""
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # Версии ещё нет — первое чтение создаст новую
+        pass
+
+
+def on_commit_once(func, using=None):
+    """
+    Выполнить func после фиксации текущей транзакции один раз, сколько бы
+    раз её ни поставили в очередь в этой транзакции (например, сброс кэша
+    при сохранении каждой строки в цикле). Вне транзакции func выполняется сразу
+    """
+    conn = transaction.get_connection(using)
+    if conn.in_atomic_block and any(queued is func for _, queued, _ in conn.run_on_commit):
+        return
+    transaction.on_commit(func, using=using)
+
+
 def set_current_user_id(user_id):
     """
     Установка текущего пользователя для использования в триггерах БД
@@ -39,3 +100,105 @@ def set_current_role(role_name):
         # Параметр 'true' означает, что переменная действует только для текущей транзакции
         cursor.execute("SELECT set_config('app.current_role', %s, true)", [role_name])
 
+
+class Echo:
+    """
+    Псевдобуфер для csv.writer: write() возвращает строку вместо записи,
+    чтобы строки CSV можно было отдавать генератором
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_cache_key(view_name, params):
+    """
+    Ключ кэша CSV-выгрузки: имя представления + blake2b нормализованных query-параметров
+    """
+    normalized = json.dumps(sorted((key, sorted(values)) for key, values in params.lists()))
+    digest = hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+    return f'csv:{view_name}:{digest}'
+
+
+def csv_streaming_response(header, rows, filename, cache_key=None, timeout=CSV_CACHE_TIMEOUT):
+    """
+    Потоковый CSV-ответ: строки отправляются клиенту по мере формирования,
+    весь файл в памяти не собирается
+
+    Args:
+        header: список заголовков колонок
+        rows: итерируемое из списков значений (может быть ленивым)
+        filename: имя файла для Content-Disposition
+        cache_key: если указан, по ходу отдачи тело сжимается gzip
+            и после последней строки кладётся в кэш
+        timeout: время жизни закэшированного тела
+
+    Returns:
+        StreamingHttpResponse
+    """
+    writer = csv.writer(Echo())
+
+    def stream():
+        yield writer.writerow(header)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def stream_and_cache():
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as gz:
+            for chunk in stream():
+                gz.write(chunk.encode('utf-8'))
+                yield chunk
+        cache.set(cache_key, buffer.getvalue(), timeout)
+
+    content = stream_and_cache() if cache_key else stream()
+    response = StreamingHttpResponse(content, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def cached_csv_response(request, view_name, header, rows, filename, timeout=CSV_CACHE_TIMEOUT):
+    """
+    CSV-выгрузка с кэшированием сжатого тела по query-параметрам запроса.
+
+    При попадании в кэш запрос к БД и формирование CSV не выполняются:
+    клиенту, принимающему gzip, тело отдаётся как есть (Content-Encoding: gzip),
+    остальным — распакованным. При промахе ответ стримится и заодно кэшируется.
+
+    Args:
+        rows: ленивое итерируемое строк — не читается при попадании в кэш
+    """
+    cache_key = csv_cache_key(view_name, request.GET)
+    body = cache.get(cache_key)
+    if body is None:
+        response = csv_streaming_response(header, rows, filename, cache_key=cache_key, timeout=timeout)
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(body, content_type='text/csv; charset=utf-8')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(body), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def make_etag(*parts):
+    """
+    Слабый ETag из значений, от которых зависит содержимое ответа
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def not_modified_response(request, etag):
+    """
+    Ответ 304 Not Modified, если If-None-Match клиента совпадает с etag, иначе None
+
+    Args:
+        request: запрос Django или DRF
+        etag: ETag текущего состояния ресурса (см. make_etag)
+    """
+    response = get_conditional_response(getattr(request, '_request', request), etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+    return response
@@ -23,12 +23,12 @@ class ChatListAPIView(generics.ListAPIView):
         """Получить чаты в зависимости от роли"""
         user = self.request.user
         
-        if user.role.name == 'Admin':
+        if user.role_name == 'Admin':
             # Админ видит все чаты
             return Chat.objects.select_related('order', 'user').prefetch_related(
                 'messages__sender'
             ).filter(is_active=True)
-        elif user.role.name == 'Analyst':
+        elif user.role_name == 'Analyst':
             # Аналитик видит чаты, где он участвовал или все активные
             return Chat.objects.select_related('order', 'user').prefetch_related(
                 'messages__sender'
@@ -53,7 +53,7 @@ class ChatDetailAPIView(generics.RetrieveAPIView):
         """Получить чат с проверкой прав"""
         user = self.request.user
         
-        if user.role.name in ('Admin', 'Analyst'):
+        if user.role_name in ('Admin', 'Analyst'):
             return Chat.objects.select_related('order', 'user').prefetch_related(
                 'messages__sender'
             ).all()
@@ -80,7 +80,7 @@ def create_chat_view(request, order_id):
         )
     
     # Проверяем права доступа
-    if request.user.role.name not in ('Admin', 'Analyst'):
+    if request.user.role_name not in ('Admin', 'Analyst'):
         if order.user != request.user:
             return Response(
                 {'error': 'У вас нет доступа к этому заказу'},
@@ -130,7 +130,7 @@ def create_chat_message_view(request, chat_id):
     
     # Проверяем права доступа
     user = request.user
-    if user.role.name not in ('Admin', 'Analyst'):
+    if user.role_name not in ('Admin', 'Analyst'):
         if chat.user != user:
             return Response(
                 {'error': 'У вас нет доступа к этому чату'},
@@ -173,7 +173,7 @@ def mark_messages_read_view(request, chat_id):
     
     # Проверяем права доступа
     user = request.user
-    if user.role.name not in ('Admin', 'Analyst'):
+    if user.role_name not in ('Admin', 'Analyst'):
         if chat.user != user:
             return Response(
                 {'error': 'У вас нет доступа к этому чату'},
@@ -1,7 +1,7 @@
 """
 Views для экспорта заказов в CSV
 """
-import csv
+from django.db.models import Count, Prefetch
 from django.http import HttpResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import status
@@ -10,6 +10,60 @@ from .models import Order, OrderItem
 from .services import OrderService
 from ..common.permissions import IsAdmin, IsAnalyst
 from ..common.models import Log
+from ..common.utils import csv_streaming_response
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _format_dt(value):
+    # isoformat заметно быстрее strftime; срез отбрасывает смещение часового пояса
+    return value.isoformat(sep=' ', timespec='seconds')[:19]
+
+
+def _order_columns(order):
+    """Общие колонки заказа: ID, дата, пользователь, email, статус"""
+    return [
+        order.id,
+        _format_dt(order.order_date),
+        order.user.username if order.user else '',
+        order.user.email if order.user else '',
+        order.status,
+    ]
+
+
+def _summary_rows(queryset):
+    """Строки краткого экспорта; заказы читаются пачками, а не целиком в память"""
+    for order in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield _order_columns(order) + [
+            str(order.total_amount),
+            order.items_count,
+            _format_dt(order.created_at),
+            _format_dt(order.updated_at),
+        ]
+
+
+def _detailed_rows(queryset):
+    """Строки детального экспорта: по строке на позицию, заказ без позиций — одной строкой"""
+    for order in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        order_columns = _order_columns(order)
+        order_tail = [
+            str(order.total_amount),
+            _format_dt(order.created_at),
+            _format_dt(order.updated_at),
+        ]
+        items = order.items.all()
+        if not items:
+            yield order_columns + ['', '', '', '', '', ''] + order_tail
+            continue
+        for item in items:
+            yield order_columns + [
+                item.id,
+                item.product.name if item.product else '',
+                item.product.sku if item.product else '',
+                item.quantity,
+                str(item.price_at_purchase),
+                str(item.get_total_price()),
+            ] + order_tail
 
 
 @extend_schema(
@@ -63,7 +117,7 @@ def export_orders_csv(request):
         detailed = request.query_params.get('detailed', 'false').lower() == 'true'
         
         # Получаем заказы
-        queryset = Order.objects.select_related('user').prefetch_related('items__product').all()
+        queryset = Order.objects.select_related('user')
         
         if status_filter:
             queryset = queryset.filter(status=status_filter)
@@ -88,75 +142,30 @@ def export_orders_csv(request):
             }
         )
         
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
-        filename = 'orders_export_detailed.csv' if detailed else 'orders_export.csv'
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        
-        writer = csv.writer(response)
-        
         if detailed:
-            # Детальный экспорт с позициями заказов
-            writer.writerow([
+            # Детальный экспорт с позициями заказов: позиции подгружаются
+            # одним запросом на каждую пачку заказов итератора
+            queryset = queryset.prefetch_related(
+                Prefetch('items', queryset=OrderItem.objects.select_related('product'))
+            )
+            header = [
                 'ID заказа', 'Дата заказа', 'Пользователь', 'Email', 'Статус',
                 'ID позиции', 'Товар', 'SKU', 'Количество', 'Цена за единицу', 'Сумма позиции',
                 'Общая сумма заказа', 'Создан', 'Обновлен'
-            ])
-            
-            for order in queryset:
-                items = order.items.select_related('product').all()
-                if items:
-                    for item in items:
-                        writer.writerow([
-                            order.id,
-                            order.order_date.strftime('%Y-%m-%d %H:%M:%S'),
-                            order.user.username if order.user else '',
-                            order.user.email if order.user else '',
-                            order.status,
-                            item.id,
-                            item.product.name if item.product else '',
-                            item.product.sku if item.product else '',
-                            item.quantity,
-                            str(item.price_at_purchase),
-                            str(item.get_total_price()),
-                            str(order.total_amount),
-                            order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                            order.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-                        ])
-                else:
-                    # Заказ без позиций
-                    writer.writerow([
-                        order.id,
-                        order.order_date.strftime('%Y-%m-%d %H:%M:%S'),
-                        order.user.username if order.user else '',
-                        order.user.email if order.user else '',
-                        order.status,
-                        '', '', '', '', '', '',
-                        str(order.total_amount),
-                        order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                        order.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    ])
+            ]
+            rows = _detailed_rows(queryset)
+            filename = 'orders_export_detailed.csv'
         else:
-            # Краткий экспорт
-            writer.writerow([
+            # Краткий экспорт: число позиций считается в том же запросе
+            queryset = queryset.annotate(items_count=Count('items'))
+            header = [
                 'ID заказа', 'Дата заказа', 'Пользователь', 'Email', 'Статус',
                 'Сумма заказа', 'Количество позиций', 'Создан', 'Обновлен'
-            ])
-            
-            for order in queryset:
-                items_count = order.items.count()
-                writer.writerow([
-                    order.id,
-                    order.order_date.strftime('%Y-%m-%d %H:%M:%S'),
-                    order.user.username if order.user else '',
-                    order.user.email if order.user else '',
-                    order.status,
-                    str(order.total_amount),
-                    items_count,
-                    order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    order.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-                ])
+            ]
+            rows = _summary_rows(queryset)
+            filename = 'orders_export.csv'
         
-        return response
+        return csv_streaming_response(header, rows, filename)
         
     except Exception as e:
         # Логируем ошибку
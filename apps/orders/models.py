@@ -5,6 +5,7 @@ from django.db import models
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 from apps.catalog.models import Product
+from apps.common.utils import on_commit_once
 
 User = get_user_model()
 
@@ -76,6 +77,25 @@ class Order(models.Model):
     def is_active(self):
         """Является ли заказ активным (не завершен и не отменен)"""
         return self.status not in ['Completed', 'Cancelled', 'Refunded']
+    
+    def affects_analytics(self):
+        """Учитывается ли заказ в отчётах (выполнен или возвращён)"""
+        return self.status in ['Completed', 'Refunded']
+    
+    def save(self, *args, **kwargs):
+        """Сохранение заказа с инвалидацией кэша аналитики при смене статуса на итоговый"""
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if self.affects_analytics() and (update_fields is None or 'status' in update_fields):
+            from apps.analytics.services import AnalyticsService
+            on_commit_once(AnalyticsService.invalidate_cache)
+    
+    def delete(self, *args, **kwargs):
+        """Удаление заказа с инвалидацией кэша аналитики"""
+        if self.affects_analytics():
+            from apps.analytics.services import AnalyticsService
+            on_commit_once(AnalyticsService.invalidate_cache)
+        return super().delete(*args, **kwargs)
 
 
 class OrderItem(models.Model):
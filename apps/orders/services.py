@@ -8,24 +8,35 @@ from django.contrib.auth import get_user_model
 from .models import Order, OrderItem, Transaction
 from apps.catalog.models import Product
 from apps.cart.services import CartService
-from ..common.utils import set_current_user_id, set_current_role
+from ..common.utils import on_commit_once, set_current_user_id, set_current_role
 from ..common.models import Log
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
 
+# Процедуры, наличие которых уже подтверждено в этом процессе: схема БД
+# не меняется во время работы, поэтому pg_proc не опрашивается на каждый заказ
+_existing_procedures = set()
+
+
 def _procedure_exists(procname):
     """Проверяет наличие хранимой процедуры/функции в БД (для fallback в тестах)."""
+    if procname in _existing_procedures:
+        return True
     try:
         with connection.cursor() as cursor:
             cursor.execute(
                 'SELECT 1 FROM pg_proc WHERE proname = %s',
                 [procname]
             )
-            return cursor.fetchone() is not None
+            exists = cursor.fetchone() is not None
     except Exception:
         return False
+    # Отсутствие не запоминаем: процедуру могут создать без перезапуска приложения
+    if exists:
+        _existing_procedures.add(procname)
+    return exists
 
 
 def _create_order_from_cart_python(user):
@@ -33,7 +44,7 @@ def _create_order_from_cart_python(user):
     Резервная реализация создания заказа из корзины на Python.
     Используется, если в БД нет хранимой процедуры create_order_from_cart (например, в тестах).
     """
-    cart_items = list(CartService.get_cart(user))
+    cart_items = list(CartService.get_cart_minimal(user))
     if not cart_items:
         raise ValueError('Корзина пуста')
     total_amount = Decimal('0')
@@ -94,8 +105,8 @@ class OrderService:
         
         # Устанавливаем контекст пользователя для триггеров БД
         set_current_user_id(user.id)
-        if user.role:
-            set_current_role(user.role.name)
+        if user.role_name:
+            set_current_role(user.role_name)
         
         # Если процедуры нет в БД (например, тестовая БД) — используем Python-реализацию
         if not _procedure_exists('create_order_from_cart'):
@@ -181,7 +192,7 @@ class OrderService:
             
             if user:
                 # Если указан пользователь, проверяем права доступа
-                if user.role.name == 'Admin':
+                if user.role_name == 'Admin':
                     # Администратор видит все заказы
                     return queryset.get(id=order_id)
                 else:
@@ -217,8 +228,8 @@ class PaymentService:
         # Устанавливаем контекст пользователя
         if user:
             set_current_user_id(user.id)
-            if user.role:
-                set_current_role(user.role.name)
+            if user.role_name:
+                set_current_role(user.role_name)
         
         # Валидация суммы платежа
         try:
@@ -257,11 +268,6 @@ class PaymentService:
                 user_id=user.id if user else None,
                 meta={'transaction_id': tx.id, 'order_id': order_id, 'action': 'payment_processed'}
             )
-            try:
-                from apps.analytics.services import AnalyticsService
-                AnalyticsService.invalidate_cache()
-            except Exception:
-                pass
             return tx, 'Success'
 
         try:
@@ -288,7 +294,7 @@ class PaymentService:
                     logger.info(f'Payment processed: tx_id={transaction_id}, order_id={order_id}, amount={amount}, status={status}')
                     if status == 'Success':
                         from apps.analytics.services import AnalyticsService
-                        AnalyticsService.invalidate_cache()
+                        on_commit_once(AnalyticsService.invalidate_cache)
                     if transaction_id:
                         transaction_obj = Transaction.objects.select_related('order').get(id=transaction_id)
                         return transaction_obj, status
@@ -330,8 +336,8 @@ class PaymentService:
         # Устанавливаем контекст пользователя
         if user:
             set_current_user_id(user.id)
-            if user.role:
-                set_current_role(user.role.name)
+            if user.role_name:
+                set_current_role(user.role_name)
         
         # Вызываем функцию БД
         try:
@@ -356,7 +362,7 @@ class PaymentService:
                     
                     logger.info(f'Transaction refunded: tx_id={transaction_id}, result={message}')
                     from apps.analytics.services import AnalyticsService
-                    AnalyticsService.invalidate_cache()
+                    on_commit_once(AnalyticsService.invalidate_cache)
                     return message
                 else:
                     raise ValueError('Ошибка при возврате транзакции')
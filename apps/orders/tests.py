@@ -9,7 +9,7 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from apps.catalog.models import Category, Product
 from apps.accounts.models import Role
 from apps.cart.models import CartItem
-from .models import Order, Transaction
+from .models import Order, OrderItem, Transaction
 from .services import OrderService, PaymentService
 
 User = get_user_model()
@@ -128,6 +128,21 @@ class OrderAPITestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['id'], order.id)
 
+    
+    def test_export_orders_csv_detailed_streams_items(self):
+        """Детальный экспорт стримится: строка на позицию, заказ без позиций — одной строкой"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.get_admin_token()}')
+        order = Order.objects.create(user=self.buyer, total_amount=2000.00, status='Pending')
+        OrderItem.objects.create(order=order, product=self.product, quantity=2, price_at_purchase=1000.00)
+        Order.objects.create(user=self.buyer, total_amount=0, status='Cancelled')
+        
+        response = self.client.get('/api/v1/orders/export/csv/?detailed=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('PROD-001', lines[-1])
+
 
 class PaymentTestCase(TestCase):
     """Тесты для платежей"""
@@ -227,3 +242,26 @@ class OrderServiceTestCase(TestCase):
         self.assertEqual(orders.count(), 1)
         self.assertEqual(orders.first().id, order.id)
 
+    
+    def test_procedure_existence_remembered(self):
+        """
+        Наличие процедуры проверяется запросом к pg_proc один раз и запоминается;
+        отсутствие не запоминается и проверяется заново
+        """
+        from . import services
+        # Чистое состояние кэша процесса: результат не зависит от порядка тестов
+        remembered = set(services._existing_procedures)
+        services._existing_procedures.clear()
+        try:
+            # now() — встроенная функция PostgreSQL, она всегда есть в pg_proc
+            with self.assertNumQueries(1):
+                self.assertTrue(services._procedure_exists('now'))
+            with self.assertNumQueries(0):
+                self.assertTrue(services._procedure_exists('now'))
+            
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    self.assertFalse(services._procedure_exists('no_such_procedure_xyz'))
+        finally:
+            services._existing_procedures.clear()
+            services._existing_procedures.update(remembered)
@@ -32,7 +32,7 @@ class OrderListAPIView(generics.ListAPIView):
         """Получить заказы в зависимости от роли пользователя"""
         user = self.request.user
         
-        if user.role.name == 'Admin':
+        if user.role_name == 'Admin':
             return Order.objects.select_related('user').prefetch_related(
                 'items__product',
                 'transactions'
@@ -91,7 +91,7 @@ class OrderDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
         """Получить заказ с проверкой прав доступа"""
         user = self.request.user
         
-        if user.role.name == 'Admin':
+        if user.role_name == 'Admin':
             return Order.objects.select_related('user').prefetch_related(
                 'items__product',
                 'transactions'
@@ -102,7 +102,7 @@ class OrderDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     def get_object(self):
         """Получить заказ с проверкой прав"""
         order = super().get_object()
-        if self.request.user.role.name != 'Admin':
+        if self.request.user.role_name != 'Admin':
             if order.user != self.request.user:
                 from rest_framework.exceptions import PermissionDenied
                 raise PermissionDenied('У вас нет доступа к этому заказу')
@@ -111,7 +111,7 @@ class OrderDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     
     def update(self, request, *args, **kwargs):
         """Обновление заказа (только для админов)"""
-        if request.user.role.name != 'Admin':
+        if request.user.role_name != 'Admin':
             from rest_framework.exceptions import PermissionDenied
             raise PermissionDenied('Только администраторы могут изменять заказы')
         
@@ -124,7 +124,7 @@ class OrderDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
     
     def destroy(self, request, *args, **kwargs):
         """Удаление заказа (только для админов)"""
-        if request.user.role.name != 'Admin':
+        if request.user.role_name != 'Admin':
             from rest_framework.exceptions import PermissionDenied
             raise PermissionDenied('Только администраторы могут удалять заказы')
         
@@ -168,9 +168,6 @@ def update_order_status_view(request, pk):
     
     order.status = new_status
     order.save(update_fields=['status', 'updated_at'])
-    if new_status in ('Completed', 'Refunded'):
-        from apps.analytics.services import AnalyticsService
-        AnalyticsService.invalidate_cache()
     
     serializer = OrderSerializer(order)
     return Response(serializer.data)
@@ -204,7 +201,7 @@ def create_payment_view(request, order_id):
             status=status.HTTP_404_NOT_FOUND
         )
     
-    if request.user.role.name != 'Admin' and order.user != request.user:
+    if request.user.role_name != 'Admin' and order.user != request.user:
         return Response(
             {'error': 'У вас нет доступа к этому заказу'},
             status=status.HTTP_403_FORBIDDEN
@@ -367,7 +364,7 @@ def order_transactions_view(request, order_id):
             status=status.HTTP_404_NOT_FOUND
         )
     
-    if request.user.role.name != 'Admin' and order.user != request.user:
+    if request.user.role_name != 'Admin' and order.user != request.user:
         return Response(
             {'error': 'У вас нет доступа к этому заказу'},
             status=status.HTTP_403_FORBIDDEN
@@ -2,6 +2,7 @@
 Настройки Django-проекта интернет-магазина спортивных товаров (курсовая).
 """
 
+import sys
 from pathlib import Path
 from decouple import config
 import os
@@ -74,6 +75,9 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default=config('db_password', default='')),
         'HOST': config('DB_HOST', default=config('db_host', default='localhost')),
         'PORT': config('DB_PORT', default=config('db_port', default='5432')),
+        # Постоянные соединения: без TCP/TLS-подключения и аутентификации на каждый запрос
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=600, cast=int),
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
             'options': '-c search_path=shop,public'
         },
@@ -101,6 +105,10 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# В тестах пароли хешируются MD5: PBKDF2 на каждом create_user заметно замедляет прогон
+if 'test' in sys.argv:
+    PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
 LANGUAGE_CODE = 'ru-ru'
 TIME_ZONE = 'Europe/Moscow'
 USE_I18N = True
@@ -116,7 +124,7 @@ AUTH_USER_MODEL = 'accounts.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.accounts.authentication.RoleJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
@@ -200,6 +208,15 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='Grenghem@yandex.ru')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='zkvgrkpeetyhxnyo')
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default=EMAIL_HOST_USER)
 FRONTEND_URL = config('FRONTEND_URL', default='http://127.0.0.1:8001')
+EMAIL_ASYNC = config('EMAIL_ASYNC', default=True, cast=bool)
+EMAIL_WORKERS = config('EMAIL_WORKERS', default=2, cast=int)
+
+# Размер пачки bulk_create/bulk_update при импорте CSV
+BULK_CREATE_BATCH_SIZE = config('SPORTMAG_BULK_CREATE_BATCH', default=1000, cast=int)
+BULK_UPDATE_BATCH_SIZE = config('SPORTMAG_BULK_UPDATE_BATCH', default=1000, cast=int)
+# Фоновый импорт товаров (?background=1): одновременно выполняется не более IMPORT_WORKERS
+IMPORT_ASYNC = config('IMPORT_ASYNC', default=True, cast=bool)
+IMPORT_WORKERS = config('IMPORT_WORKERS', default=1, cast=int)
 
 LOGGING = {
     'version': 1,
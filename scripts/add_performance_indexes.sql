@@ -59,11 +59,14 @@ CREATE INDEX IF NOT EXISTS idx_categories_parent ON categories(parent_id);
 -- CREATE INDEX IF NOT EXISTS idx_categories_slug ON categories(slug); -- уже есть через UNIQUE
 
 -- Индексы для таблицы cart_items
--- Составной индекс для поиска товаров в корзине пользователя
-CREATE INDEX IF NOT EXISTS idx_cart_items_user_product ON cart_items(user_id, product_id);
-
--- Индекс для фильтрации по пользователю
-CREATE INDEX IF NOT EXISTS idx_cart_items_user ON cart_items(user_id);
+-- UNIQUE (user_id, product_id) уже даёт B-tree индекс: он покрывает и поиск позиции,
+-- и фильтр по user_id (ведущая колонка). Отдельные индексы только дублируют его
+-- и замедляют каждую вставку/изменение/удаление в корзине.
+-- (user_id, updated_at) тоже не нужен: MAX(updated_at) для ETag корзины считается
+-- по нескольким строкам пользователя, найденным через тот же UNIQUE-индекс
+DROP INDEX IF EXISTS idx_cart_items_user_product;
+DROP INDEX IF EXISTS idx_cart_items_user;
+DROP INDEX IF EXISTS idx_cart_user;
 
 -- Индексы для таблицы logs
 -- Индекс для фильтрации по уровню лога
@@ -92,6 +95,12 @@ CREATE INDEX IF NOT EXISTS idx_users_is_active ON users(is_active) WHERE is_acti
 -- Составной индекс для поиска по роли и активности
 CREATE INDEX IF NOT EXISTS idx_users_role_active ON users(role_id, is_active);
 
+-- Индекс для сортировки по дате регистрации (ordering модели User, список в админке и API)
+CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at DESC);
+
+-- Функциональный индекс для поиска по email без учёта регистра (сброс пароля)
+CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users(lower(email));
+
 -- Индексы для таблицы backups
 -- Индекс для сортировки по дате создания
 CREATE INDEX IF NOT EXISTS idx_backups_created_at ON backups(created_at DESC);
@@ -104,7 +113,6 @@ COMMENT ON INDEX idx_orders_status IS 'Индекс для быстрой фил
 COMMENT ON INDEX idx_orders_order_date IS 'Индекс для сортировки заказов по дате';
 COMMENT ON INDEX idx_order_items_order_product IS 'Составной индекс для JOIN заказов и товаров';
 COMMENT ON INDEX idx_products_available_stock IS 'Частичный индекс для быстрого поиска доступных товаров';
-COMMENT ON INDEX idx_cart_items_user_product IS 'Индекс для быстрого поиска товаров в корзине пользователя';
 
 -- Статистика для оптимизатора запросов
 ANALYZE orders;
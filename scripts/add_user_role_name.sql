@@ -0,0 +1,61 @@
+-- ======================================================
+-- Денормализация названия роли в таблицу users
+-- Проверки прав (is_staff, is_superuser) читают users.role_name
+-- без JOIN с таблицей roles.
+-- Использование: выполните в pgAdmin или через psql
+-- ======================================================
+
+SET search_path = shop, public;
+
+-- ======================================================
+-- 1. Колонка role_name и заполнение существующих строк
+-- ======================================================
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS role_name VARCHAR(50) NOT NULL DEFAULT '';
+
+UPDATE users u
+SET role_name = r.name
+FROM roles r
+WHERE r.id = u.role_id
+  AND u.role_name IS DISTINCT FROM r.name;
+
+CREATE INDEX IF NOT EXISTS idx_users_role_name ON users(role_name);
+
+-- ======================================================
+-- 2. Синхронизация при вставке и смене роли пользователя
+-- ======================================================
+
+CREATE OR REPLACE FUNCTION sync_user_role_name()
+RETURNS TRIGGER AS $$
+BEGIN
+    SELECT name INTO NEW.role_name FROM roles WHERE id = NEW.role_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_sync_role_name ON users;
+CREATE TRIGGER trg_users_sync_role_name
+    BEFORE INSERT OR UPDATE OF role_id ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION sync_user_role_name();
+
+-- ======================================================
+-- 3. Синхронизация при переименовании роли
+-- ======================================================
+
+CREATE OR REPLACE FUNCTION propagate_role_name()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE users SET role_name = NEW.name WHERE role_id = NEW.id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_roles_propagate_name ON roles;
+CREATE TRIGGER trg_roles_propagate_name
+    AFTER UPDATE OF name ON roles
+    FOR EACH ROW
+    WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE FUNCTION propagate_role_name();
+
+ANALYZE users;
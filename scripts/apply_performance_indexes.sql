@@ -84,23 +84,13 @@ CREATE INDEX IF NOT EXISTS idx_categories_parent ON categories(parent_id);
 -- 6. Индексы для таблицы cart_items
 -- ======================================================
 
--- Составной индекс для поиска товаров в корзине пользователя
--- (уже есть UNIQUE на user_id, product_id, но добавим для оптимизации JOIN)
--- CREATE INDEX IF NOT EXISTS idx_cart_items_user_product ON cart_items(user_id, product_id); -- уже есть через UNIQUE
-
--- Индекс для фильтрации по пользователю (уже есть в основном скрипте как idx_cart_user)
--- Проверяем и создаем если нет
-DO $$
-BEGIN
-    IF NOT EXISTS (
-        SELECT 1 FROM pg_indexes 
-        WHERE schemaname = 'shop' 
-        AND tablename = 'cart_items' 
-        AND indexname = 'idx_cart_user'
-    ) THEN
-        CREATE INDEX idx_cart_user ON cart_items(user_id);
-    END IF;
-END $$;
+-- UNIQUE (user_id, product_id) уже даёт индекс: он покрывает поиск позиции
+-- и фильтр по user_id (ведущая колонка). Одноколоночный индекс по user_id
+-- и дублирующий составной только добавляют работы при каждой записи в корзину.
+-- Индекс (user_id, updated_at) для ETag корзины не нужен по той же причине
+DROP INDEX IF EXISTS idx_cart_items_user_product;
+DROP INDEX IF EXISTS idx_cart_items_user;
+DROP INDEX IF EXISTS idx_cart_user;
 
 -- ======================================================
 -- 7. Индексы для таблицы logs
@@ -151,6 +141,12 @@ CREATE INDEX IF NOT EXISTS idx_users_is_active ON users(is_active) WHERE is_acti
 -- Составной индекс для поиска по роли и активности
 CREATE INDEX IF NOT EXISTS idx_users_role_active ON users(role_id, is_active);
 
+-- Индекс для сортировки по дате регистрации (ordering модели User, список в админке и API)
+CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at DESC);
+
+-- Функциональный индекс для поиска по email без учёта регистра (сброс пароля)
+CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users(lower(email));
+
 -- Индекс для поиска по email (уже есть через UNIQUE)
 -- CREATE INDEX IF NOT EXISTS idx_users_email ON users(email); -- уже есть через UNIQUE
 
@@ -189,7 +185,6 @@ COMMENT ON INDEX idx_orders_status IS 'Индекс для быстрой фил
 COMMENT ON INDEX idx_orders_order_date IS 'Индекс для сортировки заказов по дате';
 COMMENT ON INDEX idx_order_items_order_product IS 'Составной индекс для JOIN заказов и товаров';
 COMMENT ON INDEX idx_products_available_stock IS 'Частичный индекс для быстрого поиска доступных товаров';
-COMMENT ON INDEX idx_cart_items_user_product IS 'Индекс для быстрого поиска товаров в корзине пользователя (через UNIQUE)';
 
 -- ======================================================
 -- 13. Обновление статистики для оптимизатора запросов